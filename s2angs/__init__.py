@@ -16,4 +16,6 @@
 # along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
 #
 
-from .s2_angs import *
\ No newline at end of file
+from .s2_angs import *
+from .batch import BatchResult, gen_s2_ang_batch
+from .model import AngleModel, PointAngles, angles_at, detector_ids
@@ -0,0 +1,221 @@
+#
+# This file is part of Brazil Data Cube Sentinel-2 Angle Bands.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Generation of angle bands for many Sentinel-2 products in parallel."""
+
+# Python Native
+import glob
+import logging
+import os
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from .output import get_output_profile
+from .s2_angs import gen_s2_ang
+
+logger = logging.getLogger(__name__)
+
+BatchResult = namedtuple('BatchResult', [
+    'path',           # input product (.SAFE, .zip or folder)
+    'outputs',        # gen_s2_ang result, or None when it failed
+    'error',          # formatted traceback of the failure, or None
+    'elapsed',        # processing time in seconds
+])
+
+# Peak memory of a scene written as separate files, whatever its bands, measured on a whole tile, in bytes
+SCENE_MEMORY = 320 * 2**20
+
+# Peak memory added by each layer (SZA, SAA, VZA and VAA of each band) of stacked or COG outputs, in bytes
+LAYER_MEMORY = 96 * 2**20
+
+# Seconds between checks of the available memory while scenes wait for it
+MEMORY_POLL = 5
+
+
+def expand_paths(paths):
+    """Expand a list of products and glob patterns.
+
+    Parameters:
+       paths (str or list): products (.SAFE, .zip or folders) or glob patterns.
+    Returns:
+       list: products in the given order, patterns expanded and sorted. Patterns matching nothing are kept as is.
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    products = []
+    for path in paths:
+        matches = sorted(glob.glob(path)) if glob.has_magic(path) else []
+        products.extend(matches or [path])
+    return products
+
+
+def available_memory():
+    """Return the physical memory available to new processes, in bytes, or None when unknown."""
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def estimate_scene_memory(bands=None, stack=None, output_profile=None, **kwargs):
+    """Approximate peak memory of a scene, from its gen_s2_ang parameters.
+
+    Stacked outputs are upsampled layer by layer into one file and COGs are
+    copied from a temporary GeoTIFF, both holding a block cache per layer.
+
+    Parameters:
+       bands (list) (optional): band names of the view angles. Defaults to B04.
+       stack (str) (optional): None, 'pixel', 'band' or 'vrt', see gen_s2_ang.
+       output_profile (str or OutputProfile) (optional): output profile, see OUTPUT_PROFILES.
+       kwargs: other gen_s2_ang parameters, not affecting the memory.
+    Returns:
+       int: peak memory in bytes.
+    """
+    layers = 2 + 2 * (len(bands) if bands else 1)
+    if stack in ('pixel', 'band'):
+        return SCENE_MEMORY + layers * LAYER_MEMORY
+    if get_output_profile(output_profile).cog:
+        return SCENE_MEMORY + LAYER_MEMORY
+    return SCENE_MEMORY
+
+
+def batch_workers(nscenes, workers=None, max_memory=None, scene_memory=SCENE_MEMORY):
+    """Number of processes of a batch, bounded by the CPUs, the memory and the number of scenes.
+
+    Parameters:
+       nscenes (int): number of scenes.
+       workers (int) (optional): requested number of processes. Defaults to the number of CPUs.
+       max_memory (int) (optional): memory budget in bytes. Defaults to the available physical memory.
+       scene_memory (int): approximate peak memory of a scene in bytes.
+    Returns:
+       int: number of processes.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if max_memory is None:
+        max_memory = available_memory()
+    if max_memory is not None:
+        workers = min(workers, max(1, int(max_memory // scene_memory)))
+    return max(1, min(workers, nscenes))
+
+
+def _gen_s2_ang_scene(path, output_dir, kwargs):
+    """Run gen_s2_ang on a scene, returning its failure instead of raising it."""
+    start = time.time()
+    try:
+        outputs = gen_s2_ang(path, output_dir, **kwargs)
+    except Exception:
+        return BatchResult(path=path, outputs=None, error=traceback.format_exc(), elapsed=time.time() - start)
+    return BatchResult(path=path, outputs=outputs, error=None, elapsed=time.time() - start)
+
+
+def _run_pool(products, output_dir, kwargs, workers, memory=None):
+    """Run scenes in a process pool, starting each one when a process and enough memory are free.
+
+    Parameters:
+       products (list): (index, path) of the scenes.
+       output_dir (str): path to output folder.
+       kwargs (dict): further gen_s2_ang parameters.
+       workers (int): number of processes.
+       memory (int) (optional): memory a scene needs to be started besides running ones, checked against the
+          available physical memory. Defaults to no check.
+    Returns:
+       dict: result of each scene index, without the scenes lost when a process died and broke the pool.
+    """
+    results = {}
+    pending = list(products)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        running = {}
+        while pending or running:
+            while pending and len(running) < workers:
+                available = available_memory() if memory is not None and running else None
+                if available is not None and available < memory:
+                    break
+                index, path = pending.pop(0)
+                running[executor.submit(_gen_s2_ang_scene, path, output_dir, kwargs)] = (index, path)
+            done, _ = wait(running, timeout=MEMORY_POLL, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, path = running.pop(future)
+                try:
+                    results[index] = future.result()
+                except BrokenProcessPool:
+                    # The scene may be an innocent victim of another one, it is run again
+                    pass
+                except Exception:
+                    results[index] = BatchResult(path=path, outputs=None, error=traceback.format_exc(), elapsed=None)
+            if any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+                break
+    return results
+
+
+def gen_s2_ang_batch(paths, output_dir=None, workers=None, max_memory=None, scene_memory=None, **kwargs):
+    """Generate Sentinel 2 angle bands for many products.
+
+    Each scene runs in a process of a pool, so a failing scene does not stop
+    the others. When a process dies (e.g. killed out of memory), breaking
+    the pool, the scenes it did not complete are run again, those interrupted
+    twice each in its own process, so only a crashing scene fails. The
+    number of processes is bounded by the memory budget divided by the peak
+    memory of a scene and, without budget, a scene only starts when the
+    available memory holds it.
+
+    Parameters:
+       paths (str or list): products (.SAFE, .zip or folders) or glob patterns.
+       output_dir (str) (optional): path to output folder.
+       workers (int) (optional): maximum number of processes. Defaults to the number of CPUs; 1 runs in this process.
+       max_memory (int) (optional): memory budget in bytes. Defaults to the available physical memory.
+       scene_memory (int) (optional): approximate peak memory of a scene in bytes. Defaults to an estimate from
+          kwargs, see estimate_scene_memory.
+       kwargs: further gen_s2_ang parameters (bands, output_profile, stack, bbox, bbox_crs, skip_existing).
+    Returns:
+       list of BatchResult: path, outputs, error and elapsed time of each scene, in input order.
+    """
+    products = expand_paths(paths)
+    if not products:
+        return []
+    if scene_memory is None:
+        scene_memory = estimate_scene_memory(**kwargs)
+    workers = batch_workers(len(products), workers, max_memory, scene_memory)
+    logger.info(f'Generating angles for {len(products)} scenes with {workers} processes')
+
+    if workers == 1:
+        results = [_gen_s2_ang_scene(path, output_dir, kwargs) for path in products]
+    else:
+        done = _run_pool(list(enumerate(products)), output_dir, kwargs, workers,
+                         scene_memory if max_memory is None else None)
+        lost = [(index, path) for index, path in enumerate(products) if index not in done]
+        if lost:
+            logger.warning(f'A worker process died, running the {len(lost)} scenes it interrupted again')
+            done.update(_run_pool(lost, output_dir, kwargs, min(workers, len(lost)),
+                                  scene_memory if max_memory is None else None))
+        # Scenes interrupted twice run in single process pools, so that a crashing scene only fails itself
+        for index, path in [(index, path) for index, path in lost if index not in done]:
+            done.update(_run_pool([(index, path)], output_dir, kwargs, 1))
+            if index not in done:
+                done[index] = BatchResult(path=path, outputs=None, elapsed=None,
+                                          error=f'BrokenProcessPool: the process of {path} died\n')
+        results = [done[index] for index in range(len(products))]
+
+    for result in results:
+        if result.error is not None:
+            logger.error(f'Failed {result.path}:\n{result.error}')
+    logger.info(f'{sum(result.error is None for result in results)} of {len(results)} scenes done')
+    return results
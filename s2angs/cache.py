@@ -0,0 +1,303 @@
+#
+# This file is part of Brazil Data Cube Sentinel-2 Angle Bands.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Persistent caches shared by the processing of many products."""
+
+# Python Native
+import hashlib
+import json
+import os
+import re
+import shutil
+import xml.etree.ElementTree as ET
+
+# 3rdparty
+import numpy
+
+from .version import __version__
+
+# Environment variable holding the cache directory, caches are disabled when unset
+CACHE_DIR_ENV = 'S2ANGS_CACHE_DIR'
+
+# Maximum number of fitted orbits kept per orbit key
+ORBIT_ENTRIES = 64
+
+# Maximum size of the cached outputs, the least recently used entries being removed beyond it
+OUTPUT_CACHE_BYTES = 8 * 2**30
+
+
+def cache_dir(directory=None):
+    """Obtain the directory of the persistent caches.
+
+    Parameters:
+       directory (str) (optional): cache directory. Defaults to the S2ANGS_CACHE_DIR environment variable.
+    Returns:
+       str or None: cache directory, None when caching is disabled.
+    """
+    if directory is not None:
+        return directory
+    return os.environ.get(CACHE_DIR_ENV) or None
+
+
+def _write_json(path, data):
+    """Write a JSON file atomically, concurrent writers leaving one of their versions."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def orbit_key(tile_id):
+    """Obtain the key of the orbit of a tile, shared by all the tiles of a datatake.
+
+    Parameters:
+       tile_id (str): TILE_ID of MTD_TL.xml, e.g. S2A_OPER_MSI_L1C_TL_2APS_20230527T145859_A032495_T23LLF_N05.09.
+    Returns:
+       str or None: spacecraft and absolute orbit number, e.g. S2A_A032495, None when tile_id has no orbit number.
+    """
+    match = re.match(r'(S2[A-D])_.*_A(\d{6})_', tile_id)
+    if match is None:
+        return None
+    return f'{match.group(1)}_A{match.group(2)}'
+
+
+def _orbit_path(directory, key):
+    return os.path.join(directory, 'orbits', key + '.json')
+
+
+def load_orbits(directory, key):
+    """Read the orbits fitted on the tiles of an orbit key.
+
+    Parameters:
+       directory (str): cache directory.
+       key (str): orbit key, see orbit_key.
+    Returns:
+       list: dicts with the tile ('tile'), its fitted orbit ('orbit') and LOS residual RMS ('los_rms').
+    """
+    try:
+        with open(_orbit_path(directory, key)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def nearest_orbit(directory, key, lat):
+    """Find the cached orbit of an orbit key fitted closest to a latitude.
+
+    Parameters:
+       directory (str): cache directory.
+       key (str): orbit key, see orbit_key.
+       lat (float): latitude in radians.
+    Returns:
+       list or None: orbit (reference Lat, reference Lon, Radius, Inclination and Period), None when none is cached.
+    """
+    entries = load_orbits(directory, key)
+    if not entries:
+        return None
+    return min(entries, key=lambda entry: abs(entry['orbit'][0] - lat))['orbit']
+
+
+def save_orbit(directory, key, tile_id, orbit, los_rms):
+    """Add the orbit fitted on a tile to the cache.
+
+    Parameters:
+       directory (str): cache directory.
+       key (str): orbit key, see orbit_key.
+       tile_id (str): TILE_ID of the tile.
+       orbit (list): fitted orbit (reference Lat, reference Lon, Radius, Inclination and Period).
+       los_rms (float): LOS residual RMS of the fit.
+    """
+    entries = [entry for entry in load_orbits(directory, key) if entry['tile'] != tile_id]
+    entries.append({'tile': tile_id, 'orbit': [float(parm) for parm in orbit[:5]], 'los_rms': float(los_rms)})
+    _write_json(_orbit_path(directory, key), entries[-ORBIT_ENTRIES:])
+
+
+def cached_array(directory, kind, key, compute):
+    """Obtain an array from the on-disk cache, computing and storing it when missing.
+
+    Stored arrays are memory-mapped (read-only) on load, so only the pages used are read.
+
+    Parameters:
+       directory (str): cache directory.
+       kind (str): kind of array, subdirectory of the cache.
+       key (tuple): parameters the array depends on.
+       compute (callable): function without arguments returning the array.
+    Returns:
+       arr: the cached or computed array.
+    """
+    path = os.path.join(directory, kind, hashlib.sha1(repr(key).encode()).hexdigest()[:20] + '.npy')
+    try:
+        return numpy.load(path, mmap_mode='r')
+    except (OSError, ValueError):
+        pass
+    array = compute()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        numpy.save(f, array)
+    os.replace(tmp_path, path)
+    return array
+
+
+def geometry_digest(mtd, footprints=()):
+    """Digest of the inputs the angle bands are computed from.
+
+    Only the Geometric_Info of MTD_TL.xml (tile geocoding, sun and view
+    angle grids) and the detector footprint contents are hashed, so the L1C
+    and L2A products of an acquisition, or reprocessings keeping its
+    geometry, share their digest.
+
+    Parameters:
+       mtd (str): path to MTD_TL.xml.
+       footprints (list) (optional): paths to the detector footprint files used.
+    Returns:
+       str: hexadecimal digest.
+    """
+    digest = hashlib.sha256()
+    root = ET.parse(mtd).getroot()
+    for element in root.iter():
+        if element.tag.rsplit('}', 1)[-1] == 'Geometric_Info':
+            for child in element:
+                digest.update(ET.canonicalize(ET.tostring(child), strip_text=True).encode())
+    for footprint in footprints:
+        with open(footprint, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def output_key(digest, **options):
+    """Key of the outputs computed from inputs of a given digest with given options.
+
+    Parameters:
+       digest (str): digest of the inputs, see geometry_digest.
+       options: options the outputs depend on (bands, output profile, etc.).
+    Returns:
+       str: hexadecimal key, also depending on the s2angs version.
+    """
+    return hashlib.sha256(repr((digest, __version__, sorted(options.items()))).encode()).hexdigest()
+
+
+def _copy(source, target):
+    """Copy source as target, which only appears once complete.
+
+    Outputs are copied rather than hard linked, so that editing an output in
+    place (e.g. adding overviews) does not alter the cached entry.
+    """
+    tmp_path = f'{target}.{os.getpid()}.tmp'
+    shutil.copy2(source, tmp_path)
+    os.replace(tmp_path, target)
+
+
+def restore_outputs(directory, key, targets):
+    """Copy the cached outputs of a key to their target paths.
+
+    Parameters:
+       directory (str): cache directory.
+       key (str): outputs key, see output_key.
+       targets (dict): target path of each output name.
+    Returns:
+       bool: whether all the outputs were cached and copied.
+    """
+    entry = os.path.join(directory, 'outputs', key)
+    if not all(os.path.exists(os.path.join(entry, name)) for name in targets):
+        return False
+    try:
+        for name, target in targets.items():
+            _copy(os.path.join(entry, name), target)
+        # The entry modification time orders the entries by last use
+        os.utime(entry)
+    except OSError:
+        # Removed meanwhile by another process
+        return False
+    return True
+
+
+def _entry_size(entry):
+    return sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+
+
+def evict_outputs(directory, max_bytes=OUTPUT_CACHE_BYTES, keep=None):
+    """Remove the least recently used cached outputs beyond a total size.
+
+    Parameters:
+       directory (str): cache directory.
+       max_bytes (int) (optional): size the cached outputs are reduced to.
+       keep (str) (optional): key of an entry which is never removed.
+    Returns:
+       list: keys of the removed entries.
+    """
+    outputs_dir = os.path.join(directory, 'outputs')
+    if not os.path.isdir(outputs_dir):
+        return []
+    entries = []
+    for key in os.listdir(outputs_dir):
+        entry = os.path.join(outputs_dir, key)
+        if key.endswith('.tmp'):
+            continue
+        try:
+            entries.append((os.stat(entry).st_mtime_ns, key, _entry_size(entry)))
+        except OSError:
+            continue
+    total = sum(size for (_, _, size) in entries)
+    removed = []
+    for (_, key, size) in sorted(entries):
+        if total <= max_bytes:
+            break
+        if key == keep:
+            continue
+        # Entries are renamed before their removal, so that an entry which exists is complete
+        entry = os.path.join(outputs_dir, key)
+        tmp_entry = f'{entry}.{os.getpid()}.tmp'
+        try:
+            os.rename(entry, tmp_entry)
+        except OSError:
+            continue
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        total -= size
+        removed.append(key)
+    return removed
+
+
+def store_outputs(directory, key, sources, max_bytes=OUTPUT_CACHE_BYTES):
+    """Add copies of outputs to the cache.
+
+    The least recently stored or restored entries are then removed while the
+    cached outputs exceed max_bytes.
+
+    Parameters:
+       directory (str): cache directory.
+       key (str): outputs key, see output_key.
+       sources (dict): path of each output name.
+       max_bytes (int) (optional): maximum size of the cached outputs.
+    """
+    entry = os.path.join(directory, 'outputs', key)
+    if os.path.exists(entry):
+        return
+    # The entry is filled aside and renamed, so that an entry which exists is complete
+    tmp_entry = f'{entry}.{os.getpid()}.tmp'
+    os.makedirs(tmp_entry, exist_ok=True)
+    for name, source in sources.items():
+        _copy(source, os.path.join(tmp_entry, name))
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError:
+        # Stored meanwhile by another process
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+    evict_outputs(directory, max_bytes, keep=key)
@@ -0,0 +1,99 @@
+#
+# This file is part of Brazil Data Cube Sentinel-2 Angle Bands.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Command line interface of s2angs."""
+
+import os
+
+import click
+
+from .batch import gen_s2_ang_batch
+from .cache import CACHE_DIR_ENV
+from .metadata import BAND_NAMES
+from .output import OUTPUT_PROFILES
+from .s2_angs import STACKS
+from .version import __version__
+
+
+def _read_list(list_file):
+    """Read the products of a list file, one per line, skipping blank lines and comments."""
+    lines = (line.strip() for line in list_file)
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def _split_bands(ctx, param, value):
+    """Split comma separated band names and check them."""
+    bands = [band.strip().upper() for item in value for band in item.split(',') if band.strip()]
+    unknown = [band for band in bands if band not in BAND_NAMES]
+    if unknown:
+        raise click.BadParameter(f"unknown bands {unknown}, expected any of {list(BAND_NAMES)}")
+    return bands or None
+
+
+@click.command(context_settings=dict(help_option_names=['-h', '--help']))
+@click.version_option(__version__)
+@click.argument('inputs', nargs=-1)
+@click.option('-l', '--list', 'list_file', type=click.File('r'),
+              help='File listing products (or glob patterns), one per line; - for stdin.')
+@click.option('-o', '--output-dir', type=click.Path(file_okay=False),
+              help='Output folder. Defaults to the ANG_DATA folder of each product (working directory for .zip).')
+@click.option('-w', '--workers', type=click.IntRange(min=1),
+              help='Maximum number of parallel processes. Defaults to the number of CPUs.')
+@click.option('--max-memory', type=click.IntRange(min=1),
+              help='Memory budget in MiB bounding the number of processes. Defaults to the available memory.')
+@click.option('-b', '--bands', multiple=True, callback=_split_bands,
+              help='Bands to generate view angles for, e.g. B02,B8A (repeatable). Defaults to B04.')
+@click.option('-p', '--output-profile', type=click.Choice(list(OUTPUT_PROFILES)), default='default', show_default=True,
+              help='Data type, layout and compression of the outputs.')
+@click.option('--stack', type=click.Choice(STACKS), help='Write one multi-band GeoTIFF (pixel or band interleaved) or a VRT.')
+@click.option('--bounds', type=float, nargs=4, metavar='LEFT BOTTOM RIGHT TOP',
+              help='Area to write, in the tile coordinate reference system or --bounds-crs. Defaults to the whole tile.')
+@click.option('--bounds-crs', metavar='CRS',
+              help='Coordinate reference system of --bounds, e.g. EPSG:4326 for longitudes and latitudes.')
+@click.option('--skip-existing', is_flag=True, help='Only compute the outputs missing, stale or corrupt according to the manifest of a previous run.')
+@click.option('--cache-dir', type=click.Path(file_okay=False),
+              help=f'Directory of the persistent caches (e.g. fitted orbits). Defaults to ${CACHE_DIR_ENV}.')
+def cli(inputs, list_file, output_dir, workers, max_memory, bands, output_profile, stack, bounds, bounds_crs, skip_existing,
+        cache_dir):
+    """Generate Sentinel-2 angle bands for INPUTS (.SAFE, .zip or folders, glob patterns allowed)."""
+    paths = list(inputs) + (_read_list(list_file) if list_file is not None else [])
+    if not paths:
+        raise click.UsageError('No input products, give INPUTS or --list.')
+    if cache_dir is not None:
+        # Inherited by the worker processes
+        os.environ[CACHE_DIR_ENV] = cache_dir
+
+    results = gen_s2_ang_batch(paths, output_dir, workers=workers,
+                               max_memory=max_memory * 2**20 if max_memory is not None else None,
+                               bands=bands, output_profile=output_profile, stack=stack, bbox=bounds or None,
+                               bbox_crs=bounds_crs, skip_existing=skip_existing)
+
+    failed = [result for result in results if result.error is not None]
+    for result in results:
+        if result.error is None:
+            click.echo(f'OK      {result.path} ({result.elapsed:.1f}s)')
+        else:
+            click.echo(f'FAILED  {result.path}: {result.error.strip().splitlines()[-1]}')
+            click.echo(f'Failed {result.path}:\n{result.error}', err=True)
+    click.echo(f'{len(results) - len(failed)} of {len(results)} products done, {len(failed)} failed.')
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,137 @@
+#
+# This file is part of Brazil Data Cube Sentinel-2 Angle Bands.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Manifests describing the angle bands written for a product, to resume interrupted runs."""
+
+# Python Native
+import hashlib
+import json
+import os
+
+from .version import __version__
+
+
+def file_checksum(path):
+    """Compute the SHA-256 checksum of a file.
+
+    Parameters:
+       path (str): file path.
+    Returns:
+       str: hexadecimal checksum.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _normalize(options):
+    """Options as stored in a manifest (JSON types)."""
+    return json.loads(json.dumps(options))
+
+
+def read_manifest(path):
+    """Read a manifest.
+
+    Parameters:
+       path (str): manifest file.
+    Returns:
+       dict or None: the manifest, None when missing or unreadable.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _output_entry(output, previous=None):
+    """Manifest entry of an output, keeping the checksum of previous when the file is unchanged."""
+    stat = os.stat(output)
+    entry = {'file': os.path.basename(output), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if previous and all(previous.get(key) == value for key, value in entry.items()) and 'sha256' in previous:
+        entry['sha256'] = previous['sha256']
+    else:
+        entry['sha256'] = file_checksum(output)
+    return entry
+
+
+def write_manifest(path, digest, options, outputs):
+    """Write the manifest of a set of outputs.
+
+    Only the outputs written since the previous manifest are hashed, the
+    others (same file, size and modification time) keep their checksum. The
+    manifest is rewritten as each output of a run is completed, outputs
+    which are not complete being left out.
+
+    Parameters:
+       path (str): manifest file.
+       digest (str): digest of the inputs, see cache.geometry_digest.
+       options (dict): options of the run (bands, output profile, etc.).
+       outputs (dict): path of each output name.
+    """
+    previous = (read_manifest(path) or {}).get('outputs', {})
+    manifest = {
+        'version': __version__,
+        'digest': digest,
+        'options': _normalize(options),
+        'outputs': {name: _output_entry(output, previous.get(name)) for name, output in outputs.items()},
+    }
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def outdated_outputs(path, digest, options, outputs, verify=False):
+    """Find the outputs of a run which are missing, stale or corrupt.
+
+    Every output is outdated when the manifest is missing or was written by
+    another version, from other inputs or with other options. Otherwise only
+    the outputs which are not recorded, missing or do not match their size and
+    checksum are. Outputs keeping the recorded size and modification time are
+    not hashed again, unless verify is set.
+
+    Parameters:
+       path (str): manifest file.
+       digest (str): digest of the inputs, see cache.geometry_digest.
+       options (dict): options of the run (bands, output profile, etc.).
+       outputs (dict): path of each output name.
+       verify (bool) (optional): hash every output, to find outputs altered without changing their modification time.
+    Returns:
+       set: names of the outputs to compute.
+    """
+    manifest = read_manifest(path)
+    if (manifest is None or manifest.get('version') != __version__ or manifest.get('digest') != digest
+            or manifest.get('options') != _normalize(options)):
+        return set(outputs)
+
+    outdated = set()
+    for name, output in outputs.items():
+        entry = manifest['outputs'].get(name)
+        try:
+            stat = os.stat(output)
+        except OSError:
+            outdated.add(name)
+            continue
+        if entry is None or entry['file'] != os.path.basename(output) or stat.st_size != entry['size']:
+            outdated.add(name)
+        elif (verify or stat.st_mtime_ns != entry['mtime_ns']) and file_checksum(output) != entry['sha256']:
+            outdated.add(name)
+    return outdated
@@ -0,0 +1,287 @@
+#
+# This file is part of Brazil Data Cube Sentinel-2 Angle Bands.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Sentinel-2 metadata (MTD_TL.xml and MTD_MSIL*.xml) parsing."""
+
+# Python Native
+import math
+import os
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+from functools import lru_cache
+from types import MappingProxyType
+
+# 3rdparty
+import numpy
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import Affine, array_bounds
+from rasterio.warp import transform_bounds
+
+# Sentinel-2 band names, indexed by bandId
+BAND_NAMES = ('B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B08', 'B8A', 'B09', 'B10', 'B11', 'B12')
+
+# Sentinel-2 band resolutions in meters, indexed by bandId
+BAND_RESOLUTIONS = (60, 10, 10, 10, 20, 20, 20, 10, 20, 60, 60, 20, 20)
+
+TileMetadata = namedtuple('TileMetadata', [
+    'path',           # path to MTD_TL.xml
+    'tile_id',        # TILE_ID
+    'sensing_time',   # SENSING_TIME
+    'zone',           # UTM zone number
+    'hemis',          # UTM hemisphere, 'N' or 'S'
+    'epsg',           # EPSG code of the tile CRS
+    'sizes',          # resolution -> (nrows, ncols)
+    'geopositions',   # resolution -> (ulx, uly)
+    'sun_step',       # (col_step, row_step) of the sun angle grid, in meters
+    'sun_zenith',     # sun zenith grid
+    'sun_azimuth',    # sun azimuth grid
+    'view_step',      # (col_step, row_step) of the view angle grids, in meters
+    'view_zenith',    # (bandId, detectorId) -> view zenith grid
+    'view_azimuth',   # (bandId, detectorId) -> view azimuth grid
+    'footprints',     # bandId -> path to the detector footprint file (MSK_DETFOO)
+])
+
+ReferenceGrid = namedtuple('ReferenceGrid', [
+    'width',          # number of columns
+    'height',         # number of rows
+    'transform',      # affine transform of the grid
+    'crs',            # coordinate reference system of the grid
+])
+
+ProductMetadata = namedtuple('ProductMetadata', [
+    'path',           # path to MTD_MSIL*.xml
+    'product_uri',    # PRODUCT_URI
+])
+
+
+def _localname(element):
+    """Return the tag of an element without its namespace."""
+    return element.tag.rsplit('}', 1)[-1]
+
+
+def _child(element, name):
+    """Return the first child of an element with the given tag, ignoring namespaces."""
+    for child in element:
+        if _localname(child) == name:
+            return child
+    return None
+
+
+def _values(grid):
+    """Convert the Values_List of an angle grid to a read-only array (NaN where missing)."""
+    rows = _child(grid, 'Values_List')
+    values = numpy.array(' '.join(row.text for row in rows).split(), dtype=numpy.float64)
+    values = values.reshape(len(rows), -1)
+    values.setflags(write=False)
+    return values
+
+
+def _steps(grid):
+    """Return the (col_step, row_step) of an angle grid."""
+    return (int(_child(grid, 'COL_STEP').text), int(_child(grid, 'ROW_STEP').text))
+
+
+@lru_cache(maxsize=32)
+def _read_tile_metadata(path, mtime):
+    """Parse MTD_TL.xml, memoized on the file path and modification time."""
+    root = ET.parse(path).getroot()
+    geninfo = _child(root, 'General_Info')
+    geoinfo = _child(root, 'Geometric_Info')
+    qualinfo = _child(root, 'Quality_Indicators_Info')
+
+    tile_id = _child(geninfo, 'TILE_ID').text.strip()
+    sensing_time = _child(geninfo, 'SENSING_TIME')
+    sensing_time = sensing_time.text.strip() if sensing_time is not None else None
+
+    frame = _child(geoinfo, 'Tile_Geocoding')
+    czone = _child(frame, 'HORIZONTAL_CS_NAME').text.strip()[-3:]
+    epsg = int(_child(frame, 'HORIZONTAL_CS_CODE').text.strip().split(':')[-1])
+    sizes = {}
+    geopositions = {}
+    for box in frame:
+        if _localname(box) == 'Size':
+            sizes[int(box.attrib['resolution'])] = (int(_child(box, 'NROWS').text), int(_child(box, 'NCOLS').text))
+        elif _localname(box) == 'Geoposition':
+            geopositions[int(box.attrib['resolution'])] = (float(_child(box, 'ULX').text), float(_child(box, 'ULY').text))
+
+    sun_step = view_step = None
+    sun_zenith = sun_azimuth = None
+    view_zenith = {}
+    view_azimuth = {}
+    for angle in _child(geoinfo, 'Tile_Angles'):
+        if _localname(angle) == 'Sun_Angles_Grid':
+            sun_step = _steps(_child(angle, 'Zenith'))
+            sun_zenith = _values(_child(angle, 'Zenith'))
+            sun_azimuth = _values(_child(angle, 'Azimuth'))
+        elif _localname(angle) == 'Viewing_Incidence_Angles_Grids':
+            key = (int(angle.attrib['bandId']), int(angle.attrib['detectorId']))
+            view_step = _steps(_child(angle, 'Zenith'))
+            view_zenith[key] = _values(_child(angle, 'Zenith'))
+            view_azimuth[key] = _values(_child(angle, 'Azimuth'))
+
+    footprints = {}
+    pixlevel = _child(qualinfo, 'Pixel_Level_QI') if qualinfo is not None else None
+    for qifile in (pixlevel if pixlevel is not None else []):
+        if _localname(qifile) == 'MASK_FILENAME' and qifile.attrib.get('type') == 'MSK_DETFOO':
+            footprints[int(qifile.attrib['bandId'])] = os.path.join(os.path.dirname(path), 'QI_DATA',
+                                                                    os.path.basename(qifile.text.strip()))
+
+    return TileMetadata(path=path, tile_id=tile_id, sensing_time=sensing_time,
+                        zone=int(czone[:-1]), hemis=czone[-1:], epsg=epsg,
+                        sizes=MappingProxyType(sizes), geopositions=MappingProxyType(geopositions),
+                        sun_step=sun_step, sun_zenith=sun_zenith, sun_azimuth=sun_azimuth,
+                        view_step=view_step, view_zenith=MappingProxyType(view_zenith),
+                        view_azimuth=MappingProxyType(view_azimuth), footprints=MappingProxyType(footprints))
+
+
+def read_tile_metadata(xml):
+    """Read the tile metadata of a Sentinel-2 granule.
+
+    The file is parsed once and the result is memoized per path, so repeated
+    calls for the same MTD_TL.xml return the same object.
+
+    Parameters:
+       xml (str): path to MTD_TL.xml.
+    Returns:
+       TileMetadata: immutable tile metadata, angle grids as read-only arrays.
+    """
+    path = os.path.abspath(xml)
+    return _read_tile_metadata(path, os.stat(path).st_mtime_ns)
+
+
+@lru_cache(maxsize=32)
+def _read_product_metadata(path, mtime):
+    """Parse MTD_MSIL*.xml, memoized on the file path and modification time."""
+    root = ET.parse(path).getroot()
+    prodinfo = _child(_child(root, 'General_Info'), 'Product_Info')
+    return ProductMetadata(path=path, product_uri=_child(prodinfo, 'PRODUCT_URI').text.strip())
+
+
+def read_product_metadata(mtdmsi):
+    """Read the product metadata of a Sentinel-2 product.
+
+    Parameters:
+       mtdmsi (str): path to MTD_MSIL*.xml.
+    Returns:
+       ProductMetadata: immutable product metadata.
+    """
+    path = os.path.abspath(mtdmsi)
+    return _read_product_metadata(path, os.stat(path).st_mtime_ns)
+
+
+def reference_grid(mtd=None, imgref=None, resolution=10):
+    """Obtain the pixel grid of a Sentinel-2 tile at a given resolution.
+
+    The grid is built from the Tile_Geocoding of MTD_TL.xml, so no image is
+    opened. When the metadata does not describe the resolution, only the
+    header of the reference image is read.
+
+    Parameters:
+       mtd (str) (optional): path to MTD_TL.xml.
+       imgref (str) (optional): path or GDAL dataset name of a reference image on the grid.
+       resolution (int): grid resolution in meters.
+    Returns:
+       ReferenceGrid: width, height, transform and crs of the grid.
+    """
+    if mtd is not None:
+        tile = read_tile_metadata(mtd)
+        if resolution in tile.sizes and resolution in tile.geopositions:
+            nrows, ncols = tile.sizes[resolution]
+            ulx, uly = tile.geopositions[resolution]
+            return ReferenceGrid(width=ncols, height=nrows, transform=Affine(resolution, 0, ulx, 0, -resolution, uly),
+                                 crs=CRS.from_epsg(tile.epsg))
+    if imgref is None:
+        raise ValueError(f"No {resolution}m grid in {mtd} and no reference image given")
+    with rasterio.open(imgref) as src:
+        return ReferenceGrid(width=src.width, height=src.height, transform=src.transform, crs=src.crs)
+
+
+def scale_grid(grid, resolution):
+    """Express a reference grid at another resolution, over the same extent.
+
+    Parameters:
+       grid (ReferenceGrid): reference grid.
+       resolution (int): new resolution in meters.
+    Returns:
+       ReferenceGrid: grid with the same origin and crs at the new resolution.
+    """
+    factor = resolution / grid.transform.a
+    if factor == 1:
+        return grid
+    return ReferenceGrid(width=int(math.ceil(round(grid.width / factor, 6))),
+                         height=int(math.ceil(round(grid.height / factor, 6))),
+                         transform=grid.transform * Affine.scale(factor), crs=grid.crs)
+
+
+def angle_grid_transform(grid, step=5000):
+    """Obtain the transform of the angle grids of MTD_TL.xml.
+
+    The sun and view angle grids are sampled at the nodes ULX + i * step,
+    ULY - j * step of the tile, so the angle of node i is the value of the
+    step meters cell centred on it.
+
+    Parameters:
+       grid (ReferenceGrid): reference grid of the tile.
+       step (int): spacing of the angle grid nodes in meters.
+    Returns:
+       Affine: transform of the angle grid cells.
+    """
+    return Affine(step, 0, grid.transform.c - step / 2, 0, -step, grid.transform.f + step / 2)
+
+
+def grid_bounds(grid):
+    """Obtain the bounds of a reference grid.
+
+    Parameters:
+       grid (ReferenceGrid): reference grid.
+    Returns:
+       tuple: left, bottom, right and top in the grid crs.
+    """
+    return array_bounds(grid.height, grid.width, grid.transform)
+
+
+def crop_grid(grid, bounds, align=60, crs=None):
+    """Restrict a reference grid to the pixels intersecting a bounding box.
+
+    The crop is widened to multiples of align meters from the grid origin,
+    so that it can be expressed exactly at every band resolution. Bounds in
+    another crs (e.g. EPSG:4326 longitudes and latitudes) are replaced by
+    the bounding box of their projection on the grid crs.
+
+    Parameters:
+       grid (ReferenceGrid): reference grid.
+       bounds (tuple): left, bottom, right and top.
+       align (int): alignment of the crop in meters.
+       crs (str or CRS) (optional): crs of bounds. Defaults to the grid crs.
+    Returns:
+       ReferenceGrid: grid over the intersection of grid and bounds.
+    """
+    if crs is not None and CRS.from_user_input(crs) != grid.crs:
+        bounds = transform_bounds(crs, grid.crs, *bounds, densify_pts=21)
+    left, bottom, right, top = bounds
+    step = align / grid.transform.a
+    col_off = max(0, int(math.floor((left - grid.transform.c) / align)) * step)
+    col_end = min(grid.width, int(math.ceil((right - grid.transform.c) / align)) * step)
+    row_off = max(0, int(math.floor((grid.transform.f - top) / align)) * step)
+    row_end = min(grid.height, int(math.ceil((grid.transform.f - bottom) / align)) * step)
+    if col_end <= col_off or row_end <= row_off:
+        raise ValueError(f"Bounds {bounds} do not intersect the grid")
+    col_off, row_off = int(round(col_off)), int(round(row_off))
+    return ReferenceGrid(width=int(round(col_end)) - col_off, height=int(round(row_end)) - row_off,
+                         transform=grid.transform * Affine.translation(col_off, row_off), crs=grid.crs)
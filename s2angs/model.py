@@ -0,0 +1,334 @@
+#
+# This file is part of Brazil Data Cube Sentinel-2 Angle Bands.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Compact angle models of Sentinel-2 tiles, evaluated on demand."""
+
+# Python Native
+import json
+import os
+from collections import namedtuple
+
+# 3rdparty
+import numpy
+from rasterio.crs import CRS
+from rasterio.transform import Affine
+from rasterio.warp import transform as warp_transform
+from rasterio.windows import Window
+from rasterio.windows import transform as window_transform
+
+from .metadata import (BAND_NAMES, BAND_RESOLUTIONS, ReferenceGrid, angle_grid_transform, grid_bounds, reference_grid,
+                       scale_grid)
+from .s2_angs import (AngleLayer, S2Angles, angle_block, angleband_paths, band_indexes, extract_sun_angles,
+                      product_files)
+from .s2_sensor_angs.s2_sensor_angs import (SampleGroundVectors, detector_grids, fit_view_model, get_angleobs,
+                                            view_angle_grid, view_angle_samples)
+from .upsample import axis_points, interpolate_points
+from .version import __version__
+
+# Version of the layout of saved models, models of other versions are rejected
+MODEL_VERSION = 2
+
+# Subsampling of the view angle grids (samples every 10 pixels of each band), as in sensor_angle_grids
+SUBSAMP = 10
+
+PointAngles = namedtuple('PointAngles', [
+    'sza',            # solar zenith of each point, in degrees
+    'saa',            # solar azimuth of each point, in degrees
+    'vza',            # view zenith of each point, in degrees; with bands, a dict mapping band names to arrays
+    'vaa',            # view azimuth of each point, in degrees; with bands, a dict mapping band names to arrays
+    'detectors',      # uint16 bit mask of the detectors averaged at each point (bit d for detector d); with bands, a dict
+])
+
+
+class AngleModel:
+    """Sun and view angle model of a Sentinel-2 tile.
+
+    The model holds the sun angle grid of MTD_TL.xml, the orbit and detector
+    observation time models fitted on its view angles, and the detector
+    footprints of each band on its view angle grid. These take a few hundred
+    KB, from which the angles are computed on any window or at any point of
+    the tile as gen_s2_ang computes them.
+    """
+
+    def __init__(self, header, sun_zenith, sun_azimuth, time_models, detectors):
+        """Create a model, see from_product and load.
+
+        Parameters:
+           header (dict): tile geometry ('crs', 'transform', 'width', 'height' of the 10m grid, 'angle_obs'),
+              'orbit' and identification ('tile_id', 'product') of the model.
+           sun_zenith (arr): sun zenith grid sampled every 5000m from the tile corner, in degrees.
+           sun_azimuth (arr): sun azimuth grid on the same nodes, in degrees.
+           time_models (arr): (13, detectors, 4) observation time model coefficients of each band and detector.
+           detectors (dict): bandId -> detector bit mask of the view angle grid of the band.
+        """
+        self.header = header
+        self.sun_zenith = sun_zenith
+        self.sun_azimuth = sun_azimuth
+        self.time_models = time_models
+        self.detectors = detectors
+
+    @classmethod
+    def from_product(cls, path, bands=None):
+        """Fit the angle model of a product.
+
+        Parameters:
+           path (str): path to zipfile or .SAFE.
+           bands (list) (optional): band names (e.g. ['B02', 'B8A']) whose detector footprints are kept, the view
+              angles of the other bands can not be evaluated. Defaults to B04 only.
+        Returns:
+           AngleModel: the model.
+        """
+        band_ids = [3] if bands is None else band_indexes(bands)
+        with product_files(path) as files:
+            if files.view_angles != 'model':
+                raise ValueError(f"Angle models need the detector footprints of a .SAFE or .zip product, not {path}")
+            tile_grid = reference_grid(files.mtd, files.imgref)
+            tile_id, angle_obs = get_angleobs(files.mtd)
+            orbit, time_parms = fit_view_model(tile_id, angle_obs)
+            detectors = detector_grids(files.mtd, angle_obs, band_ids, BAND_RESOLUTIONS, SUBSAMP)
+            sun_zenith, sun_azimuth = extract_sun_angles(files.mtd)
+
+        product = os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+        header = dict(version=MODEL_VERSION, s2angs=__version__, product=product, tile_id=tile_id,
+                      crs=tile_grid.crs.to_string(), transform=list(tile_grid.transform)[:6],
+                      width=tile_grid.width, height=tile_grid.height,
+                      angle_obs={key: value.item() if hasattr(value, 'item') else value
+                                 for key, value in angle_obs.items() if key != 'obs'},
+                      orbit=[float(parm) for parm in orbit])
+        time_models = numpy.stack([tparms['tmodel'] for tparms in time_parms])
+        detectors = {bandId: mask.astype(numpy.uint16) for bandId, mask in detectors.items()}
+        return cls(header, sun_zenith, sun_azimuth, time_models, detectors)
+
+    def save(self, path):
+        """Write the model as a compressed NumPy archive (.npz).
+
+        Parameters:
+           path (str): output file.
+        """
+        arrays = {'detectors_' + BAND_NAMES[bandId]: mask for bandId, mask in self.detectors.items()}
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            numpy.savez_compressed(f, header=numpy.array(json.dumps(self.header)), sun_zenith=self.sun_zenith,
+                                   sun_azimuth=self.sun_azimuth, time_models=self.time_models, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Read a model written by save.
+
+        Parameters:
+           path (str): model file.
+        Returns:
+           AngleModel: the model.
+        """
+        with numpy.load(path) as data:
+            header = json.loads(str(data['header']))
+            if header.get('version') != MODEL_VERSION:
+                raise ValueError(f"Unsupported angle model version {header.get('version')} in {path}, "
+                                 f"expected {MODEL_VERSION}")
+            detectors = {BAND_NAMES.index(name[len('detectors_'):]): data[name]
+                         for name in data.files if name.startswith('detectors_')}
+            return cls(header, data['sun_zenith'], data['sun_azimuth'], data['time_models'], detectors)
+
+    @property
+    def bands(self):
+        """Names of the bands whose view angles can be evaluated."""
+        return [BAND_NAMES[bandId] for bandId in sorted(self.detectors)]
+
+    def grid(self, resolution=10):
+        """Pixel grid of the tile.
+
+        Parameters:
+           resolution (int): grid resolution in meters.
+        Returns:
+           ReferenceGrid: width, height, transform and crs of the grid.
+        """
+        tile_grid = ReferenceGrid(width=self.header['width'], height=self.header['height'],
+                                  transform=Affine(*self.header['transform']), crs=CRS.from_user_input(self.header['crs']))
+        return scale_grid(tile_grid, resolution)
+
+    def _band_ids(self, bands):
+        band_ids = [3] if bands is None else band_indexes(bands)
+        missing = [BAND_NAMES[bandId] for bandId in band_ids if bandId not in self.detectors]
+        if missing:
+            raise ValueError(f"No detector footprints of {missing} in the model, expected any of {self.bands}")
+        return band_ids
+
+    def _sun_transform(self):
+        return angle_grid_transform(self.grid())
+
+    def _view_transform(self, bandId):
+        gsd = BAND_RESOLUTIONS[bandId]
+        step = gsd * SUBSAMP
+        angle_obs = self.header['angle_obs']
+        return Affine(step, 0, angle_obs['ul_x'] + gsd / 2 - step / 2, 0, -step, angle_obs['ul_y'] - gsd / 2 + step / 2)
+
+    def layers(self, grid, bands=None):
+        """Coarse angle grids over an area, to be upsampled to its grid.
+
+        Parameters:
+           grid (ReferenceGrid): grid of the area, on the pixels of the tile.
+           bands (list) (optional): band names of the view angles. Defaults to B04 only.
+        Returns:
+           list of AngleLayer: sun zenith and azimuth then view zenith and azimuth of each band, see angle_layers.
+        """
+        sun_transform = self._sun_transform()
+        layers = [AngleLayer('SZA', self.sun_zenith, sun_transform, 100, False, grid, None),
+                  AngleLayer('SAA', self.sun_azimuth, sun_transform, 100, True, grid, None)]
+
+        # View angles are only computed on the samples surrounding the area
+        bounds = None if grid == self.grid() else grid_bounds(grid)
+        for bandId in self._band_ids(bands):
+            zenith, azimuth, band_aff = view_angle_grid(self.header['angle_obs'], self.header['orbit'],
+                                                        self.time_models[bandId], self.detectors[bandId],
+                                                        BAND_RESOLUTIONS[bandId], SUBSAMP, bounds)
+            band_grid = scale_grid(grid, BAND_RESOLUTIONS[bandId])
+            suffix = '' if bands is None else '_' + BAND_NAMES[bandId]
+            layers.append(AngleLayer('VZA' + suffix, zenith, band_aff, 1, False, band_grid, None))
+            layers.append(AngleLayer('VAA' + suffix, azimuth, band_aff, 1, True, band_grid, None))
+        return layers
+
+    def evaluate(self, window=None, resolution=10, bands=None):
+        """Compute the angles over a window of the tile.
+
+        Parameters:
+           window (Window) (optional): window of the tile grid at resolution, i.e. of the band images.
+              Defaults to the whole tile.
+           resolution (int): resolution of the arrays in meters (10, 20 or 60).
+           bands (list) (optional): band names of the view angles. Defaults to B04 only.
+        Returns:
+           S2Angles: float32 sza, saa, vza and vaa arrays in degrees (NaN where missing), their transform and crs,
+              as computed by compute_s2_angles. With bands, vza and vaa map each band name to its array.
+        """
+        tile_grid = self.grid(resolution)
+        if window is None:
+            window = Window(0, 0, tile_grid.width, tile_grid.height)
+        grid = ReferenceGrid(width=int(window.width), height=int(window.height),
+                             transform=window_transform(window, tile_grid.transform), crs=tile_grid.crs)
+        layers = self.layers(grid, bands)
+        blocks = [angle_block(layer, tile_grid.transform, window) for layer in layers]
+        sza, saa, vza, vaa = angleband_paths([layer.description for layer in layers], blocks, bands)
+        return S2Angles(sza=sza, saa=saa, vza=vza, vaa=vaa, transform=grid.transform, crs=grid.crs)
+
+    def evaluate_points(self, xs, ys, bands=None):
+        """Compute the angles at points of the tile.
+
+        Only the view angle samples surrounding the points are computed, the
+        angles being interpolated as for the pixels centred on the points.
+
+        Parameters:
+           xs (arr): x coordinates of the points, in the tile crs.
+           ys (arr): y coordinates of the points, in the tile crs.
+           bands (list) (optional): band names of the view angles. Defaults to B04 only.
+        Returns:
+           PointAngles: sza, saa, vza and vaa of each point in degrees, NaN out of the tile or of all detector
+              footprints, and the bit mask of the detectors whose view angles were interpolated (0 where none).
+              With bands, vza, vaa and detectors map each band name to its array.
+        """
+        xs, ys = numpy.broadcast_arrays(numpy.asarray(xs, dtype=numpy.float64), numpy.asarray(ys, dtype=numpy.float64))
+        left, bottom, right, top = grid_bounds(self.grid())
+        outside = (xs < left) | (xs > right) | (ys < bottom) | (ys > top)
+
+        angles = [interpolate_points(self.sun_zenith, self._sun_transform(), xs, ys),
+                  interpolate_points(self.sun_azimuth, self._sun_transform(), xs, ys)]
+        descriptions = ['SZA', 'SAA']
+        detectors = []
+        for bandId in self._band_ids(bands):
+            gsd = BAND_RESOLUTIONS[bandId]
+            mask = self.detectors[bandId]
+            band_aff = self._view_transform(bandId)
+
+            # Samples surrounding the points
+            rows, row_frac = axis_points(band_aff.f + band_aff.e / 2, band_aff.e, mask.shape[0], ys)
+            cols, col_frac = axis_points(band_aff.c + band_aff.a / 2, band_aff.a, mask.shape[1], xs)
+            next_rows = numpy.minimum(rows + 1, mask.shape[0] - 1)
+            next_cols = numpy.minimum(cols + 1, mask.shape[1] - 1)
+            samples = numpy.unique(numpy.concatenate([(r * mask.shape[1] + c).ravel()
+                                                      for r in (rows, next_rows) for c in (cols, next_cols)]))
+            sample_rows, sample_cols = numpy.divmod(samples, mask.shape[1])
+
+            Gx = SampleGroundVectors(self.header['angle_obs'], gsd, SUBSAMP, sample_rows, sample_cols)
+            zenith = numpy.full(mask.shape, numpy.nan)
+            azimuth = numpy.full(mask.shape, numpy.nan)
+            zenith[sample_rows, sample_cols], azimuth[sample_rows, sample_cols] = view_angle_samples(
+                self.header['orbit'], self.time_models[bandId], mask, gsd, SUBSAMP, sample_rows, sample_cols, Gx)
+
+            suffix = '' if bands is None else '_' + BAND_NAMES[bandId]
+            angles += [interpolate_points(zenith, band_aff, xs, ys) / 100,
+                       interpolate_points(azimuth, band_aff, xs, ys) / 100]
+            descriptions += ['VZA' + suffix, 'VAA' + suffix]
+
+            # Detectors of the samples weighting in the interpolation
+            used = numpy.zeros(xs.shape, dtype=numpy.uint16)
+            for row_index, row_weight in ((rows, 1 - row_frac), (next_rows, row_frac)):
+                for col_index, col_weight in ((cols, 1 - col_frac), (next_cols, col_frac)):
+                    weighted = (row_weight * col_weight > 0) & ~numpy.isnan(zenith[row_index, col_index])
+                    used |= numpy.where(weighted, mask[row_index, col_index], 0).astype(numpy.uint16)
+            detectors.append(numpy.where(outside, 0, used).astype(numpy.uint16))
+
+        angles = [numpy.where(outside, numpy.nan, values) for values in angles]
+        sza, saa, vza, vaa = angleband_paths(descriptions, angles, bands)
+        if bands is None:
+            detectors = detectors[0]
+        else:
+            detectors = {description.split('_')[-1]: used for description, used in zip(descriptions[2::2], detectors)}
+        return PointAngles(sza=sza, saa=saa, vza=vza, vaa=vaa, detectors=detectors)
+
+
+def detector_ids(detectors):
+    """List the detectors of a bit mask returned by angles_at.
+
+    Parameters:
+       detectors (int): bit mask, bit d being set for detector d.
+    Returns:
+       list: detector numbers (1 to 12).
+    """
+    return [detId for detId in range(1, 16) if int(detectors) >> detId & 1]
+
+
+def angles_at(product, xs, ys, crs=None, bands=None):
+    """Compute Sentinel 2 angles at points, without computing the angle bands.
+
+    A fitted model only interpolates the sun grid and computes the view
+    angles of the samples surrounding the points, so thousands of points take
+    milliseconds. Pass a saved model (.npz) or an AngleModel to skip the fit.
+
+    Parameters:
+       product (str or AngleModel): path to zipfile or .SAFE, saved angle model (.npz) or angle model.
+       xs (arr): x coordinates (or longitudes) of the points.
+       ys (arr): y coordinates (or latitudes) of the points.
+       crs (str) (optional): crs of the points, e.g. 'EPSG:4326' for longitudes and latitudes. Defaults to the tile crs.
+       bands (list) (optional): band names (e.g. ['B02', 'B8A']) to compute view angles for. Defaults to B04 only.
+    Returns:
+       PointAngles: sza, saa, vza and vaa of each point in degrees (NaN out of the tile or of all detector footprints)
+          and the bit mask of the detectors used (see detector_ids). With bands, vza, vaa and detectors map each band
+          name to its array.
+    """
+    if isinstance(product, AngleModel):
+        model = product
+    elif str(product).endswith('.npz'):
+        model = AngleModel.load(product)
+    else:
+        model = AngleModel.from_product(product, bands)
+
+    xs, ys = numpy.broadcast_arrays(numpy.asarray(xs, dtype=numpy.float64), numpy.asarray(ys, dtype=numpy.float64))
+    tile_crs = model.grid().crs
+    if crs is not None and CRS.from_user_input(crs) != tile_crs:
+        tile_xs, tile_ys = warp_transform(CRS.from_user_input(crs), tile_crs, xs.ravel(), ys.ravel())
+        xs, ys = numpy.reshape(tile_xs, xs.shape), numpy.reshape(tile_ys, ys.shape)
+    return model.evaluate_points(xs, ys, bands)
@@ -0,0 +1,233 @@
+#
+# This file is part of Brazil Data Cube Sentinel-2 Angle Bands.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Output profiles (data type, layout and compression) of the angle bands."""
+
+# Python Native
+import os
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+
+# 3rdparty
+import numpy
+import rasterio
+import rasterio.shutil
+from rasterio.env import GDALVersion
+
+from .upsample import row_windows
+
+OutputProfile = namedtuple('OutputProfile', [
+    'dtype',          # 'int32', 'int16' or 'uint16'
+    'compress',       # GDAL codec, e.g. 'deflate', 'zstd', 'lerc_zstd'
+    'predictor',      # GDAL predictor, 2 for horizontal differencing, or None
+    'max_z_error',    # maximum LERC error in hundredths of a degree, or None
+    'cog',            # write a Cloud Optimized GeoTIFF with internal overviews
+    'blocksize',      # tile size in pixels, or None for strips
+])
+
+# Named output profiles. Angles are stored in hundredths of a degree:
+#  - 'default': int32 strips, nodata -9999, values truncated (the historical layout);
+#  - 'int16': azimuth wrapped to [-180, 180), nodata -32768, scale 0.01;
+#  - 'uint16': azimuth in [0, 360), nodata 65535, scale 0.01;
+#  - 'cog': 'int16' as a tiled COG with internal overviews;
+#  - 'cog-lerc': 'cog' compressed with LERC, at most 0.01 degree off.
+OUTPUT_PROFILES = {
+    'default': OutputProfile(dtype='int32', compress='deflate', predictor=None, max_z_error=None, cog=False, blocksize=None),
+    'int16': OutputProfile(dtype='int16', compress='zstd', predictor=2, max_z_error=None, cog=False, blocksize=512),
+    'uint16': OutputProfile(dtype='uint16', compress='zstd', predictor=2, max_z_error=None, cog=False, blocksize=512),
+    'cog': OutputProfile(dtype='int16', compress='zstd', predictor=2, max_z_error=None, cog=True, blocksize=512),
+    'cog-lerc': OutputProfile(dtype='int16', compress='lerc_zstd', predictor=None, max_z_error=1, cog=True, blocksize=512),
+}
+
+NODATA = {'int32': -9999, 'int16': -32768, 'uint16': 65535}
+
+GDAL_DTYPES = {'int32': 'Int32', 'int16': 'Int16', 'uint16': 'UInt16'}
+
+# PREDICTOR creation option of the COG driver for each TIFF predictor
+COG_PREDICTORS = {1: 'NO', 2: 'YES', 3: 'FLOATING_POINT'}
+
+# Scale from stored values to degrees, written to the band metadata of the 16 bits profiles
+SCALE = 0.01
+
+
+def get_output_profile(output_profile=None):
+    """Obtain an output profile.
+
+    Parameters:
+       output_profile (str or OutputProfile) (optional): name in OUTPUT_PROFILES or profile. Defaults to 'default'.
+    Returns:
+       OutputProfile: the output profile.
+    """
+    if output_profile is None:
+        output_profile = 'default'
+    if isinstance(output_profile, OutputProfile):
+        return output_profile
+    if output_profile not in OUTPUT_PROFILES:
+        raise ValueError(f"Unknown output profile {output_profile}, expected any of {list(OUTPUT_PROFILES)}")
+    return OUTPUT_PROFILES[output_profile]
+
+
+def encode_angles(values, output_profile, azimuth=False):
+    """Convert angles in hundredths of a degree to the data type of an output profile.
+
+    Parameters:
+       values (arr): angles in hundredths of a degree, NaN where missing.
+       output_profile (OutputProfile): output profile.
+       azimuth (bool): whether values are azimuths, wrapped to the range of the data type.
+    Returns:
+       arr: stored values.
+    """
+    nodata = NODATA[output_profile.dtype]
+    missing = numpy.isnan(values)
+    if output_profile.dtype == 'int32':
+        values = numpy.where(missing, nodata, values)
+        return values.astype(numpy.intc)
+    values = numpy.rint(values)
+    if azimuth and output_profile.dtype == 'int16':
+        values = numpy.mod(values + 18000, 36000) - 18000
+    elif azimuth:
+        values = numpy.mod(values, 36000)
+    values[missing] = nodata
+    return values.astype(output_profile.dtype)
+
+
+def creation_options(output_profile, driver='GTiff'):
+    """GDAL creation options of the compression of an output profile, for the GTiff or COG driver."""
+    options = dict(compress=output_profile.compress, num_threads='ALL_CPUS')
+    if output_profile.predictor is not None:
+        # The COG driver takes YES (horizontal differencing) or FLOATING_POINT instead of the TIFF predictor codes
+        options['predictor'] = output_profile.predictor if driver == 'GTiff' else COG_PREDICTORS[output_profile.predictor]
+    if output_profile.max_z_error is not None:
+        options['max_z_error'] = output_profile.max_z_error
+    return options
+
+
+def write_angles(path, grid, compute, output_profile=None, azimuth=False):
+    """Write an angle band computed window by window.
+
+    Parameters:
+       path (str): output file.
+       grid (ReferenceGrid): output grid.
+       compute (callable): function of a Window returning its angles in hundredths of a degree (NaN where missing).
+       output_profile (str or OutputProfile) (optional): output profile, see OUTPUT_PROFILES.
+       azimuth (bool): whether the band holds azimuths.
+    Returns:
+       str: path to the written file.
+    """
+    return write_angle_stack(path, grid, [(None, compute, azimuth)], output_profile)
+
+
+def write_angle_stack(path, grid, layers, output_profile=None, interleave='pixel'):
+    """Write angle bands computed window by window to a single (multi-band) GeoTIFF.
+
+    Parameters:
+       path (str): output file.
+       grid (ReferenceGrid): output grid.
+       layers (list): (description, compute, azimuth) of each band, compute being a function of a Window returning
+          its angles in hundredths of a degree (NaN where missing) and azimuth whether the band holds azimuths.
+       output_profile (str or OutputProfile) (optional): output profile, see OUTPUT_PROFILES.
+       interleave (str): 'pixel' or 'band' interleaving of multi-band files.
+    Returns:
+       str: path to the written file.
+    """
+    output_profile = get_output_profile(output_profile)
+
+    profile = dict(driver='GTiff', height=grid.height, width=grid.width, count=len(layers), dtype=output_profile.dtype,
+                   crs=grid.crs, transform=grid.transform, nodata=NODATA[output_profile.dtype])
+    if len(layers) > 1:
+        profile.update(interleave=interleave)
+    if output_profile.blocksize is not None:
+        profile.update(tiled=True, blockxsize=output_profile.blocksize, blockysize=output_profile.blocksize)
+
+    # Files are written under a temporary name and renamed when complete, so that an output which exists is whole.
+    # The COG driver only creates copies, so the bands are first streamed to a fast compressed GeoTIFF.
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    out_path = tmp_path + '.tif' if output_profile.cog else tmp_path
+    if output_profile.cog:
+        profile.update(compress='zstd', zstd_level=1, num_threads='ALL_CPUS')
+    else:
+        profile.update(creation_options(output_profile))
+
+    try:
+        with rasterio.open(out_path, 'w', **profile) as dataset:
+            if output_profile.dtype != 'int32':
+                dataset.scales = (SCALE,) * len(layers)
+                dataset.offsets = (0.0,) * len(layers)
+            for index, (description, _, _) in enumerate(layers, start=1):
+                if description is not None:
+                    dataset.set_band_description(index, description)
+            for window in row_windows(dataset):
+                for index, (_, compute, azimuth) in enumerate(layers, start=1):
+                    dataset.write(encode_angles(compute(window), output_profile, azimuth), index, window=window)
+
+        if output_profile.cog:
+            options = creation_options(output_profile, driver='COG')
+            # Earlier COG drivers always interleave pixels
+            if len(layers) > 1 and GDALVersion.runtime().at_least('3.11'):
+                options['interleave'] = interleave
+            # Azimuths wrap around, so their overviews are not averaged
+            azimuth = any(azimuth for (_, _, azimuth) in layers)
+            rasterio.shutil.copy(out_path, tmp_path, driver='COG', blocksize=output_profile.blocksize, overviews='AUTO',
+                                 overview_resampling='nearest' if azimuth else 'average', **options)
+        os.replace(tmp_path, path)
+    finally:
+        for leftover in {out_path, tmp_path}:
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    return path
+
+
+def build_vrt(path, grid, sources):
+    """Write a VRT stacking single band angle files.
+
+    Sources on a coarser grid than grid (e.g. 20m bands on a 10m grid) are
+    resampled on the fly by GDAL (nearest neighbour).
+
+    Parameters:
+       path (str): output VRT file.
+       grid (ReferenceGrid): grid of the VRT.
+       sources (list): (description, file) of each band.
+    Returns:
+       str: path to the written file.
+    """
+    vrt = ET.Element('VRTDataset', rasterXSize=str(grid.width), rasterYSize=str(grid.height))
+    ET.SubElement(vrt, 'SRS').text = grid.crs.to_wkt()
+    ET.SubElement(vrt, 'GeoTransform').text = ', '.join(repr(float(v)) for v in grid.transform.to_gdal())
+    for index, (description, source) in enumerate(sources, start=1):
+        with rasterio.open(source) as src:
+            dtype, nodata, scale, offset = src.dtypes[0], src.nodata, src.scales[0], src.offsets[0]
+            width, height, res = src.width, src.height, src.res
+        band = ET.SubElement(vrt, 'VRTRasterBand', dataType=GDAL_DTYPES[dtype], band=str(index))
+        ET.SubElement(band, 'Description').text = description
+        if nodata is not None:
+            ET.SubElement(band, 'NoDataValue').text = repr(nodata)
+        if dtype != 'int32':
+            ET.SubElement(band, 'Offset').text = repr(offset)
+            ET.SubElement(band, 'Scale').text = repr(scale)
+        complex_source = ET.SubElement(band, 'ComplexSource')
+        ET.SubElement(complex_source, 'SourceFilename', relativeToVRT='1').text = os.path.relpath(source, os.path.dirname(path) or '.')
+        ET.SubElement(complex_source, 'SourceBand').text = '1'
+        ET.SubElement(complex_source, 'SrcRect', xOff='0', yOff='0', xSize=str(width), ySize=str(height))
+        ET.SubElement(complex_source, 'DstRect', xOff='0', yOff='0',
+                      xSize=str(round(width * res[0] / grid.transform.a)),
+                      ySize=str(round(height * res[1] / -grid.transform.e)))
+        if nodata is not None:
+            ET.SubElement(complex_source, 'NODATA').text = repr(nodata)
+    ET.ElementTree(vrt).write(path)
+    return path
@@ -21,19 +21,24 @@ import glob
 import logging
 import logging.config
 import os
-import shutil
-import xml.etree.ElementTree as ET
-from pathlib import Path
+import tempfile
+from collections import namedtuple
+from contextlib import contextmanager
+from fnmatch import fnmatch
 from zipfile import ZipFile
 
 # 3rdparty
-import affine
 import numpy
 import rasterio
-from rasterio.io import MemoryFile
-from skimage.transform import resize
+from rasterio.crs import CRS
+from rasterio.windows import Window
 
-from .s2_sensor_angs.s2_sensor_angs import s2_sensor_angs
+from . import cache, manifest
+from .metadata import (BAND_NAMES, BAND_RESOLUTIONS, ReferenceGrid, angle_grid_transform, crop_grid, grid_bounds,
+                       read_product_metadata, read_tile_metadata, reference_grid, scale_grid)
+from .s2_sensor_angs.s2_sensor_angs import s2_sensor_angs, sensor_angle_grids
+from .output import build_vrt, get_output_profile, write_angle_stack, write_angles
+from .upsample import upsample_window
 
 
 ################################################################################
@@ -46,6 +51,8 @@ def logging_configs():
     global logger
     logger = logging.getLogger(__name__) # or pass an explicit name here, e.g. "mylogger"
     logger.setLevel(logging.INFO)
+    if logger.handlers:
+        return
 
     # create console handler and set level to debug
     ch = logging.StreamHandler()
@@ -61,6 +68,19 @@ def logging_configs():
     logger.addHandler(ch)
 
 
+def band_indexes(bands):
+    """Convert Sentinel-2 band names to bandIds.
+    Parameters:
+       bands (list): band names, e.g. ['B02', 'B8A'].
+    Returns:
+       list: bandIds (0 to 12), in band order.
+    """
+    unknown = [band for band in bands if band not in BAND_NAMES]
+    if unknown:
+        raise ValueError(f"Unknown bands {unknown}, expected any of {list(BAND_NAMES)}")
+    return sorted(set(BAND_NAMES.index(band) for band in bands))
+
+
 def extract_tileid(mtdmsi):
     """Get tile id from MTD_MSI.xml file.
     Parameters:
@@ -68,25 +88,7 @@ def extract_tileid(mtdmsi):
     Returns:
        str: .SAFE tile id.
     """
-    tile_id = ""
-    # Parse the XML file
-    tree = ET.parse(mtdmsi)
-    root = tree.getroot()
-
-    # Find the angles
-    for child in root:
-        if child.tag[-12:] == 'General_Info':
-            geninfo = child
-
-    i=-1
-    j=-1
-    for segment in geninfo:
-        i=i+1
-        if segment.tag == 'Product_Info':
-            for seg in geninfo[i]:
-                j=j+1
-                if seg.tag == 'PRODUCT_URI':
-                    tile_id = geninfo[i][j].text.strip()
+    tile_id = read_product_metadata(mtdmsi).product_uri
 
     return(tile_id.replace(".SAFE",""))
 
@@ -96,108 +98,36 @@ def extract_sun_angles(xml):
     Parameters:
        xml (str): path to MTD_TL.xml.
     Returns:
-       str, str: sz_path, sa_path: path to solar zenith image, path to solar azimuth image, respectively.
+       arr, arr: solar zenith and azimuth grids (23x23) in degrees, sampled every 5000m from the tile corner
+          (see angle_grid_transform), NaN where missing.
     """
-    solar_zenith_values = numpy.empty((23,23,)) * numpy.nan #initiates matrix
-    solar_azimuth_values = numpy.empty((23,23,)) * numpy.nan
-
-    # Parse the XML file
-    tree = ET.parse(xml)
-    root = tree.getroot()
-
-    # Find the angles
-    for child in root:
-        if child.tag[-14:] == 'Geometric_Info':
-            geoinfo = child
-
-    for segment in geoinfo:
-        if segment.tag == 'Tile_Angles':
-            angles = segment
-
-    for angle in angles:
-        if angle.tag == 'Sun_Angles_Grid':
-            for bset in angle:
-                if bset.tag == 'Zenith':
-                    zenith = bset
-                if bset.tag == 'Azimuth':
-                    azimuth = bset
-            for field in zenith:
-                if field.tag == 'Values_List':
-                    zvallist = field
-            for field in azimuth:
-                if field.tag == 'Values_List':
-                    avallist = field
-            for rindex in range(len(zvallist)):
-                zvalrow = zvallist[rindex]
-                avalrow = avallist[rindex]
-                zvalues = zvalrow.text.split(' ')
-                avalues = avalrow.text.split(' ')
-                values = list(zip(zvalues, avalues)) #row of values
-                for cindex in range(len(values)):
-                    if ( values[cindex][0] != 'NaN' and values[cindex][1] != 'NaN'):
-                        zen = float(values[cindex][0])
-                        az = float(values[cindex][1])
-                        solar_zenith_values[rindex,cindex] = zen
-                        solar_azimuth_values[rindex,cindex] = az
-    solar_zenith_values = resize(solar_zenith_values,(22,22))
-    solar_azimuth_values = resize(solar_azimuth_values,(22,22))
+    metadata = read_tile_metadata(xml)
+    valid = ~(numpy.isnan(metadata.sun_zenith) | numpy.isnan(metadata.sun_azimuth))
+    solar_zenith_values = numpy.where(valid, metadata.sun_zenith, numpy.nan)
+    solar_azimuth_values = numpy.where(valid, metadata.sun_azimuth, numpy.nan)
     return (solar_zenith_values, solar_azimuth_values)
 
 
-def extract_sensor_angles(xml):
+def extract_sensor_angles(xml, bandId=7):
     """Extract Sentinel-2 view (sensor) angle bands values from MTD_TL.xml.
     Parameters:
        xml (str): path to MTD_TL.xml.
+       bandId (int): band (0 to 12) of the view angles.
     Returns:
-       str, str: path to view (sensor) zenith image and path to view (sensor) azimuth image, respectively.
+       arr, arr: view (sensor) zenith and azimuth grids (23x23) in degrees, sampled every 5000m from the tile corner
+          (see angle_grid_transform), NaN where missing.
     """
-    numband = 13
-    sensor_zenith_values = numpy.empty((numband,23,23)) * numpy.nan #initiates matrix
-    sensor_azimuth_values = numpy.empty((numband,23,23)) * numpy.nan
-
-    # Parse the XML file
-    tree = ET.parse(xml)
-    root = tree.getroot()
-
-    # Find the angles
-    for child in root:
-        if child.tag[-14:] == 'Geometric_Info':
-            geoinfo = child
-
-    for segment in geoinfo:
-        if segment.tag == 'Tile_Angles':
-            angles = segment
-
-    for angle in angles:
-        if angle.tag == 'Viewing_Incidence_Angles_Grids':
-            bandId = int(angle.attrib['bandId'])
-            for bset in angle:
-                if bset.tag == 'Zenith':
-                    zenith = bset
-                if bset.tag == 'Azimuth':
-                    azimuth = bset
-            for field in zenith:
-                if field.tag == 'Values_List':
-                    zvallist = field
-            for field in azimuth:
-                if field.tag == 'Values_List':
-                    avallist = field
-            for rindex in range(len(zvallist)):
-                zvalrow = zvallist[rindex]
-                avalrow = avallist[rindex]
-                zvalues = zvalrow.text.split(' ')
-                avalues = avalrow.text.split(' ')
-                values = list(zip(zvalues, avalues )) #row of values
-                for cindex in range(len(values)):
-                    if (values[cindex][0] != 'NaN' and values[cindex][1] != 'NaN'):
-                        zen = float(values[cindex][0])
-                        az = float(values[cindex][1])
-                        sensor_zenith_values[bandId, rindex,cindex] = zen
-                        sensor_azimuth_values[bandId, rindex,cindex] = az
-    # In the next two lines, 7 is adopted as bandId since for our application we opted to not generate the angle bands for each of the spectral bands. Here we adopted bandId 7 due to its use in vegetation applications
-    # Also on the next two lines, we are using 22x22 matrices since the angle bands pixels represent 5000 meters. Sentinel-2 images area 109800x109800 meters. The 23x23 5000m matrix is equivalent to 11500x11500m. Based on that we opted to not use the last column and row. More information can be found on STEP ESA forum: https://forum.step.esa.int/t/generate-view-angles-from-metadata-sentinel-2/5598
-    sensor_zenith_values = resize(sensor_zenith_values[7],(22,22))
-    sensor_azimuth_values = resize(sensor_azimuth_values[7],(22,22))
+    metadata = read_tile_metadata(xml)
+    # By default, 7 is adopted as bandId since for our application we opted to not generate the angle bands for each of the spectral bands. Here we adopted bandId 7 due to its use in vegetation applications
+    sensor_zenith_values = numpy.empty(metadata.sun_zenith.shape) * numpy.nan #initiates matrix
+    sensor_azimuth_values = numpy.empty(metadata.sun_zenith.shape) * numpy.nan
+    # Detector grids are merged in metadata order, the last valid value wins
+    for (band, detector), zenith in metadata.view_zenith.items():
+        if band == bandId:
+            azimuth = metadata.view_azimuth[(band, detector)]
+            valid = ~(numpy.isnan(zenith) | numpy.isnan(azimuth))
+            sensor_zenith_values[valid] = zenith[valid]
+            sensor_azimuth_values[valid] = azimuth[valid]
     return(sensor_zenith_values, sensor_azimuth_values)
 
 
@@ -265,97 +195,230 @@ def generate_anglebands(mtd):
     return
 
 
-def resample_anglebands(array, imgref, filename_out, filename_intermed=None):
+def resample_anglebands(array, imgref, filename_out, filename_intermed=None, step=5000, output_profile=None, azimuth=False, bbox=None):
     """Resample angle bands.
     Parameters:
-       array (arr): matrix of angle values.
-       imgref (str): path to image that will be used as reference.
+       array (arr): matrix of angle values, sampled every step meters from the upper left corner of the tile.
+       imgref (ReferenceGrid or str): grid, or path to image, that will be used as reference.
        filename_out (str): filename of the resampled angle band.
-       filename_intermed (str): filename of the intermediary angle bands (not resampled).
+       filename_intermed (str) (optional): filename of the intermediary angle bands (not resampled), in degrees.
+       step (int): size of the angle cells in meters.
+       output_profile (str or OutputProfile) (optional): data type, layout and compression of the output, see OUTPUT_PROFILES.
+       azimuth (bool): whether array holds azimuths.
+       bbox (tuple) (optional): left, bottom, right and top, in the tile crs, of the area to write. Defaults to the whole tile.
     """
-    src_dataset = rasterio.open(imgref)
-    profile = src_dataset.profile
+    grid = imgref if isinstance(imgref, ReferenceGrid) else reference_grid(imgref=imgref)
+    intermed_aff = angle_grid_transform(grid, step)
+    if bbox is not None:
+        grid = crop_grid(grid, bbox)
 
-    profile_intermed = profile
-    if not profile_intermed['nodata']:
-        profile_intermed['nodata'] = -9999
-    profile_intermed.update(width=array.shape[1], height=array.shape[0])
-    intermed_aff = profile['transform']
-    intermed_aff = affine.Affine(5000, intermed_aff.b, intermed_aff.c, intermed_aff.d, -5000, intermed_aff.f)
+    # write the angle bands not resampled (23x23), missing values as nodata
+    if filename_intermed is not None:
+        profile_intermed = dict(width=array.shape[1], height=array.shape[0], count=1, dtype=numpy.float64, crs=grid.crs,
+                                transform=intermed_aff, nodata=-9999)
+        write_raster(numpy.where(numpy.isnan(array), -9999, array), filename_intermed, profile_intermed)
 
-    memfile = MemoryFile()
-    intermed_dataset = memfile.open(#rasterio.open(
-        driver='GTiff',
-        height=profile_intermed['height'],
-        width=profile_intermed['width'],
-        count=profile_intermed['count'],
-        dtype=numpy.float64,
-        crs=profile_intermed['crs'],
-        transform=intermed_aff,
-        nodata=profile_intermed['nodata']
-    )
-
-    #TODO if filename_intermed write angle bands not resampled (23x23)
-    # intermed_dataset = rasterio.open(
-    #     filename_intermed,
-    #     'w',
-    #     driver='GTiff',
-    #     height=profile_intermed['height'],
-    #     width=profile_intermed['width'],
-    #     count=profile_intermed['count'],
-    #     dtype=numpy.float64,
-    #     crs=profile_intermed['crs'],
-    #     transform=intermed_aff,
-    #     nodata=profile_intermed['nodata']
-    # )
-    # intermed_dataset.write(array, 1)
-    # intermed_dataset.close()
-
-    old_res = [intermed_aff.a, intermed_aff.e]
-    new_res = (profile['transform'][0], profile['transform'][4])
-
-    # setup the transform to change the resolution
-    ref_shp = rasterio.open(imgref).read().shape
-    resampled_array = numpy.empty(shape=(ref_shp[1], ref_shp[2]))
-
-    resampled_array = resize(array,(11000,11000))
-    resampled_array = resampled_array[:ref_shp[1],:ref_shp[2]]*100
-    resampled_array[numpy.isnan(resampled_array)] = profile_intermed['nodata']
-    resampled_array = resampled_array.astype(numpy.intc)
-
-    # write results to file
-    resampled_dataset = rasterio.open(
-        filename_out,
-        'w',
-        driver=intermed_dataset.driver,
-        height=ref_shp[1],
-        width=ref_shp[2],
-        count=intermed_dataset.count,
-        dtype=numpy.intc,#str(resampled_array.dtype),
-        crs=intermed_dataset.crs,
-        transform=profile['transform'],
-        nodata=intermed_dataset.nodata,
-        compress='deflate'
-    )
-    resampled_dataset.write(resampled_array, 1)
-    resampled_dataset.close()
+    # write results to file, one block of rows at a time
+    write_angles(filename_out, grid, lambda window: upsample_window(array, intermed_aff, grid.transform, window)*100,
+                 output_profile, azimuth=azimuth)
 
     return
 
 
-def generate_resampled_anglebands(mtdmsi, mtd, imgFolder, angFolder):
-    """Generates angle bands resampled to 10 meters.
+AngleLayer = namedtuple('AngleLayer', [
+    'description',    # band description, e.g. 'SZA' or 'VZA_B04'
+    'array',          # coarse angle grid
+    'transform',      # affine transform of the coarse grid (values at cell centres)
+    'scale',          # factor from the grid values to hundredths of a degree
+    'azimuth',        # whether the layer holds azimuths
+    'grid',           # ReferenceGrid of the layer output
+    'path',           # output file of the layer
+])
+
+# Multi-band outputs: one GeoTIFF, pixel or band interleaved, or a VRT stacking the separate files
+STACKS = ('pixel', 'band', 'vrt')
+
+
+def angleband_files(angFolder, scenename, bands=None):
+    """Output files of the angle layers.
     Parameters:
-       mtdmsi (str): path to MTD_TL.xml.
-       mtd (str): path to MTD_TL.xml.
-       imgFolder (str): path to IMG_DATA folder.
        angFolder (str): output path to angle bands.
+       scenename (str): scene name, prefix of the files.
+       bands (list) (optional): requested band names, None for the legacy B04 outputs.
+    Returns:
+       dict: path of each layer description (SZA, SAA then VZA and VAA of each band), in layer order.
+    """
+    suffixes = [''] if bands is None else ['_' + BAND_NAMES[bandId] for bandId in band_indexes(bands)]
+    files = {'SZA': scenename + '_SZAr.tif', 'SAA': scenename + '_SAAr.tif'}
+    for suffix in suffixes:
+        files['VZA' + suffix] = scenename + suffix + '_VZAr.tif'
+        files['VAA' + suffix] = scenename + suffix + '_VAAr.tif'
+    return {description: os.path.join(angFolder, file) for description, file in files.items()}
+
+
+def angleband_paths(descriptions, paths, bands=None):
+    """Arrange the paths of the angle layers as returned by gen_s2_ang.
+    Parameters:
+       descriptions (list): layer descriptions, sun zenith and azimuth then view zenith and azimuth of each band.
+       paths (list): path of each layer.
+       bands (list) (optional): requested band names, None for the legacy B04 outputs.
+    Returns:
+       str, str, str, str: sz_path, sa_path, vz_path and va_path, the view paths mapping band names to paths with bands.
+    """
+    sz_path, sa_path = paths[0], paths[1]
+    if bands is None:
+        vz_path, va_path = paths[2], paths[3]
+    else:
+        vz_path = {description.split('_')[-1]: path for description, path in zip(descriptions[2::2], paths[2::2])}
+        va_path = {description.split('_')[-1]: path for description, path in zip(descriptions[3::2], paths[3::2])}
+    return sz_path, sa_path, vz_path, va_path
+
+
+def angleband_outputs(files, basename, stack=None):
+    """Files written by write_anglebands, besides the VRT of stack 'vrt'.
+    Parameters:
+       files (dict): path of each layer description, see angleband_files.
+       basename (str): output path and scene name, prefix of stacked outputs.
+       stack (str) (optional): None, 'pixel', 'band' or 'vrt', see write_anglebands.
+    Returns:
+       dict: path of each output, named after its layer description ('SZA.tif', ...) or 'ANG.tif' when stacked.
+    """
+    if stack in ('pixel', 'band'):
+        return {'ANG.tif': basename + '_ANG.tif'}
+    return {description + '.tif': path for description, path in files.items()}
+
+
+def angleband_results(files, basename, bands=None, stack=None):
+    """Arrange the outputs of a run as returned by gen_s2_ang.
+    Parameters:
+       files (dict): path of each layer description, see angleband_files.
+       basename (str): output path and scene name, prefix of stacked outputs.
+       bands (list) (optional): requested band names, None for the legacy B04 outputs.
+       stack (str) (optional): None, 'pixel', 'band' or 'vrt', see write_anglebands.
+    Returns:
+       str, str, str, str: sz_path, sa_path, vz_path and va_path as returned by gen_s2_ang.
+    """
+    if stack in ('pixel', 'band'):
+        paths = [basename + '_ANG.tif'] * len(files)
+    elif stack == 'vrt':
+        paths = [basename + '_ANG.vrt'] * len(files)
+    else:
+        paths = list(files.values())
+    return angleband_paths(list(files), paths, bands)
+
+
+def angleband_options(bands=None, output_profile=None, stack=None, bbox=None, view_angles='model', bbox_crs=None):
+    """Options the outputs of a run depend on, recorded in manifests and output cache keys.
+    Parameters:
+       bands (list) (optional): requested band names, None for the legacy B04 outputs.
+       output_profile (str or OutputProfile) (optional): output profile, see OUTPUT_PROFILES.
+       stack (str) (optional): None, 'pixel', 'band' or 'vrt', see write_anglebands.
+       bbox (tuple) (optional): left, bottom, right and top of the written area.
+       view_angles (str): 'model' for view angles computed from the orbit model, 'metadata' for the metadata grids.
+       bbox_crs (str) (optional): crs of bbox, None for the tile crs.
+    Returns:
+       dict: the options.
+    """
+    return dict(bands=None if bands is None else [BAND_NAMES[bandId] for bandId in band_indexes(bands)],
+                output_profile=dict(get_output_profile(output_profile)._asdict()), stack=stack,
+                bbox=None if bbox is None else [float(v) for v in bbox],
+                bbox_crs=None if bbox_crs is None else CRS.from_user_input(bbox_crs).to_string(), view_angles=view_angles)
+
+
+def angle_layers(mtd, tile_grid, grid, bands=None, files=None, view_angles='model', view_ids=None):
+    """Coarse angle grids of a tile, to be upsampled to the output grids.
+    Parameters:
+       mtd (str): path to MTD_TL.xml.
+       tile_grid (ReferenceGrid): reference 10m grid of the whole tile, origin of the 5000m angle grids.
+       grid (ReferenceGrid): reference grid of the outputs, possibly cropped, the view angles being only computed over it.
+       bands (list) (optional): requested band names, None for the legacy outputs (B04, or B08 from the metadata grids).
+       files (dict) (optional): path of each layer description, see angleband_files. Defaults to no paths.
+       view_angles (str): 'model' for view angles computed from the orbit model, 'metadata' for the metadata grids.
+       view_ids (list) (optional): bandIds whose view angles are computed, the layers of the others having no array.
+          Defaults to all the bands.
+    Returns:
+       list of AngleLayer: sun zenith and azimuth then view zenith and azimuth of each band.
+    """
+    files = files or {}
+
+    # Sun angle layers, sampled every 5000m from the tile corner
+    angs_aff = angle_grid_transform(tile_grid)
+    solar_zenith, solar_azimuth = extract_sun_angles(mtd)
+    layers = [AngleLayer('SZA', solar_zenith, angs_aff, 100, False, grid, files.get('SZA')),
+              AngleLayer('SAA', solar_azimuth, angs_aff, 100, True, grid, files.get('SAA'))]
+
+    # View angle layers, each band on its native grid
+    band_ids = band_indexes(bands) if bands is not None else [3] if view_angles == 'model' else [7]
+    if view_ids is None:
+        view_ids = band_ids
+    bounds = None if grid == tile_grid else grid_bounds(grid)
+    view_grids = sensor_angle_grids(mtd, bands=view_ids, bounds=bounds) if view_angles == 'model' and view_ids else {}
+    for bandId in band_ids:
+        if view_angles == 'model':
+            zenith, azimuth, band_aff = view_grids.get(bandId, (None, None, None))
+            scale = 1
+        else:
+            zenith, azimuth = extract_sensor_angles(mtd, bandId)
+            band_aff, scale = angs_aff, 100
+        band_grid = scale_grid(grid, BAND_RESOLUTIONS[bandId])
+        suffix = '' if bands is None else '_' + BAND_NAMES[bandId]
+        layers.append(AngleLayer('VZA' + suffix, zenith, band_aff, scale, False, band_grid, files.get('VZA' + suffix)))
+        layers.append(AngleLayer('VAA' + suffix, azimuth, band_aff, scale, True, band_grid, files.get('VAA' + suffix)))
+    return layers
+
+
+def write_anglebands(layers, grid, basename, bands=None, output_profile=None, stack=None, pending=None, on_written=None):
+    """Write upsampled angle layers, as separate files or stacked.
+    Parameters:
+       layers (list of AngleLayer): sun zenith and azimuth then view zenith and azimuth of each band.
+       grid (ReferenceGrid): reference 10m grid, grid of stacked outputs.
+       basename (str): output path and scene name, prefix of stacked outputs.
+       bands (list) (optional): requested band names, None for the legacy B04 outputs.
+       output_profile (str or OutputProfile) (optional): data type, layout and compression of the outputs, see OUTPUT_PROFILES.
+       stack (str) (optional): None for separate files, 'pixel' or 'band' for one multi-band GeoTIFF ({scene}_ANG.tif)
+          with that interleaving, 'vrt' for the separate files plus a VRT stacking them ({scene}_ANG.vrt).
+       pending (set) (optional): names of the outputs to write (see angleband_outputs), the others being kept as they are.
+          Defaults to all the outputs.
+       on_written (callable) (optional): called with the name of each output once it is written, e.g. to record it.
     Returns:
        str, str, str, str: path to solar zenith image, path to solar azimuth image, path to view (sensor) zenith image and path to view (sensor) azimuth image, respectively.
+          With bands, vz_path and va_path map each band name to its path. When stacked, every path is the stacked product.
     """
-    logger.debug('Generating resampled anglebands')
-    os.makedirs(angFolder, exist_ok=True)
+    if stack is not None and stack not in STACKS:
+        raise ValueError(f"Unknown stack {stack}, expected None or any of {list(STACKS)}")
+
+    def compute(layer, dst_grid):
+        return lambda window: upsample_window(layer.array, layer.transform, dst_grid.transform, window) * layer.scale
+
+    if stack in ('pixel', 'band'):
+        # Every layer is upsampled to the reference grid
+        paths = [basename + '_ANG.tif'] * len(layers)
+        if pending is None or 'ANG.tif' in pending:
+            stacked = [(layer.description, compute(layer, grid), layer.azimuth) for layer in layers]
+            write_angle_stack(paths[0], grid, stacked, output_profile, interleave=stack)
+            if on_written is not None:
+                on_written('ANG.tif')
+    else:
+        paths = [layer.path for layer in layers]
+        for layer in layers:
+            name = layer.description + '.tif'
+            if pending is None or name in pending:
+                write_angles(layer.path, layer.grid, compute(layer, layer.grid), output_profile, azimuth=layer.azimuth)
+                if on_written is not None:
+                    on_written(name)
+        if stack == 'vrt':
+            paths = [build_vrt(basename + '_ANG.vrt', grid, [(layer.description, layer.path) for layer in layers])] * len(layers)
 
+    return angleband_paths([layer.description for layer in layers], paths, bands)
+
+
+def find_imgref(imgFolder):
+    """Find the reference band (4, red) in a folder.
+    Parameters:
+       imgFolder (str): folder searched recursively for the band, as .jp2 or .tif.
+    Returns:
+       str: path to the reference band, None when not found.
+    """
     if not imgFolder.endswith('/'):
         imgFolder = imgFolder + '/'
 
@@ -364,27 +427,97 @@ def generate_resampled_anglebands(mtdmsi, mtd, imgFolder, angFolder):
     safe_tif = [f for f in glob.glob(imgFolder + "**/*B04*.tif", recursive=True)]
     folder_tif = [f for f in glob.glob(imgFolder + "**/*band4*.tif", recursive=True)]
     imgref_list = safe_jp2 + safe_tif + folder_tif
-    # Checks for empty list (No file)
+    imgref_list.sort()
+    return imgref_list[0] if imgref_list else None
+
+
+def generate_resampled_anglebands(mtdmsi, mtd, imgFolder, angFolder, imgref=None, bands=None, output_profile=None, stack=None,
+                                  bbox=None, skip_existing=False, bbox_crs=None):
+    """Generates angle bands resampled to 10 meters.
+    Parameters:
+       mtdmsi (str): path to MTD_TL.xml.
+       mtd (str): path to MTD_TL.xml.
+       imgFolder (str): path to IMG_DATA folder, or None when no reference band has to be searched.
+       angFolder (str): output path to angle bands.
+       imgref (str) (optional): path or GDAL dataset name of the reference band (4, red), searched in imgFolder when not given.
+          It is only read when MTD_TL.xml does not describe the 10m grid.
+       bands (list) (optional): band names (e.g. ['B02', 'B8A']) to generate view angles for, each at its native resolution.
+          Defaults to B04 only, written with the band-less file names.
+       output_profile (str or OutputProfile) (optional): data type, layout and compression of the outputs, see OUTPUT_PROFILES.
+       stack (str) (optional): None for separate files, 'pixel' or 'band' for one multi-band GeoTIFF ({scene}_ANG.tif)
+          with that interleaving, 'vrt' for the separate files plus a VRT stacking them ({scene}_ANG.vrt).
+       bbox (tuple) (optional): left, bottom, right and top, in the tile crs or bbox_crs, of the area to write. Defaults to the whole tile.
+       bbox_crs (str) (optional): crs of bbox, e.g. 'EPSG:4326' for longitudes and latitudes. Defaults to the tile crs.
+       skip_existing (bool): resume a previous run, only computing the outputs its manifest ({scene}_ANG.json) does not
+          record as complete and current.
+    Returns:
+       str, str, str, str: path to solar zenith image, path to solar azimuth image, path to view (sensor) zenith image and path to view (sensor) azimuth image, respectively.
+          With bands, vz_path and va_path map each band name to its path. When stacked, every path is the stacked product.
+    """
+    logger.debug('Generating resampled anglebands')
+    os.makedirs(angFolder, exist_ok=True)
+
+    if imgref is None and imgFolder is not None:
+        # The band is optional as the grid is taken from the metadata when available
+        imgref = find_imgref(imgFolder)
+
+    # Reference 10m grid, without reading image pixels
     try:
-        imgref_list.sort()
-        imgref = imgref_list[0]
-    except IndexError:
+        tile_grid = reference_grid(mtd, imgref)
+    except ValueError:
         raise IndexError(f"Missing reference band (4, red) file on {imgFolder}")
 
     scenename = extract_tileid(mtdmsi)
+    files = angleband_files(angFolder, scenename, bands)
+    basename = os.path.join(angFolder, scenename)
+    outputs = angleband_outputs(files, basename, stack)
+    band_ids = [3] if bands is None else band_indexes(bands)
+    grid = tile_grid if bbox is None else crop_grid(tile_grid, bbox, crs=bbox_crs)
+
+    # Outputs only depend on the tile geometry and the options
+    footprints = read_tile_metadata(mtd).footprints
+    digest = cache.geometry_digest(mtd, [footprints[bandId] for bandId in band_ids if bandId in footprints])
+    options = angleband_options(bands, output_profile, stack, bbox, bbox_crs=bbox_crs)
+    manifest_path = basename + '_ANG.json'
+
+    # Resume a previous run, computing only the outputs which are missing, stale or corrupt
+    pending = set(outputs)
+    if skip_existing:
+        pending = manifest.outdated_outputs(manifest_path, digest, options, outputs)
+        if not pending:
+            logger.info(f'Skipping {scenename}, outputs in {angFolder} are complete')
+            if stack == 'vrt' and not os.path.exists(basename + '_ANG.vrt'):
+                build_vrt(basename + '_ANG.vrt', grid, list(files.items()))
+            return angleband_results(files, basename, bands, stack)
+        logger.info(f'Computing {sorted(pending)} of {scenename}')
+
+    # The outputs of other products sharing the geometry (e.g. L1C and L2A) are copied from the cache
+    cache_dir = cache.cache_dir()
+    key = cache.output_key(digest, **options)
+    if cache_dir is not None and cache.restore_outputs(cache_dir, key, {name: outputs[name] for name in pending}):
+        logger.info(f'Copied cached outputs of {scenename} to {angFolder}')
+        if stack == 'vrt':
+            build_vrt(basename + '_ANG.vrt', grid, list(files.items()))
+    else:
+        # View angles are only computed for the bands of pending outputs
+        suffixes = {bandId: '' if bands is None else '_' + BAND_NAMES[bandId] for bandId in band_ids}
+        view_ids = [bandId for bandId in band_ids
+                    if stack in ('pixel', 'band') or {f'VZA{suffixes[bandId]}.tif', f'VAA{suffixes[bandId]}.tif'} & pending]
+        layers = angle_layers(mtd, tile_grid, grid, bands, files, view_ids=view_ids)
+        # The manifest records each output as it is written, so an interrupted run resumes from the last one
+        recorded = {name: output for name, output in outputs.items() if name not in pending}
+        manifest.write_manifest(manifest_path, digest, options, recorded)
 
-    sz_path = os.path.join(angFolder, scenename + '_SZAr.tif')
-    sa_path = os.path.join(angFolder, scenename + '_SAAr.tif')
-    vz_path = os.path.join(angFolder, scenename + '_VZAr.tif')
-    va_path = os.path.join(angFolder, scenename + '_VAAr.tif')
+        def record(name):
+            recorded[name] = outputs[name]
+            manifest.write_manifest(manifest_path, digest, options, recorded)
 
-    solar_zenith, solar_azimuth = extract_sun_angles(mtd)
-    va_path, vz_path = s2_sensor_angs(mtd, imgref, va_path, vz_path)
+        write_anglebands(layers, grid, basename, bands, output_profile, stack, pending, on_written=record)
+        if cache_dir is not None:
+            cache.store_outputs(cache_dir, key, outputs)
 
-    resample_anglebands(solar_zenith, imgref, sz_path)
-    resample_anglebands(solar_azimuth, imgref, sa_path)
-
-    return sz_path, sa_path, vz_path, va_path
+    manifest.write_manifest(manifest_path, digest, options, outputs)
+    return angleband_results(files, basename, bands, stack)
 
 
 def xmls_from_safe(SAFEfile):
@@ -401,13 +534,86 @@ def xmls_from_safe(SAFEfile):
     return mtdmsi, mtd
 
 
-def gen_s2_ang_from_SAFE(SAFEfile, output_dir=None):
+ProductFiles = namedtuple('ProductFiles', [
+    'mtdmsi',         # path to MTD_MSIL*.xml
+    'mtd',            # path to MTD_TL.xml
+    'imgref',         # path or GDAL dataset name of the reference band (4, red), or None
+    'view_angles',    # 'model' for view angles computed from the orbit model, 'metadata' for the metadata grids
+])
+
+
+@contextmanager
+def zip_product_files(zipfile):
+    """Locate the metadata and reference band of a zipped .SAFE.
+    Only the metadata and detector footprint members are extracted, into a
+    private temporary directory removed on exit; the reference band is read
+    in place through GDAL's /vsizip/.
+    Parameters:
+       zipfile (str): path to zipfile.
+    Returns:
+       ProductFiles: paths to the extracted metadata and to the reference band, within the context.
+    """
+    with ZipFile(zipfile) as zipObj:
+        members = [m for m in zipObj.namelist() if not m.endswith('/')]
+        mtdmsi = [m for m in members if fnmatch(m, '*.SAFE/MTD_MSIL*.xml')]
+        mtd = [m for m in members if fnmatch(m, '*.SAFE/GRANULE/*/MTD_TL.xml')]
+        if not mtdmsi or not mtd:
+            raise IndexError(f"Missing MTD_MSIL*.xml or MTD_TL.xml on {zipfile}")
+        mtdmsi, mtd = sorted(mtdmsi)[0], sorted(mtd)[0]
+        granule = mtd.rsplit('/', 1)[0]
+        footprints = [m for m in members if fnmatch(m, granule + '/QI_DATA/*DETFOO*')]
+
+        imgref_list = [m for m in members
+                       if fnmatch(m, granule + '/IMG_DATA/*B04*.jp2') or fnmatch(m, granule + '/IMG_DATA/*B04*.tif')]
+        imgref_list.sort()
+        imgref = '/vsizip/' + os.path.abspath(zipfile) + '/' + imgref_list[0] if imgref_list else None
+
+        with tempfile.TemporaryDirectory(prefix='s2_ang_') as tmp_dir:
+            for member in [mtdmsi, mtd] + footprints:
+                zipObj.extract(member, tmp_dir)
+            yield ProductFiles(os.path.join(tmp_dir, mtdmsi), os.path.join(tmp_dir, mtd), imgref, 'model')
+
+
+@contextmanager
+def product_files(path):
+    """Locate the metadata and reference band of a product.
+    Parameters:
+       path (str): path to zipfile, .SAFE or folder containing S2 data.
+    Returns:
+       ProductFiles: paths to the metadata and to the reference band, within the context.
+    """
+    if path.endswith('.zip'):
+        with zip_product_files(path) as files:
+            yield files
+    elif path.endswith('.SAFE'):
+        mtdmsi, mtd = xmls_from_safe(path)
+        yield ProductFiles(mtdmsi, mtd, find_imgref(os.path.join(os.path.split(mtd)[0], "IMG_DATA")), 'model')
+    else:
+        mtdmsi = [f for f in glob.glob(os.path.join(path, "MTD_MSIL*.xml"), recursive=True)][0]
+        imgref = find_imgref(path)
+        if imgref is None:
+            raise IndexError(f"Missing reference band (4, red) file on {path}")
+        yield ProductFiles(mtdmsi, os.path.join(path, 'MTD_TL.xml'), imgref, 'metadata')
+
+
+def gen_s2_ang_from_SAFE(SAFEfile, output_dir=None, bands=None, output_profile=None, stack=None, bbox=None,
+                         skip_existing=False, bbox_crs=None):
     """Generate Sentinel 2 angles using .SAFE.
     Parameters:
        SAFEfile (str): path to Sentinel-2 .SAFE folder.
        output_dir (str) (optional): path to output folder.
+       bands (list) (optional): band names (e.g. ['B02', 'B8A']) to generate view angles for, each at its native resolution.
+          Defaults to B04 only, written with the band-less file names.
+       output_profile (str or OutputProfile) (optional): data type, layout and compression of the outputs, see OUTPUT_PROFILES.
+       stack (str) (optional): None for separate files, 'pixel' or 'band' for one multi-band GeoTIFF ({scene}_ANG.tif)
+          with that interleaving, 'vrt' for the separate files plus a VRT stacking them ({scene}_ANG.vrt).
+       bbox (tuple) (optional): left, bottom, right and top, in the tile crs or bbox_crs, of the area to write. Defaults to the whole tile.
+       bbox_crs (str) (optional): crs of bbox, e.g. 'EPSG:4326' for longitudes and latitudes. Defaults to the tile crs.
+       skip_existing (bool): resume a previous run, only computing the outputs its manifest ({scene}_ANG.json) does not
+          record as complete and current.
     Returns:
        sz_path, sa_path, vz_path, va_path: path to solar zenith image, path to solar azimuth image, path to view (sensor) zenith image and path to view (sensor) azimuth image, respectively.
+          With bands, vz_path and va_path map each band name to its path. When stacked, every path is the stacked product.
     """
     logger.debug('Using .SAFE approach')
 
@@ -420,61 +626,68 @@ def gen_s2_ang_from_SAFE(SAFEfile, output_dir=None):
         angFolder = output_dir
 
     ### Generates resampled anglebands (to 10m)
-    sz_path, sa_path, vz_path, va_path = generate_resampled_anglebands(mtdmsi, mtd, imgFolder, angFolder)
+    sz_path, sa_path, vz_path, va_path = generate_resampled_anglebands(mtdmsi, mtd, imgFolder, angFolder, bands=bands,
+                                                                       output_profile=output_profile, stack=stack,
+                                                                       bbox=bbox, skip_existing=skip_existing,
+                                                                       bbox_crs=bbox_crs)
     return sz_path, sa_path, vz_path, va_path
 
 
-def gen_s2_ang_from_zip(zipfile, output_dir=None):
+def gen_s2_ang_from_zip(zipfile, output_dir=None, bands=None, output_profile=None, stack=None, bbox=None,
+                        skip_existing=False, bbox_crs=None):
     """Generate Sentinel 2 angles using a zipped .SAFE.
+    Only the metadata and detector footprint members are extracted, into a
+    private temporary directory; the reference band is read in place through
+    GDAL's /vsizip/.
     Parameters:
        zipfile (str): path to zipfile.
        output_dir (str) (optional): path to output folder.
+       bands (list) (optional): band names (e.g. ['B02', 'B8A']) to generate view angles for, each at its native resolution.
+          Defaults to B04 only, written with the band-less file names.
+       output_profile (str or OutputProfile) (optional): data type, layout and compression of the outputs, see OUTPUT_PROFILES.
+       stack (str) (optional): None for separate files, 'pixel' or 'band' for one multi-band GeoTIFF ({scene}_ANG.tif)
+          with that interleaving, 'vrt' for the separate files plus a VRT stacking them ({scene}_ANG.vrt).
+       bbox (tuple) (optional): left, bottom, right and top, in the tile crs or bbox_crs, of the area to write. Defaults to the whole tile.
+       bbox_crs (str) (optional): crs of bbox, e.g. 'EPSG:4326' for longitudes and latitudes. Defaults to the tile crs.
+       skip_existing (bool): resume a previous run, only computing the outputs its manifest ({scene}_ANG.json) does not
+          record as complete and current.
     Returns:
        str, str, str, str: path to solar zenith image, path to solar azimuth image, path to view (sensor) zenith image and path to view (sensor) azimuth image, respectively.
+          With bands, vz_path and va_path map each band name to its path. When stacked, every path is the stacked product.
     """
     logger.debug('Using .zip approach')
 
-    with ZipFile(zipfile) as zipObj:
-        zipfoldername = zipObj.namelist()[0][:-1]
-    work_dir = os.getcwd()
+    angFolder = os.getcwd()
     if output_dir is not None:
-        work_dir = output_dir
-    os.makedirs('s2_ang_tmp', exist_ok=True)
-    s2_ang_tmp = os.path.join(os.getcwd(), 's2_ang_tmp')
-    temp_SAFE = os.path.join(s2_ang_tmp, zipfoldername)
-    shutil.unpack_archive(zipfile, temp_SAFE, 'zip')
-    SAFEfile = os.path.join(temp_SAFE, zipfoldername)
-    mtdmsi, mtd = xmls_from_safe(SAFEfile)
-    path = os.path.split(mtd)[0]
-    imgFolder = os.path.join(path, "IMG_DATA")
-    angFolder = os.path.join(path, "ANG_DATA")
-
-    ### Generates resampled anglebands (to 10m)
-    sz_path, sa_path, vz_path, va_path = generate_resampled_anglebands(mtdmsi, mtd, imgFolder, angFolder)
-    ang_dir = os.path.join(SAFEfile,'GRANULE', os.listdir(os.path.join(SAFEfile,'GRANULE/'))[0], 'ANG_DATA')
-
-    new_sz_path = os.path.join(work_dir, Path(sz_path).name)
-    new_sa_path = os.path.join(work_dir, Path(sa_path).name)
-    new_vz_path = os.path.join(work_dir, Path(vz_path).name)
-    new_va_path = os.path.join(work_dir, Path(va_path).name)
+        angFolder = output_dir
 
-    shutil.move(sz_path, new_sz_path)
-    shutil.move(sa_path, new_sa_path)
-    shutil.move(vz_path, new_vz_path)
-    shutil.move(va_path, new_va_path)
-    shutil.rmtree(temp_SAFE)
-    Path(s2_ang_tmp).rmdir()
+    with zip_product_files(zipfile) as files:
+        ### Generates resampled anglebands (to 10m)
+        sz_path, sa_path, vz_path, va_path = generate_resampled_anglebands(
+            files.mtdmsi, files.mtd, None, angFolder, imgref=files.imgref, bands=bands,
+            output_profile=output_profile, stack=stack, bbox=bbox, skip_existing=skip_existing, bbox_crs=bbox_crs)
 
     return sz_path, sa_path, vz_path, va_path
 
 
-def gen_s2_ang_from_folder(folder, output_dir=None):
+def gen_s2_ang_from_folder(folder, output_dir=None, bands=None, output_profile=None, stack=None, bbox=None,
+                           skip_existing=False, bbox_crs=None):
     """Generate Sentinel 2 angles using all files in a single folder.
     Parameters:
        folder (str): path to Sentinel-2 folder.
        output_dir (str) (optional): path to output folder.
+       bands (list) (optional): band names (e.g. ['B02', 'B8A']) to generate view angles for, each at its native resolution.
+          Defaults to B04 only, written with the band-less file names.
+       output_profile (str or OutputProfile) (optional): data type, layout and compression of the outputs, see OUTPUT_PROFILES.
+       stack (str) (optional): None for separate files, 'pixel' or 'band' for one multi-band GeoTIFF ({scene}_ANG.tif)
+          with that interleaving, 'vrt' for the separate files plus a VRT stacking them ({scene}_ANG.vrt).
+       bbox (tuple) (optional): left, bottom, right and top, in the tile crs or bbox_crs, of the area to write. Defaults to the whole tile.
+       bbox_crs (str) (optional): crs of bbox, e.g. 'EPSG:4326' for longitudes and latitudes. Defaults to the tile crs.
+       skip_existing (bool): resume a previous run, only computing the outputs its manifest ({scene}_ANG.json) does not
+          record as complete and current.
     Returns:
        sz_path, sa_path, vz_path, va_path: path to solar zenith image, path to solar azimuth image, path to view (sensor) zenith image and path to view (sensor) azimuth image, respectively.
+          With bands, vz_path and va_path map each band name to its path. When stacked, every path is the stacked product.
     """
     logger.debug('Using Folder approach')
 
@@ -484,54 +697,217 @@ def gen_s2_ang_from_folder(folder, output_dir=None):
     ### Generates resampled anglebands (to 10m)
     ang_folder = os.path.join(folder, 'ANG_DATA')
     if output_dir is not None:
-        angFolder = output_dir
+        ang_folder = output_dir
 
     os.makedirs(ang_folder, exist_ok=True)
 
-    if not folder.endswith('/'):
-        imgFolder = folder + '/'
-
-    safe_jp2 = [f for f in glob.glob(imgFolder + "**/*B04*.jp2", recursive=True)]
-    safe_tif = [f for f in glob.glob(imgFolder + "**/*B04*.tif", recursive=True)]
-    folder_tif = [f for f in glob.glob(imgFolder + "**/*band4*.tif", recursive=True)]
-    imgref_list = safe_jp2 + safe_tif + folder_tif
-    imgref_list.sort()
-
-    imgref = imgref_list[0]
+    imgref = find_imgref(folder)
+    if imgref is None:
+        raise IndexError(f"Missing reference band (4, red) file on {folder}")
 
     scenename = extract_tileid(mtdmsi)
-
-    sz_path = os.path.join(ang_folder, scenename + '_SZAr.tif')
-    sa_path = os.path.join(ang_folder, scenename + '_SAAr.tif')
-    vz_path = os.path.join(ang_folder, scenename + '_VZAr.tif')
-    va_path = os.path.join(ang_folder, scenename + '_VAAr.tif')
-
-    solar_zenith, solar_azimuth = extract_sun_angles(mtd)
-    view_zenith, view_azimuth = extract_sensor_angles(mtd)
-
-    resample_anglebands(solar_zenith, imgref, sz_path)
-    resample_anglebands(solar_azimuth, imgref, sa_path)
-    resample_anglebands(view_zenith, imgref, vz_path)
-    resample_anglebands(view_azimuth, imgref, va_path)
-
-    return sz_path, sa_path, vz_path, va_path
-
-
-def gen_s2_ang(path, output_dir=None):
+    files = angleband_files(ang_folder, scenename, bands)
+    basename = os.path.join(ang_folder, scenename)
+    outputs = angleband_outputs(files, basename, stack)
+    tile_grid = reference_grid(mtd, imgref)
+    grid = tile_grid if bbox is None else crop_grid(tile_grid, bbox, crs=bbox_crs)
+
+    # Resume a previous run, computing only the outputs which are missing, stale or corrupt
+    digest = cache.geometry_digest(mtd)
+    options = angleband_options(bands, output_profile, stack, bbox, view_angles='metadata', bbox_crs=bbox_crs)
+    manifest_path = basename + '_ANG.json'
+    pending = set(outputs)
+    if skip_existing:
+        pending = manifest.outdated_outputs(manifest_path, digest, options, outputs)
+        if not pending:
+            logger.info(f'Skipping {scenename}, outputs in {ang_folder} are complete')
+            return angleband_results(files, basename, bands, stack)
+
+    # Sun and view angle layers from the metadata grids
+    layers = angle_layers(mtd, tile_grid, grid, bands, files, view_angles='metadata')
+    paths = write_anglebands(layers, grid, basename, bands, output_profile, stack, pending)
+    manifest.write_manifest(manifest_path, digest, options, outputs)
+    return paths
+
+
+def gen_s2_ang(path, output_dir=None, bands=None, output_profile=None, stack=None, bbox=None, skip_existing=False,
+               bbox_crs=None):
     """Generate Sentinel 2 angle bands.
     Parameters:
        path (str): path to zipfile, .SAFE or folder containing S2 data.
        output_dir (str) (optional): path to output folder.
+       bands (list) (optional): band names (e.g. ['B02', 'B8A']) to generate view angles for, each at its native resolution.
+          Defaults to B04 only, written with the band-less file names.
+       output_profile (str or OutputProfile) (optional): data type, layout and compression of the outputs, see OUTPUT_PROFILES.
+       stack (str) (optional): None for separate files, 'pixel' or 'band' for one multi-band GeoTIFF ({scene}_ANG.tif)
+          with that interleaving, 'vrt' for the separate files plus a VRT stacking them ({scene}_ANG.vrt).
+       bbox (tuple) (optional): left, bottom, right and top, in the tile crs or bbox_crs, of the area to write. Defaults to the whole tile.
+       bbox_crs (str) (optional): crs of bbox, e.g. 'EPSG:4326' for longitudes and latitudes. Defaults to the tile crs.
+       skip_existing (bool): resume a previous run, only computing the outputs its manifest ({scene}_ANG.json) does not
+          record as complete and current.
     Returns:
        sz_path, sa_path, vz_path, va_path: path to solar zenith image, path to solar azimuth image, path to view (sensor) zenith image and path to view (sensor) azimuth image, respectively.
+          With bands, vz_path and va_path map each band name to its path. When stacked, every path is the stacked product.
     """
     logging_configs()
     logger.info(f'Generating angles from {path}')
     if path.endswith('.SAFE'):
-        sz_path, sa_path, vz_path, va_path = gen_s2_ang_from_SAFE(path, output_dir) #path to SAFE
+        sz_path, sa_path, vz_path, va_path = gen_s2_ang_from_SAFE(path, output_dir, bands, output_profile, stack, bbox,
+                                                                  skip_existing, bbox_crs) #path to SAFE
     elif path.endswith('.zip'):
-        sz_path, sa_path, vz_path, va_path = gen_s2_ang_from_zip(path, output_dir) #path to .zip
+        sz_path, sa_path, vz_path, va_path = gen_s2_ang_from_zip(path, output_dir, bands, output_profile, stack, bbox,
+                                                                 skip_existing, bbox_crs) #path to .zip
     else:
-        sz_path, sa_path, vz_path, va_path = gen_s2_ang_from_folder(path, output_dir)
+        sz_path, sa_path, vz_path, va_path = gen_s2_ang_from_folder(path, output_dir, bands, output_profile, stack, bbox,
+                                                                    skip_existing, bbox_crs)
 
     return sz_path, sa_path, vz_path, va_path
+
+
+S2Angles = namedtuple('S2Angles', [
+    'sza',            # solar zenith, in degrees
+    'saa',            # solar azimuth, in degrees
+    'vza',            # view zenith, in degrees; with bands, a dict mapping band names to arrays
+    'vaa',            # view azimuth, in degrees; with bands, a dict mapping band names to arrays
+    'transform',      # affine transform of the arrays
+    'crs',            # coordinate reference system of the arrays
+])
+
+
+# Blocks of iter_s2_angles when the reference band does not give them
+BLOCK_SIZE = 1024
+
+
+def angle_block(layer, transform, window):
+    """Upsample an angle layer over a window of a grid, in memory.
+    Parameters:
+       layer (AngleLayer): coarse angle grid.
+       transform (Affine): transform of the grid.
+       window (Window): window of the grid to compute.
+    Returns:
+       arr: float32 angles in degrees, NaN where missing.
+    """
+    values = upsample_window(layer.array, layer.transform, transform, window) * (layer.scale / 100)
+    return values.astype(numpy.float32)
+
+
+def angle_array(layer, grid, max_pixels=2**20):
+    """Upsample an angle layer to a grid, in memory.
+    Parameters:
+       layer (AngleLayer): coarse angle grid.
+       grid (ReferenceGrid): output grid.
+       max_pixels (int): approximate number of pixels upsampled at once.
+    Returns:
+       arr: float32 angles in degrees, NaN where missing.
+    """
+    array = numpy.empty((grid.height, grid.width), dtype=numpy.float32)
+    rows = max(1, max_pixels // grid.width)
+    for row_off in range(0, grid.height, rows):
+        window = Window(0, row_off, grid.width, min(rows, grid.height - row_off))
+        array[window.toslices()] = angle_block(layer, grid.transform, window)
+    return array
+
+
+def product_angle_layers(files, bands=None, bbox=None, resolution=10, bbox_crs=None):
+    """Angle layers of a product over an area.
+    Parameters:
+       files (ProductFiles): metadata and reference band of the product, see product_files.
+       bands (list) (optional): band names to compute view angles for. Defaults to B04 only (B08 metadata grids for folders).
+       bbox (tuple) (optional): left, bottom, right and top, in the tile crs or bbox_crs, of the area. Defaults to the whole tile.
+       bbox_crs (str) (optional): crs of bbox, e.g. 'EPSG:4326' for longitudes and latitudes. Defaults to the tile crs.
+       resolution (int): resolution of the grids in meters (10, 20 or 60).
+    Returns:
+       ReferenceGrid, ReferenceGrid, list of AngleLayer: grids of the tile and of the area at resolution, and the angle layers.
+    """
+    try:
+        tile_grid = reference_grid(files.mtd, files.imgref)
+    except ValueError:
+        raise IndexError(f"Missing reference band (4, red) file on {os.path.dirname(files.mtd)}")
+    grid = scale_grid(tile_grid if bbox is None else crop_grid(tile_grid, bbox, crs=bbox_crs), resolution)
+    layers = angle_layers(files.mtd, tile_grid, grid, bands, view_angles=files.view_angles)
+    return scale_grid(tile_grid, resolution), grid, layers
+
+
+def compute_s2_angles(path, bands=None, bbox=None, resolution=10, bbox_crs=None):
+    """Compute Sentinel 2 angle bands in memory, without writing them.
+    Every angle is upsampled to the same grid, at the given resolution.
+    Unlike the outputs of gen_s2_ang, the angles are neither truncated nor
+    wrapped. Only the persistent caches, when enabled, are written.
+    Parameters:
+       path (str): path to zipfile, .SAFE or folder containing S2 data.
+       bands (list) (optional): band names (e.g. ['B02', 'B8A']) to compute view angles for. Defaults to B04 only
+          (B08 metadata grids for folders).
+       bbox (tuple) (optional): left, bottom, right and top, in the tile crs or bbox_crs, of the area to compute. Defaults to the whole tile.
+       bbox_crs (str) (optional): crs of bbox, e.g. 'EPSG:4326' for longitudes and latitudes. Defaults to the tile crs.
+       resolution (int): resolution of the arrays in meters (10, 20 or 60).
+    Returns:
+       S2Angles: float32 sza, saa, vza and vaa arrays in degrees (NaN where missing), their transform and crs.
+          With bands, vza and vaa map each band name to its array.
+    """
+    logging_configs()
+    logger.info(f'Computing angles of {path}')
+    with product_files(path) as files:
+        _, grid, layers = product_angle_layers(files, bands, bbox, resolution, bbox_crs)
+
+    arrays = [angle_array(layer, grid) for layer in layers]
+    sza, saa, vza, vaa = angleband_paths([layer.description for layer in layers], arrays, bands)
+    return S2Angles(sza=sza, saa=saa, vza=vza, vaa=vaa, transform=grid.transform, crs=grid.crs)
+
+
+def block_windows(tile_grid, grid, block_shape):
+    """Split an area of a tile into windows aligned to the blocks of the tile.
+    Parameters:
+       tile_grid (ReferenceGrid): grid of the tile.
+       grid (ReferenceGrid): grid of the area, on the pixels of tile_grid.
+       block_shape (tuple): rows and columns of the blocks.
+    Returns:
+       generator of Window: windows of tile_grid covering the area, row by row.
+    """
+    block_rows, block_cols = block_shape
+    col_off = int(round((grid.transform.c - tile_grid.transform.c) / tile_grid.transform.a))
+    row_off = int(round((grid.transform.f - tile_grid.transform.f) / tile_grid.transform.e))
+    col_end, row_end = col_off + grid.width, row_off + grid.height
+    for row in range(row_off - row_off % block_rows, row_end, block_rows):
+        row_start, row_stop = max(row, row_off), min(row + block_rows, row_end)
+        for col in range(col_off - col_off % block_cols, col_end, block_cols):
+            col_start, col_stop = max(col, col_off), min(col + block_cols, col_end)
+            yield Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+def iter_s2_angles(path, bands=None, bbox=None, resolution=10, block_size=None, bbox_crs=None):
+    """Compute Sentinel 2 angle bands block by block, without writing them.
+    The coarse angle grids (sun grid, orbit and detector time models) are
+    computed once, then each block is only upsampled when requested, so
+    memory does not depend on the tile size. Windows are on the pixels of
+    the tile at the given resolution, i.e. of the band images, so blocks
+    can be paired with reads of the reflectances.
+    Parameters:
+       path (str): path to zipfile, .SAFE or folder containing S2 data.
+       bands (list) (optional): band names (e.g. ['B02', 'B8A']) to compute view angles for. Defaults to B04 only
+          (B08 metadata grids for folders).
+       bbox (tuple) (optional): left, bottom, right and top, in the tile crs or bbox_crs, of the area to compute. Defaults to the whole tile.
+       bbox_crs (str) (optional): crs of bbox, e.g. 'EPSG:4326' for longitudes and latitudes. Defaults to the tile crs.
+       resolution (int): resolution of the blocks in meters (10, 20 or 60).
+       block_size (int or tuple) (optional): rows and columns of the blocks. Defaults to the blocks of the reference band
+          (4, red) at 10m, BLOCK_SIZE otherwise.
+    Returns:
+       generator: window, sza, saa, vza and vaa of each block, float32 angles in degrees (NaN where missing).
+          With bands, vza and vaa map each band name to its block.
+    """
+    logging_configs()
+    logger.info(f'Computing angles of {path} by blocks')
+    with product_files(path) as files:
+        tile_grid, grid, layers = product_angle_layers(files, bands, bbox, resolution, bbox_crs)
+        if block_size is None and resolution == 10 and files.imgref is not None:
+            with rasterio.open(files.imgref) as src:
+                block_size = src.block_shapes[0]
+
+    if block_size is None:
+        block_size = BLOCK_SIZE
+    if isinstance(block_size, int):
+        block_size = (block_size, block_size)
+    descriptions = [layer.description for layer in layers]
+    for window in block_windows(tile_grid, grid, block_size):
+        blocks = [angle_block(layer, tile_grid.transform, window) for layer in layers]
+        sza, saa, vza, vaa = angleband_paths(descriptions, blocks, bands)
+        yield window, sza, saa, vza, vaa
@@ -28,129 +28,22 @@ import math
 import numpy
 import os
 import xml.etree.ElementTree as ET
+from functools import lru_cache
 from math import sqrt, cos, sin, tan, pi, asin, acos, atan, atan2
 from pathlib import Path
 
 import rasterio
 from rasterio import features
-from skimage.transform import resize
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+from rasterio.windows import Window
 
+from .. import cache
+from ..metadata import (BAND_NAMES, ReferenceGrid, crop_grid, grid_bounds, read_tile_metadata, reference_grid,
+                        scale_grid)
+from ..output import write_angles
+from ..upsample import upsample_window
 
-############################################################################
-# Sudipta's addition to enable spatial subset
-############################################################################
-K0 = 0.9996
-
-E = 0.00669438
-E2 = E * E
-E3 = E2 * E
-E_P2 = E / (1.0 - E)
-
-SQRT_E = math.sqrt(1 - E)
-_E = (1 - SQRT_E) / (1 + SQRT_E)
-_E2 = _E * _E
-_E3 = _E2 * _E
-_E4 = _E3 * _E
-_E5 = _E4 * _E
-
-M1 = (1 - E / 4 - 3 * E2 / 64 - 5 * E3 / 256)
-M2 = (3 * E / 8 + 3 * E2 / 32 + 45 * E3 / 1024)
-M3 = (15 * E2 / 256 + 45 * E3 / 1024)
-M4 = (35 * E3 / 3072)
-
-P2 = (3. / 2 * _E - 27. / 32 * _E3 + 269. / 512 * _E5)
-P3 = (21. / 16 * _E2 - 55. / 32 * _E4)
-P4 = (151. / 96 * _E3 - 417. / 128 * _E5)
-P5 = (1097. / 512 * _E4)
-
-R = 6378137
-
-ZONE_LETTERS = "CDEFGHJKLMNPQRSTUVWXX"
-
-def from_latlon(latitude, longitude, force_zone_number=None):
-    if not -80.0 <= latitude <= 84.0:
-        raise ValueError('latitude out of range (must be between 80 deg S and 84 deg N)')
-    if not -180.0 <= longitude <= 180.0:
-        raise ValueError('longitude out of range (must be between 180 deg W and 180 deg E)')
-
-    lat_rad = math.radians(latitude)
-    lat_sin = math.sin(lat_rad)
-    lat_cos = math.cos(lat_rad)
-
-    lat_tan = lat_sin / lat_cos
-    lat_tan2 = lat_tan * lat_tan
-    lat_tan4 = lat_tan2 * lat_tan2
-
-    if force_zone_number is None:
-        zone_number = latlon_to_zone_number(latitude, longitude)
-    else:
-        zone_number = force_zone_number
-
-    zone_letter = latitude_to_zone_letter(latitude)
-
-    lon_rad = math.radians(longitude)
-    central_lon = zone_number_to_central_longitude(zone_number)
-    central_lon_rad = math.radians(central_lon)
-
-    n = R / math.sqrt(1 - E * lat_sin**2)
-    c = E_P2 * lat_cos**2
-
-    a = lat_cos * (lon_rad - central_lon_rad)
-    a2 = a * a
-    a3 = a2 * a
-    a4 = a3 * a
-    a5 = a4 * a
-    a6 = a5 * a
-
-    m = R * (M1 * lat_rad -
-             M2 * math.sin(2 * lat_rad) +
-             M3 * math.sin(4 * lat_rad) -
-             M4 * math.sin(6 * lat_rad))
-
-    easting = K0 * n * (a +
-                        a3 / 6 * (1 - lat_tan2 + c) +
-                        a5 / 120 * (5 - 18 * lat_tan2 + lat_tan4 + 72 * c - 58 * E_P2)) + 500000
-
-    northing = K0 * (m + n * lat_tan * (a2 / 2 +
-                                        a4 / 24 * (5 - lat_tan2 + 9 * c + 4 * c**2) +
-                                        a6 / 720 * (61 - 58 * lat_tan2 + lat_tan4 + 600 * c - 330 * E_P2)))
-
-    if latitude < 0:
-        northing += 10000000
-
-    return easting, northing, zone_number, zone_letter
-
-
-def latitude_to_zone_letter(latitude):
-    if -80 <= latitude <= 84:
-        return ZONE_LETTERS[int(latitude + 80) >> 3]
-    else:
-        return None
-
-
-def latlon_to_zone_number(latitude, longitude):
-    if 56 <= latitude < 64 and 3 <= longitude < 12:
-        return 32
-
-    if 72 <= latitude <= 84 and longitude >= 0:
-        if longitude <= 9:
-            return 31
-        elif longitude <= 21:
-            return 33
-        elif longitude <= 33:
-            return 35
-        elif longitude <= 42:
-            return 37
-
-    return int((longitude + 180) / 6) + 1
-
-
-def zone_number_to_central_longitude(zone_number):
-    return (zone_number - 1) * 6 - 180 + 3
-
-############################################################################
-# End Sudipta's addition
-############################################################################
 
 # Define constants
 a = 6378137.0                   # WGS 84 semi-major axis in meters
@@ -159,28 +52,26 @@ ecc = 1.0 - b / a * b / a       # WGS 84 ellipsoid eccentricity
 todeg = 180.0 / pi        # Converts radians to degrees
 
 # Define functions used to construct image observations
+# Lat, Lon, Zen and Az may be scalars or arrays, vectors are returned stacked on the last axis
 def LOSVec(Lat, Lon, Zen, Az):
-    LSRx = (-sin(Lon), cos(Lon), 0.0)
-    LSRy = (-sin(Lat)*cos(Lon), -sin(Lat)*sin(Lon), cos(Lat))
-    LSRz = (cos(Lat)*cos(Lon), cos(Lat)*sin(Lon), sin(Lat))
-    LOS = (sin(Zen)*sin(Az), sin(Zen)*cos(Az), cos(Zen))
-    Sat = (LOS[0]*LSRx[0] + LOS[1]*LSRy[0] + LOS[2]*LSRz[0],
-            LOS[0]*LSRx[1] + LOS[1]*LSRy[1] + LOS[2]*LSRz[1],
-            LOS[0]*LSRx[2] + LOS[1]*LSRy[2] + LOS[2]*LSRz[2])
-    Rn = a / sqrt(1.0 - ecc *sin(Lat)*sin(Lat))
-    Gx = (Rn*cos(Lat)*cos(Lon),
-            Rn*cos(Lat)*sin(Lon),
-            Rn*(1-ecc)*sin(Lat))
+    LSRx = (-numpy.sin(Lon), numpy.cos(Lon), 0.0)
+    LSRy = (-numpy.sin(Lat)*numpy.cos(Lon), -numpy.sin(Lat)*numpy.sin(Lon), numpy.cos(Lat))
+    LSRz = (numpy.cos(Lat)*numpy.cos(Lon), numpy.cos(Lat)*numpy.sin(Lon), numpy.sin(Lat))
+    LOS = (numpy.sin(Zen)*numpy.sin(Az), numpy.sin(Zen)*numpy.cos(Az), numpy.cos(Zen))
+    Sat = numpy.stack([LOS[0]*LSRx[0] + LOS[1]*LSRy[0] + LOS[2]*LSRz[0],
+                       LOS[0]*LSRx[1] + LOS[1]*LSRy[1] + LOS[2]*LSRz[1],
+                       LOS[0]*LSRx[2] + LOS[1]*LSRy[2] + LOS[2]*LSRz[2]], axis=-1)
+    Gx = GrndVec(Lat, Lon)
     return (Sat, Gx)
 
 def GrndVec(Lat, Lon):
-    Rn = a / sqrt(1.0 - ecc *sin(Lat)*sin(Lat))
-    Gx = (Rn*cos(Lat)*cos(Lon),
-            Rn*cos(Lat)*sin(Lon),
-            Rn*(1-ecc)*sin(Lat))
+    Rn = a / numpy.sqrt(1.0 - ecc *numpy.sin(Lat)*numpy.sin(Lat))
+    Gx = numpy.stack([Rn*numpy.cos(Lat)*numpy.cos(Lon),
+                      Rn*numpy.cos(Lat)*numpy.sin(Lon),
+                      Rn*(1-ecc)*numpy.sin(Lat)], axis=-1)
     return (Gx)
 
-# Inverse (X/Y to lat/long) UTM projection
+# Inverse (X/Y to lat/long) UTM projection, X and Y may be scalars or arrays
 def utm_inv(Zone, X, Y, a=6378137.0, b=6356752.31414):
         if Zone < 0 :
                 FNorth = 10000000.0     # Southern hemisphere False Northing
@@ -197,20 +88,20 @@ def utm_inv(Zone, X, Y, a=6378137.0, b=6356752.31414):
                -ecc*(0.375+ecc*(3.0/32.0+ecc*45.0/1024.0))*sin(2.0*LatOrigin)
                +ecc*ecc*(15.0/256.0+ecc*45.0/1024.0)*sin(4.0*LatOrigin)
                -ecc*ecc*ecc*35.0/3072.0*sin(6.0*LatOrigin))
-        M = M0+(Y-FNorth)/Scale
+        M = M0+(numpy.asarray(Y, dtype=numpy.float64)-FNorth)/Scale
         Mu = M/(a*(1.0-ecc*(0.25+ecc*(3.0/64.0+ecc*5.0/256.0))))
         e1 = (1.0-sqrt(1-ecc))/(1.0+sqrt(1.0-ecc))
-        Phi1 = Mu+(e1*(1.5-27.0/32.0*e1*e1)*sin(2.0*Mu)
-                   +e1*e1*(21.0/16.0-55.0/32.0*e1*e1)*sin(4.0*Mu)
-                   +151.0/96.0*e1*e1*e1*sin(6.0*Mu)
-                   +1097.0/512.0*e1*e1*e1*e1*sin(8.0*Mu))
-        slat = sin(Phi1)
-        clat = cos(Phi1)
-        Rn1 = a/sqrt(1.0-ecc*slat*slat)
+        Phi1 = Mu+(e1*(1.5-27.0/32.0*e1*e1)*numpy.sin(2.0*Mu)
+                   +e1*e1*(21.0/16.0-55.0/32.0*e1*e1)*numpy.sin(4.0*Mu)
+                   +151.0/96.0*e1*e1*e1*numpy.sin(6.0*Mu)
+                   +1097.0/512.0*e1*e1*e1*e1*numpy.sin(8.0*Mu))
+        slat = numpy.sin(Phi1)
+        clat = numpy.cos(Phi1)
+        Rn1 = a/numpy.sqrt(1.0-ecc*slat*slat)
         T1 = slat*slat/clat/clat
         C1 = ep*clat*clat
         R1 = Rn1*(1.0-ecc)/(1.0-ecc*slat*slat)
-        D = (X-FEast)/Rn1/Scale
+        D = (numpy.asarray(X, dtype=numpy.float64)-FEast)/Rn1/Scale
         # Calculate Lat/Lon
         Lat = Phi1 - (Rn1*slat/clat/R1*(D*D/2.0
                         -(5.0+3.0*T1+10.0*C1-4.0*C1*C1-9.0*ep)*D*D*D*D/24.0
@@ -221,166 +112,168 @@ def utm_inv(Zone, X, Y, a=6378137.0, b=6356752.31414):
         return (Lat, Lon)
 
 
+# Observation records used by the orbit and time fits
+OBS_DTYPE = numpy.dtype([('band', numpy.int16), ('det', numpy.int16), ('x', numpy.float64), ('y', numpy.float64),
+                         ('sat', numpy.float64, (3,)), ('gx', numpy.float64, (3,)), ('time', numpy.float64)])
+
+
 def get_angleobs(XML_File):
-    # Parse the XML file
-    tree = ET.parse(XML_File)
-    root = tree.getroot()
-
-    # Find the angles
-    for child in root:
-        if child.tag[-12:] == 'General_Info':
-            geninfo = child
-        if child.tag[-14:] == 'Geometric_Info':
-            geoinfo = child
-
-    for segment in geninfo:
-        if segment.tag == 'TILE_ID':
-            tile_id = segment.text.strip()
-
-    for segment in geoinfo:
-        if segment.tag == 'Tile_Geocoding':
-            frame = segment
-        if segment.tag == 'Tile_Angles':
-            angles = segment
-
-    for box in frame:
-        if box.tag == 'HORIZONTAL_CS_NAME':
-            czone = box.text.strip()[-3:]
-            hemis = czone[-1:]
-            zone = int(czone[:-1])
-        if box.tag == 'Size' and box.attrib['resolution'] == '60':
-            for field in box:
-                if field.tag == 'NROWS':
-                    nrows = int(field.text)
-                if field.tag == 'NCOLS':
-                    ncols = int(field.text)
-        if box.tag == 'Geoposition' and box.attrib['resolution'] == '60':
-            for field in box:
-                if field.tag == 'ULX':
-                    ulx = float(field.text)
-                if field.tag == 'ULY':
-                    uly = float(field.text)
+    metadata = read_tile_metadata(XML_File)
+    tile_id = metadata.tile_id
+    zone = metadata.zone
+    hemis = metadata.hemis
+    (nrows, ncols) = metadata.sizes[60]
+    (ulx, uly) = metadata.geopositions[60]
+    (col_step, row_step) = metadata.view_step
     if hemis == 'S':
         lzone = -zone
     else:
         lzone = zone
-    AngleObs = { 'zone' : zone, 'hemis' : hemis, 'nrows' : nrows, 'ncols' : ncols, 'ul_x' : ulx, 'ul_y' : uly, 'obs' : [] }
-
-    for angle in angles:
-        if angle.tag == 'Viewing_Incidence_Angles_Grids':
-            bandId = int(angle.attrib['bandId'])
-            detectorId = int(angle.attrib['detectorId'])
-            for bset in angle:
-                if bset.tag == 'Zenith':
-                    zenith = bset
-                if bset.tag == 'Azimuth':
-                    azimuth = bset
-            for field in zenith:
-                if field.tag == 'COL_STEP':
-                    col_step = int(field.text)
-                if field.tag == 'ROW_STEP':
-                    row_step = int(field.text)
-                if field.tag == 'Values_List':
-                    zvallist = field
-            for field in azimuth:
-                if field.tag == 'Values_List':
-                    avallist = field
-            for rindex in range(len(zvallist)):
-                zvalrow = zvallist[rindex]
-                avalrow = avallist[rindex]
-                zvalues = zvalrow.text.split(' ')
-                avalues = avalrow.text.split(' ')
-                values = list(zip(zvalues, avalues))
-                ycoord = uly - rindex * row_step
-                for cindex in range(len(values)):
-                    xcoord = ulx + cindex * col_step
-                    (lat, lon) = utm_inv(lzone, xcoord, ycoord)
-                    if (values[cindex][0] != 'NaN' and values[cindex][1] != 'NaN'):
-                        zen = float(values[cindex][0]) / todeg
-                        az = float(values[cindex][1]) / todeg
-                        (Sat, Gx) = LOSVec(lat, lon, zen, az)
-                        observe = [bandId, detectorId, xcoord, ycoord, Sat, Gx]
-                        AngleObs['obs'].append(observe)
+
+    obs = []
+    for (bandId, detectorId), zvalues in metadata.view_zenith.items():
+        avalues = metadata.view_azimuth[(bandId, detectorId)]
+        # The view angle grids share the same sample points, project them once
+        if not obs or zvalues.shape != lat.shape:
+            ycoord = uly - numpy.arange(zvalues.shape[0]) * row_step
+            xcoord = ulx + numpy.arange(zvalues.shape[1]) * col_step
+            (lat, lon) = utm_inv(lzone, xcoord[numpy.newaxis, :], ycoord[:, numpy.newaxis])
+        valid = ~(numpy.isnan(zvalues) | numpy.isnan(avalues))
+        rindex, cindex = numpy.nonzero(valid)
+        (Sat, Gx) = LOSVec(lat[valid], lon[valid], zvalues[valid] / todeg, avalues[valid] / todeg)
+        observe = numpy.zeros(len(rindex), dtype=OBS_DTYPE)
+        observe['band'] = bandId
+        observe['det'] = detectorId
+        observe['x'] = xcoord[cindex]
+        observe['y'] = ycoord[rindex]
+        observe['sat'] = Sat
+        observe['gx'] = Gx
+        obs.append(observe)
+    AngleObs = { 'zone' : zone, 'hemis' : hemis, 'nrows' : nrows, 'ncols' : ncols, 'ul_x' : ulx, 'ul_y' : uly,
+                 'obs' : numpy.concatenate(obs) if obs else numpy.zeros(0, dtype=OBS_DTYPE) }
 
     return (tile_id, AngleObs)
 
 #%%
 
-def get_detfootprint(XML_File):
+def get_detfootprint_files(XML_File):
+    # Detector footprint files (MSK_DETFOO) listed in the tile metadata, as (bandId, path) pairs
+    return sorted(read_tile_metadata(XML_File).footprints.items())
+
+
+def get_detgrid(Foot_File, out_rows, out_cols, step, gsd=None):
+    """Read a raster detector footprint (MSK_DETFOO_Bxx.jp2) as a detector id lookup grid.
+
+    The mask is decoded directly at the angle grid resolution, through a
+    window whose cells are centred on the angle grid samples (the centre of
+    the first band pixel of each step), so each grid cell holds the detector
+    id at its sample point (0 outside every footprint). Samples beyond the
+    edge of the raster take the id of the nearest edge pixel.
+
+    Args:
+        Foot_File (str): path to the detector footprint raster.
+        out_rows (int): number of rows of the angle grid.
+        out_cols (int): number of columns of the angle grid.
+        step (float): angle grid spacing in meters.
+        gsd (float, optional): ground sampling distance of the band. Defaults to the raster resolution.
+
+    Returns:
+        numpy.ndarray: detector ids, shape (out_rows, out_cols).
+    """
+    DetGrid = numpy.zeros((out_rows, out_cols), dtype=numpy.uint8)
+    with rasterio.open(Foot_File) as src:
+        (xres, yres) = (src.res[0], abs(src.res[1]))
+        if gsd is None:
+            gsd = xres
+        # Samples lying on the raster, the window cells being centred on them
+        rows = min(out_rows, int(math.ceil((src.height * yres - gsd / 2) / step)))
+        cols = min(out_cols, int(math.ceil((src.width * xres - gsd / 2) / step)))
+        window = Window((gsd / 2 - step / 2) / xres, (gsd / 2 - step / 2) / yres, cols * step / xres, rows * step / yres)
+        DetGrid[:rows, :cols] = src.read(1, window=window, out_shape=(rows, cols), boundless=True, fill_value=0,
+                                         resampling=Resampling.nearest)
+    # Samples beyond the raster edge take the nearest edge pixel
+    DetGrid[rows:, :cols] = DetGrid[rows - 1, :cols]
+    DetGrid[:, cols:] = DetGrid[:, cols - 1:cols]
+    return DetGrid
+
+
+def get_gmlfootprint(Foot_File, bandId):
+    # Parse the detector polygons of an old format footprint (MSK_DETFOO_BXX.gml)
+    bandfoot = []
+    root = ET.parse(Foot_File).getroot()
+    for feature in root.iter():
+        if feature.tag[-11:] != 'MaskFeature':
+            continue
+        for thisattribute in feature.attrib:
+            if thisattribute[-2:] == 'id':
+                detId = int(feature.attrib[thisattribute].split('-')[2])
+                bandName = feature.attrib[thisattribute].split('-')[1]
+        for poslist in feature.iter():
+            if poslist.tag[-7:] == 'posList':
+                ncoord = int(poslist.attrib['srsDimension'])
+                coords = numpy.array(poslist.text.split(), dtype=numpy.float64).reshape(-1, ncoord)[:, :2]
+                bandfoot.append({ 'detId' : detId, 'bandId' : bandId, 'bandName' : bandName, 'coords' : [tuple(point) for point in coords] })
+    return bandfoot
 
-    # Extract the directory
-    Foot_Dir = os.path.dirname(XML_File)
-    Foot_Dir += '/QI_DATA/'
 
-    # Parse the XML file
-    tree = ET.parse(XML_File)
-    root = tree.getroot()
+def rasterize_detfootprint(BandFoot, band, out_rows, out_cols, ul_x, ul_y, gsd, subsamp):
+    """Burn the detector footprint polygons of a band into a detector bit mask grid.
 
-    # Find the detector footprint files
-    footprints = []
-    for child in root:
-        if child.tag[-23:] == 'Quality_Indicators_Info':
-            qualinfo = child
+    Every detector is burnt on its own layer and sets its bit (1 << detId)
+    on the cells whose sample point falls inside one of its polygons, so
+    overlapping detectors are kept and overlapping polygons of a detector
+    set its bit once.
 
-    for segment in qualinfo:
-        if segment.tag == 'Pixel_Level_QI':
-            pixlevel = segment
+    Args:
+        BandFoot (list): footprint polygons from get_detfootprint.
+        band (int): band id.
+        out_rows (int): number of rows of the angle grid.
+        out_cols (int): number of columns of the angle grid.
+        ul_x (float): tile upper left x coordinate.
+        ul_y (float): tile upper left y coordinate.
+        gsd (float): ground sampling distance of the band.
+        subsamp (int): subsampling factor of the angle grid.
 
-    for qifile in pixlevel:
-        if qifile.tag == 'MASK_FILENAME':
-            if qifile.attrib['type'] == 'MSK_DETFOO':
-                bandId = int(qifile.attrib['bandId'])
-                qifname = Foot_Dir + os.path.basename(qifile.text.strip())
-                footprints.append((bandId, qifname))
+    Returns:
+        numpy.ndarray: detector bit mask, shape (out_rows, out_cols).
+    """
+    step = gsd * subsamp
+    # Cells are centred on the sample points at ul + gsd/2 + index * step
+    transform = Affine(step, 0.0, ul_x + gsd/2.0 - step/2.0, 0.0, -step, ul_y - gsd/2.0 + step/2.0)
+    polygons = {}
+    for foot in BandFoot:
+        if foot['bandId'] == band:
+            polygons.setdefault(foot['detId'], []).append([foot['coords']])
+    DetMask = numpy.zeros((out_rows, out_cols), dtype=numpy.uint16)
+    for (detId, polys) in polygons.items():
+        inside = features.rasterize([{ 'type' : 'MultiPolygon', 'coordinates' : polys }], out_shape=(out_rows, out_cols),
+                                    transform=transform, fill=0, default_value=1, dtype=numpy.uint8)
+        DetMask |= inside.astype(numpy.uint16) << detId
+    return DetMask
+
+
+def DetectorMasks(DetMask):
+    # Split a detector bit mask grid into a boolean mask for each detector
+    bits = int(numpy.bitwise_or.reduce(DetMask, axis=None)) if DetMask.size else 0
+    return [(detId, (DetMask >> detId) & 1 == 1) for detId in range(bits.bit_length()) if (bits >> detId) & 1]
+
+
+def get_detfootprint(XML_File, bands=None):
+    footprints = get_detfootprint_files(XML_File)
 
     bandfoot = []
     for foot in footprints:
         bandId = int(foot[0])
-        bandName = 'B' + str(bandId+1).zfill(2)
+        bandName = BAND_NAMES[bandId]
+        if bands is not None and bandId not in bands:
+            continue
 
         # in the old metadata version foot[1] is the path to a .gml file (e.g. MSK_DETFOO_BXX.gml, for each band XX)
         if foot[1].endswith('.gml'):
-            tree2 = ET.parse(foot[1])
-            root2 = tree2.getroot()
-            for child in root2:
-                if child.tag[-11:] == 'maskMembers':
-                    thismember = child
-                    for feature in thismember:
-                        if feature.tag[-11:] == 'MaskFeature':
-                            for thisattribute in feature.attrib:
-                                if thisattribute[-2:] == 'id':
-                                    detId = int (feature.attrib[thisattribute].split('-')[2])
-                                    bandName = feature.attrib[thisattribute].split('-')[1]
-                                    thisband = { 'detId' : detId , 'bandId' : bandId, 'bandName' : bandName, 'coords' : [] }
-                            thisfeature = feature
-                            for extent in thisfeature:
-                                if extent.tag[-8:] == 'extentOf':
-                                    thisextent = extent
-                                    for polygon in thisextent:
-                                        if polygon.tag[-7:] == 'Polygon':
-                                            thispolygon = polygon
-                                            for exterior in thispolygon:
-                                                if exterior.tag[-8:] == 'exterior':
-                                                    thisexterior = exterior
-                                                    for ring in thisexterior:
-                                                        if ring.tag[-10:] == 'LinearRing':
-                                                            thisring = ring
-                                                            for poslist in thisring:
-                                                                if poslist.tag[-7:] == 'posList':
-                                                                    ncoord = int(poslist.attrib['srsDimension'])
-                                                                    fields = poslist.text.split(' ')
-                                                                    index = 0
-                                                                    for field in fields:
-                                                                        if index == 0:
-                                                                            x = float(field)
-                                                                        elif index == 1:
-                                                                            y = float(field)
-                                                                            thisband['coords'].append((x,y))
-                                                                        index = (index + 1) % ncoord
-                                                                    bandfoot.append(thisband)
+            bandfoot.extend(get_gmlfootprint(foot[1], bandId))
 
         # in the new metadata version foot[1] is the path to a .jp2 file (e.g. MSK_DETFOO_BXX.jp2, for each band XX)
-        elif foot[1].endswith('.jp2') and bandId == 3: # band 4 is the reference
+        elif foot[1].endswith('.jp2'):
             # # uncomment lines if converting bandfoot list to a GeoJSON feature collection
             # import geojson
             # raster_name = os.path.basename(foot[1]).split('.')[0]
@@ -429,263 +322,313 @@ def get_detfootprint(XML_File):
 
 #%%
 
-# Define functions used to construct image observations
-def Magnitude(A):
-        return sqrt(A[0]*A[0] + A[1]*A[1] + A[2]*A[2])
+def Unit_Partial(Ux, Vdist, dPx):
+    # Derivative of the unit view vector for a change dPx of the satellite position
+    return (dPx - Ux * numpy.einsum('...i,...i->...', Ux, dPx)[..., numpy.newaxis]) / Vdist[..., numpy.newaxis]
 
 
-def Dot(A, B):
-        return A[0]*B[0] + A[1]*B[1] + A[2]*B[2]
+def CalcObs(obs, Orbit, Omega0, Lon0, partials=False):
+    """Calculate the view vector residuals of a set of observations.
 
+    Args:
+        obs (numpy.ndarray): observation records (OBS_DTYPE).
+        Orbit (list): reference Lat, reference Lon, Radius, Inclination and Period.
+        Omega0 (float): argument of latitude at the reference time.
+        Lon0 (float): longitude of the ascending node at the reference time.
+        partials (bool, optional): also return the analytic partial derivatives. Defaults to False.
 
-def CalcObs(obs, Orbit, Omega0, Lon0):
-    Vx = [0.0, 0.0, 0.0]
-    ltime = obs[6]
-    Sat = obs[4]
-    Gx = obs[5]
+    Returns:
+        numpy.ndarray: residuals (N, 3), and when partials is set the partial derivatives
+        w.r.t. Lat, Lon, Radius and Inclination (N, 3, 4) and w.r.t. time (N, 3).
+    """
+    ltime = obs['time']
     cta = Omega0 - 2*pi*ltime/Orbit[4]
-    gclat = asin(sin(cta) * sin(Orbit[3]))
-    gclon = Lon0 + asin(tan(gclat) / -tan(Orbit[3])) - 2*pi*ltime/86400
-    Vx[0] = Orbit[2] * cos(gclat) * cos(gclon) - Gx[0]
-    Vx[1] = Orbit[2] * cos(gclat) * sin(gclon) - Gx[1]
-    Vx[2] = Orbit[2] * sin(gclat) - Gx[2]
-    Vdist = Magnitude(Vx)
-    Vx[0] = Vx[0] / Vdist - Sat[0]
-    Vx[1] = Vx[1] / Vdist - Sat[1]
-    Vx[2] = Vx[2] / Vdist - Sat[2]
-    return Vx
-
-
-def Partial_O(obs, Orbit):
-    P0 = numpy.zeros((3,4))
-    Omega0 = asin(sin(Orbit[0]) / sin(Orbit[3]))
-    Lon0 = Orbit[1] - asin(tan(Orbit[0]) / -tan(Orbit[3]))
-    Dx = CalcObs(obs, Orbit, Omega0, Lon0)
-    POrb = Orbit
-    Pert = [0.00001, 0.00001, 10.0, 0.0001]    # Perturbations to Lat, Lon, Radius, and Inclination
-    for index in range(len(Pert)):
-        POrb[index] += Pert[index]
-        Omega0 = asin(sin(POrb[0]) / sin(POrb[3]))
-        Lon0 = POrb[1] - asin(tan(POrb[0]) / -tan(POrb[3]))
-        Dp = CalcObs(obs, POrb, Omega0, Lon0)
-        P0[0, index] = (Dp[0] - Dx[0])/Pert[index]
-        P0[1, index] = (Dp[1] - Dx[1])/Pert[index]
-        P0[2, index] = (Dp[2] - Dx[2])/Pert[index]
-        POrb[index] -= Pert[index]
-
-    return P0
-
-
-def Partial_T(obs, Orbit):
-    P1 = [0.0, 0.0, 0.0]
-    Omega0 = asin(sin(Orbit[0]) / sin(Orbit[3]))
-    Lon0 = Orbit[1] - asin(tan(Orbit[0]) / -tan(Orbit[3]))
-    Dx = CalcObs(obs, Orbit, Omega0, Lon0)
-    Pobs = obs
-    Pert = 0.1        # Time perturbation
-    Pobs[6] += Pert
-    Dp = CalcObs(Pobs, Orbit, Omega0, Lon0)
-    P1[0] = (Dp[0] - Dx[0])/Pert
-    P1[1] = (Dp[1] - Dx[1])/Pert
-    P1[2] = (Dp[2] - Dx[2])/Pert
-    Pobs[6] -= Pert
+    gclat = numpy.arcsin(numpy.sin(cta) * sin(Orbit[3]))
+    ltan = numpy.tan(gclat) / -tan(Orbit[3])
+    gclon = Lon0 + numpy.arcsin(ltan) - 2*pi*ltime/86400
+    Px = Orbit[2] * numpy.stack([numpy.cos(gclat) * numpy.cos(gclon),
+                                 numpy.cos(gclat) * numpy.sin(gclon),
+                                 numpy.sin(gclat)], axis=-1)
+    Vx = Px - obs['gx']
+    Vdist = numpy.sqrt(numpy.einsum('ij,ij->i', Vx, Vx))
+    Ux = Vx / Vdist[:, numpy.newaxis]
+    if not partials:
+        return Ux - obs['sat']
+
+    # Chain rule through the satellite position, first w.r.t. geocentric lat/lon
+    dP_dlat = Orbit[2] * numpy.stack([-numpy.sin(gclat) * numpy.cos(gclon),
+                                      -numpy.sin(gclat) * numpy.sin(gclon),
+                                      numpy.cos(gclat)], axis=-1)
+    dP_dlon = Orbit[2] * numpy.stack([-numpy.cos(gclat) * numpy.sin(gclon),
+                                      numpy.cos(gclat) * numpy.cos(gclon),
+                                      numpy.zeros_like(gclat)], axis=-1)
+    dlat_dcta = numpy.cos(cta) * sin(Orbit[3]) / numpy.cos(gclat)
+    dlon_dlat = -1.0 / (numpy.cos(gclat)**2 * tan(Orbit[3])) / numpy.sqrt(1.0 - ltan*ltan)
+    dlon_dinc = numpy.tan(gclat) / sin(Orbit[3])**2 / numpy.sqrt(1.0 - ltan*ltan)
+    # Reference terms Omega0 and Lon0 also depend on the reference Lat and the Inclination
+    rtan = tan(Orbit[0]) / -tan(Orbit[3])
+    dOmega_dlat0 = cos(Orbit[0]) / sin(Orbit[3]) / cos(Omega0)
+    dOmega_dinc = -sin(Orbit[0]) * cos(Orbit[3]) / sin(Orbit[3])**2 / cos(Omega0)
+    dLon0_dlat0 = 1.0 / (cos(Orbit[0])**2 * tan(Orbit[3])) / sqrt(1.0 - rtan*rtan)
+    dLon0_dinc = -tan(Orbit[0]) / sin(Orbit[3])**2 / sqrt(1.0 - rtan*rtan)
+
+    P0 = numpy.zeros((len(obs), 3, 4))
+    dlat = dlat_dcta * dOmega_dlat0
+    P0[:, :, 0] = Unit_Partial(Ux, Vdist, dP_dlat * dlat[:, numpy.newaxis]
+                               + dP_dlon * (dLon0_dlat0 + dlon_dlat * dlat)[:, numpy.newaxis])
+    P0[:, :, 1] = Unit_Partial(Ux, Vdist, dP_dlon)
+    P0[:, :, 2] = Unit_Partial(Ux, Vdist, Px / Orbit[2])
+    dlat = dlat_dcta * dOmega_dinc + numpy.sin(cta) * cos(Orbit[3]) / numpy.cos(gclat)
+    P0[:, :, 3] = Unit_Partial(Ux, Vdist, dP_dlat * dlat[:, numpy.newaxis]
+                               + dP_dlon * (dLon0_dinc + dlon_dlat * dlat + dlon_dinc)[:, numpy.newaxis])
+    dlat = dlat_dcta * -2*pi/Orbit[4]
+    P1 = Unit_Partial(Ux, Vdist, dP_dlat * dlat[:, numpy.newaxis]
+                      + dP_dlon * (dlon_dlat * dlat - 2*pi/86400)[:, numpy.newaxis])
+
+    return (Ux - obs['sat'], P0, P1)
+
+
+def Fit_Time(ul_x, ul_y, Obs, numband=13, numdet=13):
+    """Fit the observation time model of every band and detector.
+
+    The time of each observation is modelled as a bilinear function of its
+    offset from the tile upper left corner. The normal equations of all the
+    band/detector groups are accumulated in a single pass over the observations.
 
-    return P1
+    Args:
+        ul_x (float): tile upper left x coordinate.
+        ul_y (float): tile upper left y coordinate.
+        Obs (numpy.ndarray): observation records (OBS_DTYPE) with fitted times.
+        numband (int, optional): number of bands. Defaults to 13.
+        numdet (int, optional): number of detector slots, slot 0 holds the band average. Defaults to 13.
 
+    Returns:
+        list: one dict per band with the time model coefficients ('tmodel', shape (numdet, 4)),
+        the RMS of the fit in seconds ('rms') and the number of observations ('numobs').
+    """
+    dx = Obs['x'] - ul_x
+    dy = ul_y - Obs['y']
+    Basis = numpy.stack([numpy.ones_like(dx), dx, dy, dx*dy], axis=-1)
+    group = Obs['band'].astype(numpy.intp) * numdet + Obs['det']
+    ngroups = numband * numdet
+    Outer = (Basis[:, :, numpy.newaxis] * Basis[:, numpy.newaxis, :]).reshape(-1, 16)
+    A0 = numpy.stack([numpy.bincount(group, weights=Outer[:, k], minlength=ngroups) for k in range(16)], axis=-1)
+    L0 = numpy.stack([numpy.bincount(group, weights=Basis[:, k] * Obs['time'], minlength=ngroups) for k in range(4)], axis=-1)
+    A0 = A0.reshape(numband, numdet, 4, 4)
+    L0 = L0.reshape(numband, numdet, 4)
+    # Detector 0 is the band average solution which is used to strengthen detectors with few points
+    A0[:, 0] = A0.sum(axis=1)
+    L0[:, 0] = L0.sum(axis=1)
 
-def Fit_Time(ul_x, ul_y, Obs):
     Time_Parms = []
-    for band in range(13):
-        TParm_List = []
-        for sca in range(13):
-            A0 = numpy.matrix(numpy.zeros((4, 4)))
-            L0 = numpy.matrix(numpy.zeros((4, 1)))
-            X0 = numpy.matrix(numpy.zeros((4, 1)))
-            for los in Obs:
-                if los[0] == band and (sca == 0 or los[1] == sca):
-                    dx = los[2] - ul_x
-                    dy = ul_y - los[3]
-                    A0[0,0] += 1.0
-                    A0[0,1] += dx
-                    A0[0,2] += dy
-                    A0[0,3] += dx*dy
-                    L0[0,0] += los[6]
-                    A0[1,0] += dx
-                    A0[1,1] += dx*dx
-                    A0[1,2] += dx*dy
-                    A0[1,3] += dx*dx*dy
-                    L0[1,0] += dx*los[6]
-                    A0[2,0] += dy
-                    A0[2,1] += dy*dx
-                    A0[2,2] += dy*dy
-                    A0[2,3] += dy*dx*dy
-                    L0[2,0] += dy*los[6]
-                    A0[3,0] += dx*dy
-                    A0[3,1] += dx*dy*dx
-                    A0[3,2] += dx*dy*dy
-                    A0[3,3] += dx*dy*dx*dy
-                    L0[3,0] += dx*dy*los[6]
-            # Detector 0 is the band average solution which is used to strengthen detectors with few points
-            if sca == 0:
-                A0all = A0
-                L0all = L0
+    for band in range(numband):
+        TParm_List = numpy.zeros((numdet, 4))
+        for sca in range(numdet):
+            A0det = A0[band, sca].copy()
+            L0det = L0[band, sca].copy()
             # Make sure we have a valid solution for this detector
             try:
-                A0inv = A0**-1
+                A0inv = numpy.linalg.inv(A0det)
             # Bring in the band average data for the rate terms
-            except:
-                if A0[0,0] < 1.0:
-                    A0[0,0] = 1.0
-                A0[1,1] = A0all[1,1]
-                A0[1,2] = A0all[1,2]
-                A0[1,3] = A0all[1,3]
-                A0[2,1] = A0all[2,1]
-                A0[2,2] = A0all[2,2]
-                A0[2,3] = A0all[2,3]
-                A0[3,1] = A0all[3,1]
-                A0[3,2] = A0all[3,2]
-                A0[3,3] = A0all[3,3]
-                L0[1,0] = L0all[1,0]
-                L0[2,0] = L0all[2,0]
-                L0[3,0] = L0all[3,0]
-                A0inv = A0**-1
-            X0 = A0inv * L0
-            TParm_List.append(list(X0))
-        this_time = { 'band' : band, 'tmodel' : TParm_List }
-        Time_Parms.append(this_time)
+            except numpy.linalg.LinAlgError:
+                if A0det[0, 0] < 1.0:
+                    A0det[0, 0] = 1.0
+                A0det[1:, 1:] = A0[band, 0, 1:, 1:]
+                L0det[1:] = L0[band, 0, 1:]
+                try:
+                    A0inv = numpy.linalg.inv(A0det)
+                except numpy.linalg.LinAlgError:
+                    A0inv = numpy.linalg.pinv(A0det)
+            TParm_List[sca] = A0inv @ L0det
 
         # Calculate fit statistic
-        rmsfit = 0
-        numobs = 0
-        coeffs = TParm_List
-        for los in Obs:
-            if los[0] == band:
-                det = los[1]
-                dx = los[2] - ul_x
-                dy = ul_y - los[3]
-                dt = coeffs[det][0] + coeffs[det][1]*dx + coeffs[det][2]*dy + coeffs[det][3]*dx*dy - los[6]
-                numobs += 1
-                rmsfit += dt*dt
+        inband = Obs['band'] == band
+        numobs = int(numpy.count_nonzero(inband))
+        rmsfit = None
         if numobs > 0:
-            rmsfit = sqrt(rmsfit / numobs)
-            logging.info('Time fit for band ',band,' RMS = ',rmsfit,' seconds')
+            dt = numpy.einsum('ij,ij->i', Basis[inband], TParm_List[Obs['det'][inband]]) - Obs['time'][inband]
+            rmsfit = sqrt(numpy.dot(dt, dt) / numobs)
+            logging.info('Time fit for band %d RMS = %f seconds', band, rmsfit)
+        Time_Parms.append({ 'band' : band, 'tmodel' : TParm_List, 'rms' : rmsfit, 'numobs' : numobs })
 
     return Time_Parms
 
 
-def Fit_Orbit(AngleObs):
+def Shift_Orbit(Orbit, Lat):
+    """Move the reference point of an orbit along its track.
+
+    Args:
+        Orbit (list): reference Lat, reference Lon, Radius, Inclination and Period.
+        Lat (float): new reference latitude in radians.
+
+    Returns:
+        list: the same orbit referenced at the point of its track at Lat.
+    """
+    Omega0 = asin(sin(Orbit[0]) / sin(Orbit[3]))
+    Lon0 = Orbit[1] - asin(tan(Orbit[0]) / -tan(Orbit[3]))
+    cta = asin(max(-1.0, min(1.0, sin(Lat) / sin(Orbit[3]))))
+    Lat = asin(sin(cta) * sin(Orbit[3]))
+    ltime = (Omega0 - cta) * Orbit[4] / (2*pi)
+    Lon = Lon0 + asin(tan(Lat) / -tan(Orbit[3])) - 2*pi*ltime/86400
+    return [Lat, Lon, Orbit[2], Orbit[3], Orbit[4]]
+
+
+# LOS residual RMS (radians) within which a cached orbit is used without refinement, about 0.2 arcsecond.
+# The orbit fitted on 23LLF fits its view angles within 7.5e-9 (1.5e-9 moved along the track), while an
+# orbit radius 200m off leaves 2.3e-5; the angles are written in hundredths of a degree (1.7e-4).
+ORBIT_LOS_TOL = 1e-6
+
+
+def Fit_Orbit(AngleObs, max_iter=100, orbit0=None, los_tol=None):
+    """Reconstruct the orbit and the observation times from the view angles.
+
+    Args:
+        AngleObs (dict): angle observations from get_angleobs.
+        max_iter (int, optional): maximum number of Gauss-Newton iterations. Defaults to 100.
+        orbit0 (list, optional): orbit fitted on another tile of the same datatake, moved along its track
+            to this tile and used as starting point. Defaults to an orbit estimated from the view vectors.
+        los_tol (float, optional): keep orbit0 as is, fitting the observation times only, when their LOS
+            residual RMS is within los_tol. Defaults to None, always refining the orbit.
+
+    Returns:
+        list, list, dict: fitted orbit, time model parameters for each band and
+        the convergence report of the orbit fit.
+    """
     # Initialize the orbit parameters
     Orbit = [0.0, 0.0, 7169868.175, 98.62/todeg, 6041.958]    # Reference Lat, Reference Lon, Radius, Inclination, Period
-    Orbit0 = [0.0, 0.0, 7169868.175, 98.62/todeg, 6041.958]    # Reference Lat, Reference Lon, Radius, Inclination, Period
 
     # Load the angle records
     ul_x = AngleObs['ul_x']
     ul_y = AngleObs['ul_y']
-    Obs = []
-    numobs = 0
-    for viewrec in AngleObs['obs']:
-        numobs += 1
-        # Construct observation record
-        Sat = [viewrec[4][0],  viewrec[4][1], viewrec[4][2]]
-        Gx =  viewrec[5]
-        Obs.append([viewrec[0], viewrec[1], viewrec[2], viewrec[3], viewrec[4], viewrec[5], 0.0])
-        # Project the view vector out to the satellite orbital radius
-        Gmag = Magnitude(Gx)
-        Vdot = Dot(Sat, Gx)
-        Vdist = sqrt(Orbit[2]*Orbit[2] + Vdot*Vdot - Gmag*Gmag)
-        Px = [Gx[0]+Sat[0]*Vdist, Gx[1]+Sat[1]*Vdist, Gx[2]+Sat[2]*Vdist]
-        Orbit[1] += atan2(Px[1], Px[0])
-        Orbit[0] += atan(Px[2] / sqrt(Px[0]*Px[0] + Px[1]*Px[1]))
-
-    Orbit[1] /= numobs
-    Orbit[0] /= numobs
-    Orbit0[0] = Orbit[0]
-    Orbit0[1] = Orbit[1]
+    Obs = AngleObs['obs'].copy()
+    numobs = len(Obs)
+    # Project the view vectors out to the satellite orbital radius
+    Sat = Obs['sat']
+    Gx = Obs['gx']
+    Gmag = numpy.sqrt(numpy.einsum('ij,ij->i', Gx, Gx))
+    Vdot = numpy.einsum('ij,ij->i', Sat, Gx)
+    Vdist = numpy.sqrt(Orbit[2]*Orbit[2] + Vdot*Vdot - Gmag*Gmag)
+    Px = Gx + Sat * Vdist[:, numpy.newaxis]
+    Orbit[1] = float(numpy.mean(numpy.arctan2(Px[:, 1], Px[:, 0])))
+    Orbit[0] = float(numpy.mean(numpy.arctan(Px[:, 2] / numpy.hypot(Px[:, 0], Px[:, 1]))))
+    if orbit0 is not None:
+        Orbit = Shift_Orbit(orbit0, Orbit[0])
+    # With a starting orbit, first fit the observation times only
+    fixed = orbit0 is not None and los_tol is not None
 
     #Iterate solution for orbital parameters and observation times
     convtol = 0.001        # 1 millisecond RMS time correction
     rmstime = 15.0
     orbtol = 1.0
     orbrss = 1000.0
-    first_iter = 0
+    iteration = 0
     logging.info('Reconstructing Orbit from View Angles')
     while rmstime > convtol or orbrss > orbtol:
-        AngResid = 0.0
+        if iteration == max_iter:
+            logging.warning('Orbit fit did not converge after %d iterations', max_iter)
+            break
         Omega0 = asin(sin(Orbit[0]) / sin(Orbit[3]))
         Lon0 = Orbit[1] - asin(tan(Orbit[0]) / -tan(Orbit[3]))
-        A0 = numpy.matrix(numpy.zeros((4, 4)))
-        L0 = numpy.matrix(numpy.zeros((4, 1)))
-        X0 = numpy.matrix(numpy.zeros((4, 1)))
-        M1 = numpy.matrix(numpy.zeros((4, 1)))
-        BackSub = []
-        for los in Obs:
-            Vx = CalcObs(los, Orbit, Omega0, Lon0)
-            AngResid += Dot(Vx, Vx)
-            V0 = numpy.matrix(numpy.array(Vx)).reshape(3,1)
-            # Calculate the partial derivatives w.r.t. the orbit parameters
-            P0 = Partial_O(los, Orbit)
-            P0t = numpy.matrix(numpy.transpose(P0))
-            P0 = numpy.matrix(P0)
-            A0 = A0 + P0t * P0
-            L0 = L0 + P0t * V0
-            P1 = Partial_T(los, Orbit)
-            M1 = P0t * numpy.matrix(numpy.array(P1)).reshape(3,1)
-            A1 = 1.0 / Dot(P1, P1)
-            L1 = Dot(P1, Vx) * A1
-            M1t = A1 * M1.reshape(1,4)
-            A0 = A0 + M1 * M1t
-            L0 = L0 + M1 * L1
-            BackSub.append([L1, M1 * A1])
+        # Residuals and partial derivatives w.r.t. the orbit parameters and the time of every observation
+        (Vx, P0, P1) = CalcObs(Obs, Orbit, Omega0, Lon0, partials=True)
+        AngResid = numpy.einsum('ij,ij->', Vx, Vx)
+        M1 = numpy.einsum('nki,nk->ni', P0, P1)
+        A1 = 1.0 / numpy.einsum('ij,ij->i', P1, P1)
+        L1 = numpy.einsum('ij,ij->i', P1, Vx) * A1
+        A0 = numpy.einsum('nki,nkj->ij', P0, P0) + numpy.einsum('n,ni,nj->ij', A1, M1, M1)
+        L0 = numpy.einsum('nki,nk->i', P0, Vx) + numpy.einsum('ni,n->i', M1, L1)
         # Solve for Orbital parameter corrections
-        if first_iter == 0:
-            X0 = numpy.matrix(numpy.zeros((4, 1)))
-            first_iter = 1
+        if iteration == 0 or fixed:
+            X0 = numpy.zeros(4)
         else:
-            X0 = (A0**-1) * L0
+            X0 = numpy.linalg.solve(A0, L0)
         # Back Substitute for Time Corrections
-        rmstime = 0.0
-        for index in range(len(Obs)):
-            dtime = BackSub[index][0] - Dot(BackSub[index][1], X0)
-            rmstime += dtime * dtime
-            Obs[index][6] -= dtime
+        dtime = L1 - A1 * (M1 @ X0)
+        Obs['time'] -= dtime
         # Update Orbit Parameters
-        Orbit[0] -= X0[0,0]
-        Orbit[1] -= X0[1,0]
-        Orbit[2] -= X0[2,0]
-        Orbit[3] -= X0[3,0]
+        Orbit[0] -= X0[0]
+        Orbit[1] -= X0[1]
+        Orbit[2] -= X0[2]
+        Orbit[3] -= X0[3]
         # Evaluate Observation Residual RMS
         AngResid = sqrt(AngResid / numobs)
         # Evaluate Convergence
-        rmstime = sqrt(rmstime / numobs)
+        rmstime = sqrt(numpy.dot(dtime, dtime) / numobs)
         # Orbit Convergence
-        X0[0,0] *= 6378137.0
-        X0[1,0] *= 6378137.0
-        X0[3,0] *= Orbit[2]
-        orbrss = sqrt(X0[0,0]*X0[0,0] + X0[1,0]*X0[1,0] + X0[2,0]*X0[2,0] + X0[3,0]*X0[3,0])
-
-    logging.info('Lat    = ', Orbit[0]*todeg)
-    logging.info('Lon    = ', Orbit[1]*todeg)
-    logging.info('Radius = ', Orbit[2])
-    logging.info('Incl   = ', Orbit[3]*todeg)
-    logging.info('RMS Orbit Fit (meters): ', orbrss)
-    logging.info('RMS Time Fit (seconds): ', rmstime)
-    logging.info('RMS LOS Residual: ', AngResid)
+        orbrss = sqrt((X0[0]*6378137.0)**2 + (X0[1]*6378137.0)**2 + X0[2]**2 + (X0[3]*Orbit[2])**2)
+        iteration += 1
+        # Refine the starting orbit when it does not fit the converged observation times
+        if fixed and rmstime <= convtol and AngResid > los_tol:
+            logging.info('Starting orbit LOS residual %f above tolerance, refining it', AngResid)
+            fixed = False
+            orbrss = 1000.0
+
+    Orbit = [float(parm) for parm in Orbit]
+    FitReport = { 'iterations' : iteration, 'converged' : rmstime <= convtol and orbrss <= orbtol,
+                  'orbit_rss' : orbrss, 'time_rms' : rmstime, 'los_rms' : AngResid,
+                  'warm_start' : orbit0 is not None, 'orbit_fixed' : fixed }
+
+    logging.info('Lat    = %f', Orbit[0]*todeg)
+    logging.info('Lon    = %f', Orbit[1]*todeg)
+    logging.info('Radius = %f', Orbit[2])
+    logging.info('Incl   = %f', Orbit[3]*todeg)
+    logging.info('RMS Orbit Fit (meters): %f', orbrss)
+    logging.info('RMS Time Fit (seconds): %f', rmstime)
+    logging.info('RMS LOS Residual: %f', AngResid)
+    logging.info('Orbit fit iterations: %d', iteration)
 
     logging.info('Fitting Tile Observation Times')
 
     Time_Parms = Fit_Time(ul_x, ul_y, Obs)
 
-    return (Orbit, Time_Parms)
+    return (Orbit, Time_Parms, FitReport)
 
 
 def CalcOrbit(ltime, Orbit):
+    ltime = numpy.asarray(ltime, dtype=numpy.float64)
     cta = Orbit[5] - 2*pi*ltime/Orbit[4]
-    gclat = asin(sin(cta) * sin(Orbit[3]))
-    gclon = Orbit[6] + asin(tan(gclat) / -tan(Orbit[3])) - 2*pi*ltime/86400
-    Px = [Orbit[2]*cos(gclat)*cos(gclon), Orbit[2]*cos(gclat)*sin(gclon), Orbit[2]*sin(gclat)]
+    gclat = numpy.arcsin(numpy.sin(cta) * sin(Orbit[3]))
+    gclon = Orbit[6] + numpy.arcsin(numpy.tan(gclat) / -tan(Orbit[3])) - 2*pi*ltime/86400
+    Px = numpy.stack([Orbit[2]*numpy.cos(gclat)*numpy.cos(gclon),
+                      Orbit[2]*numpy.cos(gclat)*numpy.sin(gclon),
+                      Orbit[2]*numpy.sin(gclat)], axis=-1)
     return Px
 
 
+def CalcViewAngles(Gx, calctime, Orbit):
+    """Calculate view zenith and azimuth for a set of ground points.
+
+    The satellite position is evaluated for every observation time at once,
+    the line of sight is normalized and projected into the local
+    east/north/up frame of each ground point.
+
+    Args:
+        Gx (numpy.ndarray): ground ECEF vectors, shape (..., 3).
+        calctime (numpy.ndarray): observation times from the time model, shape (...).
+        Orbit (list): fitted orbit, including Omega0 and Lon0.
+
+    Returns:
+        numpy.ndarray, numpy.ndarray: zenith and azimuth in hundredths of degree, rounded.
+    """
+    Px = CalcOrbit(calctime, Orbit)
+    Vx = Px - Gx
+    Vx /= numpy.sqrt(numpy.einsum('...i,...i->...', Vx, Vx))[..., None]
+    LSRz = Gx / numpy.array([a, a, b])
+    Vlen = numpy.hypot(LSRz[..., 0], LSRz[..., 1])
+    # LSRx = (-z1, z0, 0) / Vlen and LSRy = LSRz x LSRx
+    LSRx0 = -LSRz[..., 1] / Vlen
+    LSRx1 = LSRz[..., 0] / Vlen
+    LSRy0 = -LSRz[..., 2] * LSRx1
+    LSRy1 = LSRz[..., 2] * LSRx0
+    LSRy2 = LSRz[..., 0] * LSRx1 - LSRz[..., 1] * LSRx0
+    east = Vx[..., 0] * LSRx0 + Vx[..., 1] * LSRx1
+    north = Vx[..., 0] * LSRy0 + Vx[..., 1] * LSRy1 + Vx[..., 2] * LSRy2
+    up = numpy.einsum('...i,...i->...', Vx, LSRz)
+    zenith = numpy.round(numpy.arccos(up) * todeg * 100.0)
+    azimuth = numpy.round(numpy.arctan2(east, north) * todeg * 100.0)
+    return zenith, azimuth
+
+
 #def CalcGroundVectors(AngleObs, gsd, subsamp, nrows, ncols):
 # sudipta changed above to support spatial subset
 def CalcGroundVectors(AngleObs, gsd, subsamp, start_row, end_row, start_col, end_col, out_rows, out_cols):
@@ -697,20 +640,52 @@ def CalcGroundVectors(AngleObs, gsd, subsamp, start_row, end_row, start_col, end
         zone *= -1
     #for row in range(nrows):
     # sudipta changed above to support spatial subset
-    for row in range(int(start_row), int(end_row)):
-        y = ul_y - float(row * gsd * subsamp) - gsd/2.0
-        #for col in range(ncols):
-        # sudipta changed above to support spatial subset
-        for col in range(start_col, end_col):
-            x = ul_x + float(col * gsd * subsamp) + gsd/2.0
-            (lat, lon) = utm_inv(zone, x, y)
-            Gx = GrndVec(lat, lon)
-            GVecs[row,col,0] = Gx[0]
-            GVecs[row,col,1] = Gx[1]
-            GVecs[row,col,2] = Gx[2]
+    rows = numpy.arange(int(start_row), int(end_row))
+    cols = numpy.arange(int(start_col), int(end_col))
+    y = ul_y - (rows * gsd * subsamp).astype(numpy.float64) - gsd/2.0
+    x = ul_x + (cols * gsd * subsamp).astype(numpy.float64) + gsd/2.0
+    (lat, lon) = utm_inv(zone, x[numpy.newaxis, :], y[:, numpy.newaxis])
+    GVecs[int(start_row):int(end_row), int(start_col):int(end_col)] = GrndVec(lat, lon)
+    return GVecs
+
+
+# Number of ground vector grids kept in memory, a 10m grid taking 29 MB
+GVECS_CACHE_SIZE = 4
+
+
+@lru_cache(maxsize=GVECS_CACHE_SIZE)
+def _ground_vectors(ul_x, ul_y, zone, hemis, gsd, subsamp, out_rows, out_cols, directory):
+    AngleObs = { 'ul_x' : ul_x, 'ul_y' : ul_y, 'zone' : zone, 'hemis' : hemis }
+    grid = (gsd, subsamp, 0, out_rows, 0, out_cols, out_rows, out_cols)
+    if directory is None:
+        GVecs = CalcGroundVectors(AngleObs, *grid)
+    else:
+        GVecs = cache.cached_array(directory, 'gvecs', (ul_x, ul_y, zone, hemis) + grid,
+                                   lambda: CalcGroundVectors(AngleObs, *grid))
+    GVecs.flags.writeable = False
     return GVecs
 
 
+def CachedGroundVectors(AngleObs, gsd, subsamp, out_rows, out_cols, cache_dir=None):
+    """Ground vectors of a whole angle grid, cached as they only depend on the tile and the grid.
+
+    The most recent grids are kept in memory and, with a cache directory, stored
+    as .npy files memory-mapped on load, so every acquisition of a tile reuses them.
+
+    Args:
+        AngleObs (dict): angle observations from get_angleobs, for the tile corner and UTM zone.
+        gsd (int): ground sampling distance of the band.
+        subsamp (int): subsampling factor of the angle grid.
+        out_rows, out_cols (int): size of the grid.
+        cache_dir (str, optional): cache directory. Defaults to the S2ANGS_CACHE_DIR environment variable.
+
+    Returns:
+        numpy.ndarray: read-only (out_rows, out_cols, 3) ground vectors.
+    """
+    return _ground_vectors(float(AngleObs['ul_x']), float(AngleObs['ul_y']), int(AngleObs['zone']), AngleObs['hemis'],
+                           gsd, subsamp, int(out_rows), int(out_cols), cache.cache_dir(cache_dir))
+
+
 def WriteHeader(Out_File, out_rows, out_cols, ul_x, ul_y, gsd, zone, n_or_s):
     Hdr_File = Out_File + '.hdr'
     if n_or_s == 'S':
@@ -736,217 +711,290 @@ def WriteHeader(Out_File, out_rows, out_cols, ul_x, ul_y, gsd, zone, n_or_s):
     return Hdr_File
 
 #%%
-def s2_sensor_angs(XML_File, imgref, va_path, vz_path, gsd=[60, 10, 10, 10, 20, 20, 20, 10, 20, 60, 60, 20, 20], subsamp=10):
+def fit_view_model(Tile_ID, AngleObs, cache_dir=None, los_tol=ORBIT_LOS_TOL):
     """
-    Calculate sensor angles (azimuth and zenith) for Sentinel-2 satellite imagery.
-    Note : it only create a raster based on B04 (bandId 3) observations.
+    Fit the orbit and the detector observation time models of a tile on its view angles.
+
+    Args:
+        Tile_ID (str): TILE_ID of the tile.
+        AngleObs (dict): angle observations from get_angleobs.
+        cache_dir (str, optional): cache directory of the orbits fitted on the tiles of each datatake, used as
+            starting point of the orbit fit. Defaults to the S2ANGS_CACHE_DIR environment variable, unset disabling it.
+        los_tol (float, optional): LOS residual RMS within which a cached orbit is kept as is, None always refining
+            it. Defaults to ORBIT_LOS_TOL.
+
+    Returns:
+        list, list: orbit (reference Lat, reference Lon, Radius, Inclination, Period, Omega0 and Lon0) and the time
+            models of each band (see Fit_Time).
+    """
+    # Start from the cached orbit of another tile of the datatake
+    orbit_dir = cache.cache_dir(cache_dir)
+    orbit_key = cache.orbit_key(Tile_ID) if orbit_dir is not None else None
+    orbit0 = None
+    if orbit_key is not None:
+        lzone = -AngleObs['zone'] if AngleObs['hemis'] == 'S' else AngleObs['zone']
+        (lat, _) = utm_inv(lzone, AngleObs['ul_x'] + AngleObs['ncols'] * 30, AngleObs['ul_y'] - AngleObs['nrows'] * 30)
+        orbit0 = cache.nearest_orbit(orbit_dir, orbit_key, float(lat))
+    (Orbit, TimeParms, FitReport) = Fit_Orbit(AngleObs, orbit0=orbit0, los_tol=los_tol)
+    if orbit_key is not None and FitReport['converged'] and not FitReport['orbit_fixed']:
+        cache.save_orbit(orbit_dir, orbit_key, Tile_ID, Orbit, FitReport['los_rms'])
+    Omega0 = asin(sin(Orbit[0]) / sin(Orbit[3]))
+    Orbit.append(Omega0)
+    Lon0 = Orbit[1] - asin(tan(Orbit[0]) / -tan(Orbit[3]))
+    Orbit.append(Lon0)
+    return (Orbit, TimeParms)
+
+
+def angle_grid_shape(AngleObs, gsd, subsamp):
+    # Number of rows and columns of the angle grid of a band, sampled every gsd * subsamp meters
+    out_rows = int(AngleObs['nrows'] * 60 / gsd / subsamp)
+    out_cols = int(AngleObs['ncols'] * 60 / gsd / subsamp)
+    if subsamp > 1:
+        out_rows += 1
+        out_cols += 1
+    return (out_rows, out_cols)
+
+
+def detector_grids(XML_File, AngleObs, bands, gsd, subsamp=10, detfoo_raster=True):
+    """
+    Read the detector footprints of bands on their angle grids.
+
+    Args:
+        XML_File (str): Path to MTD_TL.xml.
+        AngleObs (dict): angle observations from get_angleobs, for the tile corner and size.
+        bands (list): bandIds (0 to 12).
+        gsd (list): Ground sampling distance for each band.
+        subsamp (int, optional): Subsampling factor. Defaults to 10.
+        detfoo_raster (bool, optional): Read raster detector footprints (MSK_DETFOO_Bxx.jp2) at the angle grid
+            resolution as a detector lookup instead of polygonizing them. Defaults to True.
+
+    Returns:
+        dict: bandId -> detector bit mask of the angle grid samples (bit d set where detector d sees them).
+    """
+    # Raster footprints are read per band at the angle grid resolution
+    FootFiles = dict(get_detfootprint_files(XML_File))
+    BandFoot = None
+    if not detfoo_raster or not all(foot.endswith('.jp2') for foot in FootFiles.values()):
+        BandFoot = get_detfootprint(XML_File, bands=bands)
+        logging.info('Loaded detector footprints from QI files')
+
+    DetMasks = {}
+    for band in bands:
+        (out_rows, out_cols) = angle_grid_shape(AngleObs, gsd[band], subsamp)
+        if BandFoot is None:
+            DetGrid = get_detgrid(FootFiles[band], out_rows, out_cols, gsd[band] * subsamp, gsd[band])
+            logging.info('Loaded detector footprint raster for band %d', band)
+            DetMasks[band] = numpy.where(DetGrid > 0, numpy.left_shift(1, DetGrid, dtype=numpy.uint16), 0)
+        else:
+            DetMasks[band] = rasterize_detfootprint(BandFoot, band, out_rows, out_cols, AngleObs['ul_x'], AngleObs['ul_y'],
+                                                    gsd[band], subsamp)
+    return DetMasks
+
+
+def SampleGroundVectors(AngleObs, gsd, subsamp, rows, cols):
+    # Ground vectors of samples of an angle grid, given by their row and column indexes
+    zone = -AngleObs['zone'] if AngleObs['hemis'] == 'S' else AngleObs['zone']
+    y = AngleObs['ul_y'] - (rows * gsd * subsamp).astype(numpy.float64) - gsd/2.0
+    x = AngleObs['ul_x'] + (cols * gsd * subsamp).astype(numpy.float64) + gsd/2.0
+    (lat, lon) = utm_inv(zone, x, y)
+    return GrndVec(lat, lon)
+
+
+def view_angle_samples(Orbit, coeffs, DetMask, gsd, subsamp, rows, cols, Gx):
+    """
+    Calculate the view angles of a band at samples of its angle grid, averaging the detectors seeing them.
+
+    Args:
+        Orbit (list): fitted orbit, including Omega0 and Lon0.
+        coeffs (numpy.ndarray): time model coefficients of each detector of the band.
+        DetMask (numpy.ndarray): detector bit mask of the angle grid, see detector_grids.
+        gsd (int): ground sampling distance of the band.
+        subsamp (int): subsampling factor of the angle grid.
+        rows, cols (numpy.ndarray): row and column indexes of the samples.
+        Gx (numpy.ndarray): ground ECEF vectors of the samples, shape (n, 3).
+
+    Returns:
+        numpy.ndarray, numpy.ndarray: zenith and azimuth of the samples in hundredths of a degree, NaN out of all
+            detector footprints.
+    """
+    zenith = numpy.zeros(len(rows))
+    azimuth = numpy.zeros(len(rows))
+    detcount = numpy.zeros(len(rows), dtype=numpy.intc)
+    for (detId, inside) in DetectorMasks(DetMask[rows, cols]):
+        logging.info('Scanning detector %d', detId)
+        dx = cols[inside] * float(gsd * subsamp)
+        dy = rows[inside] * float(gsd * subsamp)
+        coeff = numpy.asarray(coeffs[detId], dtype=numpy.float64).ravel()
+        calctime = coeff[0] + coeff[1]*dx + coeff[2]*dy + coeff[3]*dx*dy
+        zen, az = CalcViewAngles(Gx[inside], calctime, Orbit)
+        zenith[inside] += zen
+        azimuth[inside] += az
+        detcount[inside] += 1
+    # Average the samples seen by overlapping detectors, samples out of all footprints have no value
+    overlap = detcount > 1
+    zenith[overlap] /= detcount[overlap]
+    azimuth[overlap] /= detcount[overlap]
+    zenith[detcount == 0] = numpy.nan
+    azimuth[detcount == 0] = numpy.nan
+    return zenith, azimuth
+
+
+def view_angle_grid(AngleObs, Orbit, coeffs, DetMask, gsd, subsamp=10, bounds=None, cache_dir=None):
+    """
+    Calculate the view angle (zenith and azimuth) grids of a band, in hundredths of a degree.
+
+    Args:
+        AngleObs (dict): angle observations from get_angleobs, for the tile corner and UTM zone.
+        Orbit (list): fitted orbit, including Omega0 and Lon0.
+        coeffs (numpy.ndarray): time model coefficients of each detector of the band.
+        DetMask (numpy.ndarray): detector bit mask of the angle grid, see detector_grids.
+        gsd (int): ground sampling distance of the band.
+        subsamp (int, optional): Subsampling factor. Defaults to 10.
+        bounds (tuple, optional): left, bottom, right and top, in the tile crs, of the area to compute. Only the
+            grid samples needed to interpolate the angles over it are computed, the others being NaN.
+            Defaults to the whole tile.
+        cache_dir (str, optional): cache directory of the ground vectors of each tile grid, only used without
+            bounds. Defaults to the S2ANGS_CACHE_DIR environment variable, unset disabling it.
+
+    Returns:
+        numpy.ndarray, numpy.ndarray, Affine: zenith and azimuth grids (NaN out of all detector footprints), sampled
+            every gsd * subsamp meters, and their affine transform.
+    """
+    (out_rows, out_cols) = DetMask.shape
+
+    # Spatial subset, only the grid samples surrounding bounds are computed
+    if bounds is not None:
+        step = gsd * subsamp
+        (left, bottom, right, top) = bounds
+        x0 = AngleObs['ul_x'] + gsd / 2
+        y0 = AngleObs['ul_y'] - gsd / 2
+        ul_s_c = max(0, int(math.floor((left - x0) / step)))
+        ul_s_r = max(0, int(math.floor((y0 - top) / step)))
+        lr_s_c = min(out_cols, int(math.ceil((right - x0) / step)) + 1)
+        lr_s_r = min(out_rows, int(math.ceil((y0 - bottom) / step)) + 1)
+    else:
+        ul_s_r = 0
+        ul_s_c = 0
+        lr_s_r = out_rows
+        lr_s_c = out_cols
+
+    logging.info(f"ul_s_r = {ul_s_r}, ul_s_c = {ul_s_c}, lr_s_r = {lr_s_r}, lr_s_c = {lr_s_c}")
+
+    (rows, cols) = numpy.mgrid[ul_s_r:lr_s_r, ul_s_c:lr_s_c]
+    (rows, cols) = (rows.ravel(), cols.ravel())
+    # Whole grids share the cached ground vectors of the tile, subsets only compute their own samples
+    if bounds is None:
+        Gx = CachedGroundVectors(AngleObs, gsd, subsamp, out_rows, out_cols, cache_dir)[rows, cols]
+    else:
+        Gx = SampleGroundVectors(AngleObs, gsd, subsamp, rows, cols)
+    zenith = numpy.full((out_rows, out_cols), numpy.nan)
+    azimuth = numpy.full((out_rows, out_cols), numpy.nan)
+    (zenith[rows, cols], azimuth[rows, cols]) = view_angle_samples(Orbit, coeffs, DetMask, gsd, subsamp, rows, cols, Gx)
+
+    # The angle grid samples are at the centre of their first pixel
+    step = gsd * subsamp
+    angs_aff = Affine(step, 0, AngleObs['ul_x'] + gsd / 2 - step / 2,
+                      0, -step, AngleObs['ul_y'] - gsd / 2 + step / 2)
+    return zenith, azimuth, angs_aff
+
+
+#%%
+def sensor_angle_grids(XML_File, gsd=[60, 10, 10, 10, 20, 20, 20, 10, 20, 60, 60, 20, 20], subsamp=10, detfoo_raster=True, bands=None,
+                       cache_dir=None, bounds=None):
+    """
+    Calculate the sensor angle (zenith and azimuth) grids of Sentinel-2 bands, in hundredths of a degree.
+    The orbit is fitted once for all bands, and bands sharing a resolution share their ground vectors.
 
     Args:
         XML_File (str): Path to the XML file containing angle observations metadata.
-        imgref (str): Path to the reference image.
-        va_path (str): Path to save the azimuth angle output.
-        vz_path (str): Path to save the zenith angle output.
         gsd (list, optional): Ground sampling distance for each band. Defaults to [60, 10, 10, 10, 20, 20, 20, 10, 20, 60, 60, 20, 20].
         subsamp (int, optional): Subsampling factor. Defaults to 10.
+        detfoo_raster (bool, optional): Read raster detector footprints (MSK_DETFOO_Bxx.jp2) at the angle grid
+            resolution as a detector lookup instead of polygonizing them. Defaults to True.
+        bands (list, optional): bandIds (0 to 12) to compute. Defaults to [3] (B04).
+        cache_dir (str, optional): cache directory of the orbits fitted on the tiles of each datatake, used as
+            starting point of the orbit fit, and of the ground vectors of each tile grid. Defaults to the
+            S2ANGS_CACHE_DIR environment variable, unset disabling it.
+        bounds (tuple, optional): left, bottom, right and top, in the tile crs, of the area to compute. Only the
+            grid samples needed to interpolate the angles over it are computed, the others being NaN.
+            Defaults to the whole tile.
 
     Returns:
-        None
+        dict: bandId -> (zenith, azimuth, transform), the grids (NaN out of all detector footprints), sampled every
+            gsd * subsamp meters, and their affine transform.
     """
-
-    # # Sudipta spatial subset setting
-    sul_lat = sul_lon = slr_lat = slr_lon = None
+    if bands is None:
+        bands = [3]
 
     # Load the angle observations from the metadata
     (Tile_ID, AngleObs) = get_angleobs(XML_File)
-    Tile_Base = Tile_ID.split('.')
-    logging.info('Loaded view angles from metadata for tile: ', Tile_ID)
+    logging.info('Loaded view angles from metadata for tile: %s', Tile_ID)
 
     # Reconstruct the Orbit from the Angles
-    (Orbit, TimeParms) = Fit_Orbit(AngleObs)
-    Omega0 = asin(sin(Orbit[0]) / sin(Orbit[3]))
-    Orbit.append(Omega0)
-    Lon0 = Orbit[1] - asin(tan(Orbit[0]) / -tan(Orbit[3]))
-    Orbit.append(Lon0)
-
+    (Orbit, TimeParms) = fit_view_model(Tile_ID, AngleObs, cache_dir)
     logging.info('Orbit processing complete')
 
-    # Load the detector footprints
-    BandFoot = get_detfootprint(XML_File)
-    logging.info('Loaded detector footprints from QI files')
+    # Load the detector footprints of each band on its angle grid
+    DetMasks = detector_grids(XML_File, AngleObs, bands, gsd, subsamp, detfoo_raster)
 
     # Loop through the bands using TimeParms which are in band order
+    ViewGrids = {}
     for tparms in TimeParms:
         band = tparms['band']
-        if band ==3:
-            coeffs = tparms['tmodel']
-            # Set up the output array
-            out_rows = int(AngleObs['nrows'] * 60 / gsd[band] / subsamp)
-            out_cols = int(AngleObs['ncols'] * 60 / gsd[band] / subsamp)
-            if subsamp > 1:
-                out_rows += 1
-                out_cols += 1
-
-            #######################################################
-            ## Sudipta addition to support spatial subset
-            ######################################################
-            if (sul_lat is not None):
-                # Convert the spatial subset bbox lat, lon to UTM coords.
-                ul_sx,ul_sy,_,_ = from_latlon(sul_lat, sul_lon)
-                lr_sx,lr_sy,_,_ = from_latlon(slr_lat, slr_lon)
-
-                # now calculate the bbox row, col pairs
-                ulx = AngleObs['ul_x']
-                uly = AngleObs['ul_y']
-                ul_s_c = max(0,int((ul_sx - ulx)/gsd[band]/subsamp))
-                ul_s_r = max(0,int((uly - ul_sy)/gsd[band]/subsamp))
-                lr_s_c = min(out_cols,int((lr_sx - ulx)/gsd[band]/subsamp))
-                lr_s_r = min(out_rows,int((uly - lr_sy)/gsd[band]/subsamp))
-            else:
-                ul_s_r = 0
-                ul_s_c = 0
-                lr_s_r = out_rows
-                lr_s_c = out_cols
-
-            logging.info(f"ul_s_r = {ul_s_r}, ul_s_c = {ul_s_c}, lr_s_r = {lr_s_r}, lr_s_c = {lr_s_c}")
-            #sys.exit(0)
-            #######################################################
-            ## Sudipta addition to support spatial subset
-            ######################################################
-
-            #GVecs = CalcGroundVectors(AngleObs, gsd[band], subsamp, out_rows, out_cols)
-            # sudipta changed above to support spatial subset
-            GVecs = CalcGroundVectors(AngleObs, gsd[band], subsamp, ul_s_r, lr_s_r, ul_s_c, lr_s_c, out_rows, out_cols)
-            zenith = numpy.zeros((out_rows, out_cols))
-            azimuth = numpy.zeros((out_rows, out_cols))
-            detcount = numpy.matrix(numpy.zeros((out_rows, out_cols)))
-            # Find the detector footprints for this band
-            for foot in BandFoot:
-                if foot['bandId'] == band:
-                    detId = foot['detId']
-                    bandName = foot['bandName']
-                    logging.info('Scanning band ', band, ' detector ', detId)
-                    minloc = [foot['coords'][0][0], foot['coords'][0][1]]
-                    maxloc = [foot['coords'][0][0], foot['coords'][0][1]]
-                    for pointloc in foot['coords']:
-                        if pointloc[0] < minloc[0]:
-                            minloc[0] = pointloc[0]
-                        if pointloc[0] > maxloc[0]:
-                            maxloc[0] = pointloc[0]
-                        if pointloc[1] < minloc[1]:
-                            minloc[1] = pointloc[1]
-                        if pointloc[1] > maxloc[1]:
-                            maxloc[1] = pointloc[1]
-                    segs = []
-                    for index in range(len(foot['coords'])-1):
-                        point0 = foot['coords'][index]
-                        point1 = foot['coords'][index+1]
-                        if point1[1] == point0[1]:
-                            slope = 0.0
-                            intercept = point0[0]
-                        else:
-                            slope = (point1[0] -  point0[0]) / (point1[1] - point0[1])
-                            intercept = point0[0] - slope * point0[1]
-                        if point1[1] < point0[1]:
-                            ymin = point1[1]
-                            ymax = point0[1]
-                        else:
-                            ymin = point0[1]
-                            ymax = point1[1]
-                        segs.append({ 'y0' : point0[1], 'ymin' : ymin, 'ymax' : ymax, 'slope' : slope, 'intercept' : intercept })
-                    # Scan the array
-                    #for row in range(out_rows):
-                    # sudipta changed above to support spatial subset
-                    for row in range(ul_s_r, lr_s_r):
-                        dy = float(row*gsd[band]*subsamp)
-                        y = AngleObs['ul_y'] - dy - gsd[band]/2.0
-                        if y < minloc[1] or y > maxloc[1]:
-                            continue
-                        xlist = []
-                        for seg in segs:
-                            if y == seg['y0'] or (y > seg['ymin'] and y < seg['ymax']):
-                                x = seg['intercept'] + y * seg['slope']
-                                xlist.append(x)
-                        xlist.sort()
-                        if len(xlist)%2 > 0:
-                            logging.info('Invalid footprint intersection')
-                            break
-                        #for col in range(out_cols):
-                        # sudipta changed above to support spatial subset
-                        for col in range(ul_s_c, lr_s_c):
-                            dx = float(col*gsd[band]*subsamp)
-                            x = AngleObs['ul_x'] + dx + gsd[band]/2.0
-                            if x < minloc[0] or x > maxloc[0]:
-                                continue
-                            # See if this point is inside the footprint
-                            index = 0
-                            while index < len(xlist):
-                                if x >= xlist[index] and x < xlist[index+1]:
-                                    # It is
-                                    calctime = coeffs[detId][0] + coeffs[detId][1]*dx + coeffs[detId][2]*dy + coeffs[detId][3]*dx*dy
-                                    detcount[row,col] += 1
-                                    Px = CalcOrbit(calctime, Orbit)
-                                    Gx = [GVecs[row,col,0], GVecs[row,col,1], GVecs[row,col,2]]
-                                    Vx = [Px[0]-Gx[0], Px[1]-Gx[1], Px[2]-Gx[2]]
-                                    Vlen = Magnitude(Vx)
-                                    Vx = [Vx[0]/Vlen, Vx[1]/Vlen, Vx[2]/Vlen]
-                                    LSRz = [Gx[0]/a, Gx[1]/a, Gx[2]/b]
-                                    Vlen = sqrt(LSRz[0]*LSRz[0] + LSRz[1]*LSRz[1])
-                                    LSRx = [-LSRz[1]/Vlen, LSRz[0]/Vlen, 0.0]
-                                    LSRy = [LSRz[1]*LSRx[2]-LSRz[2]*LSRx[1], LSRz[2]*LSRx[0]-LSRz[0]*LSRx[2], LSRz[0]*LSRx[1]-LSRz[1]*LSRx[0]]
-                                    LSRVec = [Dot(Vx, LSRx), Dot(Vx, LSRy), Dot(Vx, LSRz)]
-                                    zenith[row,col] += round(acos(LSRVec[2]) * todeg * 100.0)
-                                    azimuth[row,col] +=  round(atan2(LSRVec[0], LSRVec[1]) * todeg * 100.0)
-                                    if detcount[row,col] > 1:
-                                        zenith[row,col] /= detcount[row,col]
-                                        azimuth[row,col] /= detcount[row,col]
-                                    index = len(xlist)
-                                else:
-                                    index += 2
-
-            src_dataset = rasterio.open(imgref)
-
-            profile = src_dataset.profile
-            profile.update(nodata=-9999)
-
-            #Azimuth
-            azimuth = resize(azimuth,(profile['width'], profile['height']))
-            azimuth = (azimuth).astype(numpy.intc)
-
-            new_dataset = rasterio.open(
-                va_path,
-                'w',
-                driver='GTiff',
-                height=profile['height'],
-                width=profile['width'],
-                count=profile['count'],
-                dtype=numpy.intc,
-                crs=profile['crs'],
-                transform=profile['transform'],
-                nodata=profile['nodata'],
-                compress='deflate'
-            )
-            new_dataset.write(azimuth, 1)
-            new_dataset.close()
-
-            #Zenith
-            zenith = resize(zenith,(profile['width'], profile['height']))
-            zenith = (zenith).astype(numpy.intc)
-
-            new_dataset = rasterio.open(
-                vz_path,
-                'w',
-                driver='GTiff',
-                height=profile['height'],
-                width=profile['width'],
-                count=profile['count'],
-                dtype=numpy.intc,
-                crs=profile['crs'],
-                transform=profile['transform'],
-                nodata=profile['nodata'],
-                compress='deflate'
-            )
-            new_dataset.write(zenith, 1)
-            new_dataset.close()
+        if band in bands:
+            ViewGrids[band] = view_angle_grid(AngleObs, Orbit, tparms['tmodel'], DetMasks[band], gsd[band], subsamp,
+                                              bounds, cache_dir)
+
+    return ViewGrids
+
+
+def s2_sensor_angs(XML_File, imgref, va_path, vz_path, gsd=[60, 10, 10, 10, 20, 20, 20, 10, 20, 60, 60, 20, 20], subsamp=10, detfoo_raster=True, bands=None, output_profile=None, bounds=None):
+    """
+    Calculate sensor angles (azimuth and zenith) for Sentinel-2 satellite imagery.
+    Note : by default it only create a raster based on B04 (bandId 3) observations.
+    The orbit is fitted once for all bands, and bands sharing a resolution share their ground vectors and output grid.
+
+    Args:
+        XML_File (str): Path to the XML file containing angle observations metadata.
+        imgref (ReferenceGrid or str): Reference 10m grid, or path to the reference image (only its header is read).
+        va_path (str or dict): Path to save the azimuth angle output, or bandId -> path when several bands are requested.
+        vz_path (str or dict): Path to save the zenith angle output, or bandId -> path when several bands are requested.
+        gsd (list, optional): Ground sampling distance for each band. Defaults to [60, 10, 10, 10, 20, 20, 20, 10, 20, 60, 60, 20, 20].
+        subsamp (int, optional): Subsampling factor. Defaults to 10.
+        detfoo_raster (bool, optional): Read raster detector footprints (MSK_DETFOO_Bxx.jp2) at the angle grid
+            resolution as a detector lookup instead of polygonizing them. Defaults to True.
+        bands (list, optional): bandIds (0 to 12) to generate, each at its native gsd. Defaults to [3] (B04).
+        output_profile (str or OutputProfile, optional): data type, layout and compression of the outputs,
+            see s2angs.output.OUTPUT_PROFILES. Defaults to int32 deflate strips.
+        bounds (tuple, optional): left, bottom, right and top, in the tile crs, of the area to write (widened to the
+            60m grid). Defaults to the whole tile.
+
+    Returns:
+        str or dict, str or dict: va_path and vz_path.
+    """
+    if bands is None:
+        bands = [3]
+    if len(bands) > 1 and not (isinstance(va_path, dict) and isinstance(vz_path, dict)):
+        raise ValueError('va_path and vz_path must map each bandId to a path when several bands are requested')
+
+    # Reference grids are computed once per resolution
+    grid10 = imgref if isinstance(imgref, ReferenceGrid) else reference_grid(imgref=imgref)
+    if bounds is not None:
+        grid10 = crop_grid(grid10, bounds)
+        bounds = grid_bounds(grid10)
+    Grids = {}
+
+    ViewGrids = sensor_angle_grids(XML_File, gsd, subsamp, detfoo_raster, bands, bounds=bounds)
+    for band, (zenith, azimuth, angs_aff) in ViewGrids.items():
+        # Upsample to the band grid
+        if gsd[band] not in Grids:
+            Grids[gsd[band]] = scale_grid(grid10, gsd[band])
+        grid = Grids[gsd[band]]
+        band_va_path = va_path[band] if isinstance(va_path, dict) else va_path
+        band_vz_path = vz_path[band] if isinstance(vz_path, dict) else vz_path
+        for (angles, path, is_azimuth) in ((azimuth, band_va_path, True), (zenith, band_vz_path, False)):
+            write_angles(path, grid, lambda window: upsample_window(angles, angs_aff, grid.transform, window),
+                         output_profile, azimuth=is_azimuth)
 
     return va_path, vz_path
 
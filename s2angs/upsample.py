@@ -0,0 +1,164 @@
+#
+# This file is part of Brazil Data Cube Sentinel-2 Angle Bands.
+# Copyright (C) 2022 INPE.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+
+"""Separable bilinear upsampling of coarse angle grids onto image grids."""
+
+# 3rdparty
+import numpy
+from rasterio.windows import Window
+
+
+def row_windows(dataset, max_pixels=2**20):
+    """Split a dataset into windows of whole rows aligned to its blocks.
+
+    Parameters:
+       dataset (DatasetWriter): open rasterio dataset.
+       max_pixels (int): approximate number of pixels per window.
+    Returns:
+       generator of Window: windows covering the dataset top to bottom.
+    """
+    block_rows = dataset.block_shapes[0][0]
+    rows = max(block_rows, max_pixels // dataset.width // block_rows * block_rows)
+    for row_off in range(0, dataset.height, rows):
+        yield Window(0, row_off, dataset.width, min(rows, dataset.height - row_off))
+
+
+def axis_weights(src_first, src_step, src_size, dst_first, dst_step, dst_size):
+    """Bilinear interpolation weights along one axis.
+
+    Source sample i lies at src_first + i * src_step and output pixel j at
+    dst_first + j * dst_step. Outputs beyond the outer source samples take the
+    value of the edge sample.
+
+    Parameters:
+       src_first (float): coordinate of the first source sample.
+       src_step (float): distance between source samples.
+       src_size (int): number of source samples.
+       dst_first (float): coordinate of the first output pixel.
+       dst_step (float): distance between output pixels.
+       dst_size (int): number of output pixels.
+    Returns:
+       int, arr: index of the first source sample used and the (dst_size, k) weight matrix over the k samples used.
+    """
+    pos = (dst_first + numpy.arange(dst_size) * dst_step - src_first) / src_step
+    pos = numpy.clip(pos, 0, src_size - 1)
+    low = numpy.minimum(numpy.floor(pos).astype(int), max(src_size - 2, 0))
+    frac = pos - low
+    first = int(low.min())
+    last = min(int(low.max()) + 1, src_size - 1)
+    weights = numpy.zeros((dst_size, last - first + 1))
+    index = numpy.arange(dst_size)
+    weights[index, low - first] = 1 - frac
+    if src_size > 1:
+        weights[index, low + 1 - first] += frac
+    return first, weights
+
+
+def upsample_window(array, src_transform, dst_transform, window, max_cols=1024):
+    """Bilinear upsampling of a coarse grid over a window of a finer grid.
+
+    Values of array are taken at its pixel centres, both grids being located
+    by their (north-up) affine transforms. The window is computed as products
+    of small row and column weight matrices, in chunks of at most max_cols
+    columns. Missing values (NaN) are left out of the interpolation and the
+    remaining weights renormalized; pixels without valid samples are NaN.
+
+    Parameters:
+       array (arr): coarse grid.
+       src_transform (Affine): transform of the coarse grid.
+       dst_transform (Affine): transform of the fine grid.
+       window (Window): window of the fine grid to compute.
+       max_cols (int): maximum number of columns computed at once.
+    Returns:
+       arr: upsampled values within window.
+    """
+    array = numpy.asarray(array, dtype=numpy.float64)
+    valid = ~numpy.isnan(array)
+    values = numpy.where(valid, array, 0)
+
+    (row_start, row_stop), (col_start, col_stop) = window.toranges()
+    row_first, row_weights = axis_weights(src_transform.f + src_transform.e / 2, src_transform.e, array.shape[0],
+                                          dst_transform.f + dst_transform.e * (row_start + 0.5), dst_transform.e,
+                                          row_stop - row_start)
+    rows = slice(row_first, row_first + row_weights.shape[1])
+
+    out = numpy.empty((row_stop - row_start, col_stop - col_start))
+    for col_off in range(col_start, col_stop, max_cols):
+        ncols = min(max_cols, col_stop - col_off)
+        col_first, col_weights = axis_weights(src_transform.c + src_transform.a / 2, src_transform.a, array.shape[1],
+                                              dst_transform.c + dst_transform.a * (col_off + 0.5), dst_transform.a,
+                                              ncols)
+        cols = slice(col_first, col_first + col_weights.shape[1])
+        chunk = out[:, col_off - col_start:col_off - col_start + ncols]
+        chunk[:] = row_weights @ values[rows, cols] @ col_weights.T
+        if not valid[rows, cols].all():
+            norm = row_weights @ valid[rows, cols] @ col_weights.T
+            chunk[:] = numpy.where(norm > 1e-6, chunk / numpy.maximum(norm, 1e-6), numpy.nan)
+    return out
+
+
+def axis_points(src_first, src_step, src_size, coords):
+    """Bilinear interpolation indexes and weights of points along one axis.
+
+    Source sample i lies at src_first + i * src_step. As in axis_weights,
+    points beyond the outer source samples take the value of the edge sample.
+
+    Parameters:
+       src_first (float): coordinate of the first source sample.
+       src_step (float): distance between source samples.
+       src_size (int): number of source samples.
+       coords (arr): coordinates of the points.
+    Returns:
+       arr, arr: index of the first of the two source samples used by each point and the weight of the second.
+    """
+    pos = (numpy.asarray(coords, dtype=numpy.float64) - src_first) / src_step
+    pos = numpy.clip(pos, 0, src_size - 1)
+    low = numpy.minimum(numpy.floor(pos).astype(int), max(src_size - 2, 0))
+    return low, pos - low
+
+
+def interpolate_points(array, transform, xs, ys):
+    """Bilinear interpolation of a coarse grid at points.
+
+    The conventions of upsample_window apply: values of array are taken at
+    its pixel centres, missing values (NaN) are left out of the interpolation
+    and the remaining weights renormalized.
+
+    Parameters:
+       array (arr): coarse grid.
+       transform (Affine): transform of the coarse grid.
+       xs (arr): x coordinates of the points.
+       ys (arr): y coordinates of the points, same shape as xs.
+    Returns:
+       arr: interpolated values, NaN for points without valid samples.
+    """
+    array = numpy.asarray(array, dtype=numpy.float64)
+    rows, row_frac = axis_points(transform.f + transform.e / 2, transform.e, array.shape[0], ys)
+    cols, col_frac = axis_points(transform.c + transform.a / 2, transform.a, array.shape[1], xs)
+    next_rows = numpy.minimum(rows + 1, array.shape[0] - 1)
+    next_cols = numpy.minimum(cols + 1, array.shape[1] - 1)
+
+    total = numpy.zeros(rows.shape)
+    norm = numpy.zeros(rows.shape)
+    for row_index, row_weight in ((rows, 1 - row_frac), (next_rows, row_frac)):
+        for col_index, col_weight in ((cols, 1 - col_frac), (next_cols, col_frac)):
+            values = array[row_index, col_index]
+            weights = numpy.where(numpy.isnan(values), 0, row_weight * col_weight)
+            total += numpy.where(weights > 0, values, 0) * weights
+            norm += weights
+    return numpy.where(norm > 1e-6, total / numpy.maximum(norm, 1e-6), numpy.nan)
@@ -18,4 +18,4 @@
 
 """Version information for Python Client Library for Sentinel-2 Angle Bands."""
 
-__version__ = '0.5.1'
\ No newline at end of file
+__version__ = '0.6.0'
\ No newline at end of file
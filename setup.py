@@ -63,7 +63,6 @@ install_requires = [
     'Click>=7.0',
     'numpy',
     'rasterio',
-    'scikit-image'
 ]
 
 packages = find_packages()
@@ -94,6 +93,9 @@ setup(
     include_package_data=True,
     platforms='any',
     entry_points={
+        'console_scripts': [
+            's2angs = s2angs.cli:cli',
+        ],
     },
     extras_require=extras_require,
     install_requires=install_requires,
@@ -16,4 +16,880 @@
 # along with this program. If not, see <https://www.gnu.org/licenses/gpl-3.0.html>.
 #
 
-"""Unit-test for Python Client Library for Sentinel-2 Angle Bands."""
\ No newline at end of file
+"""Unit-test for Python Client Library for Sentinel-2 Angle Bands."""
+
+import os
+from math import acos, asin, atan2, cos, pi, radians, sin, sqrt, tan
+from zipfile import ZipFile
+
+import numpy
+import pytest
+import rasterio
+from click.testing import CliRunner
+from rasterio.crs import CRS
+from rasterio.transform import Affine
+from rasterio.warp import transform, transform_bounds
+from rasterio.windows import Window
+
+from s2angs import angles_at, batch, cache, detector_ids, gen_s2_ang, manifest, s2_angs
+from s2angs.batch import batch_workers, estimate_scene_memory, gen_s2_ang_batch
+from s2angs.cache import CACHE_DIR_ENV
+from s2angs.cli import cli
+from s2angs.metadata import BAND_RESOLUTIONS, ReferenceGrid, angle_grid_transform, crop_grid, grid_bounds, scale_grid
+from s2angs.model import MODEL_VERSION, AngleModel
+from s2angs.output import OUTPUT_PROFILES, encode_angles, write_angles
+from s2angs.s2_angs import compute_s2_angles, iter_s2_angles, resample_anglebands, zip_product_files
+from s2angs.s2_sensor_angs.s2_sensor_angs import (OBS_DTYPE, ORBIT_LOS_TOL, CachedGroundVectors, CalcGroundVectors,
+                                                    CalcObs, CalcViewAngles, Fit_Orbit, Fit_Time, GrndVec, LOSVec,
+                                                    _ground_vectors, angle_grid_shape, detector_grids,
+                                                    fit_view_model, get_angleobs, get_detgrid, rasterize_detfootprint,
+                                                    utm_inv, view_angle_grid)
+from s2angs.upsample import upsample_window
+from s2angs.version import __version__
+
+# CRS and 10m grid of tile 23LLF
+TILE_CRS = CRS.from_epsg(32723)
+TILE_GRID = ReferenceGrid(width=10980, height=10980, transform=Affine(10, 0, 399960, 0, -10, 8400040), crs=TILE_CRS)
+
+# Descending Sentinel-2 like orbit near 23LLF: reference Lat, Lon, Radius, Inclination and Period
+ORBIT = [radians(-14.9), radians(-45.2), 7167000.0, radians(98.57), 6035.9]
+
+
+def _view_orbit(orbit):
+    """Append Omega0 and Lon0 to an orbit, as fit_view_model does."""
+    omega0 = asin(sin(orbit[0]) / sin(orbit[3]))
+    lon0 = orbit[1] - asin(tan(orbit[0]) / -tan(orbit[3]))
+    return list(orbit) + [omega0, lon0]
+
+
+def _view_angles_reference(orbit, coeffs, detmask, gsd, subsamp, gvecs):
+    """View angles of every grid sample, scanned pixel by pixel as before the detectors were vectorized."""
+    (a, b) = (6378137.0, 6356752.314)
+    zenith = numpy.zeros(detmask.shape)
+    azimuth = numpy.zeros(detmask.shape)
+    detcount = numpy.zeros(detmask.shape, dtype=int)
+    for det in range(1, 13):
+        for (row, col) in zip(*numpy.nonzero(detmask & (1 << det))):
+            dx = float(col * gsd * subsamp)
+            dy = float(row * gsd * subsamp)
+            calctime = coeffs[det][0] + coeffs[det][1] * dx + coeffs[det][2] * dy + coeffs[det][3] * dx * dy
+            cta = orbit[5] - 2 * pi * calctime / orbit[4]
+            gclat = asin(sin(cta) * sin(orbit[3]))
+            gclon = orbit[6] + asin(tan(gclat) / -tan(orbit[3])) - 2 * pi * calctime / 86400
+            Px = [orbit[2] * cos(gclat) * cos(gclon), orbit[2] * cos(gclat) * sin(gclon), orbit[2] * sin(gclat)]
+            Gx = list(gvecs[row, col])
+            Vx = [Px[0] - Gx[0], Px[1] - Gx[1], Px[2] - Gx[2]]
+            Vlen = sqrt(Vx[0] * Vx[0] + Vx[1] * Vx[1] + Vx[2] * Vx[2])
+            Vx = [Vx[0] / Vlen, Vx[1] / Vlen, Vx[2] / Vlen]
+            LSRz = [Gx[0] / a, Gx[1] / a, Gx[2] / b]
+            Vlen = sqrt(LSRz[0] * LSRz[0] + LSRz[1] * LSRz[1])
+            LSRx = [-LSRz[1] / Vlen, LSRz[0] / Vlen, 0.0]
+            LSRy = [LSRz[1] * LSRx[2] - LSRz[2] * LSRx[1], LSRz[2] * LSRx[0] - LSRz[0] * LSRx[2],
+                    LSRz[0] * LSRx[1] - LSRz[1] * LSRx[0]]
+            east = sum(v * x for (v, x) in zip(Vx, LSRx))
+            north = sum(v * y for (v, y) in zip(Vx, LSRy))
+            up = sum(v * z for (v, z) in zip(Vx, LSRz))
+            detcount[row, col] += 1
+            zenith[row, col] += round(acos(up) * 180.0 / pi * 100.0)
+            azimuth[row, col] += round(atan2(east, north) * 180.0 / pi * 100.0)
+            if detcount[row, col] > 1:
+                zenith[row, col] /= detcount[row, col]
+                azimuth[row, col] /= detcount[row, col]
+    zenith[detcount == 0] = numpy.nan
+    azimuth[detcount == 0] = numpy.nan
+    return zenith, azimuth
+
+
+def test_view_angle_grid():
+    """The vectorized view angles match the per pixel scan, overlapping detectors being averaged."""
+    angle_obs = dict(zone=23, hemis='S', nrows=20, ncols=20, ul_x=399960.0, ul_y=8400040.0)
+    (gsd, subsamp) = (20, 10)
+    (rows, cols) = angle_grid_shape(angle_obs, gsd, subsamp)
+    coeffs = numpy.zeros((13, 4))
+    coeffs[2] = [-0.5, 1e-5, 1.5e-4, 0.0]
+    coeffs[3] = [0.5, 1.1e-5, 1.5e-4, 1e-12]
+    detmask = numpy.zeros((rows, cols), dtype=numpy.uint16)
+    detmask[:, :cols // 2 + 1] |= 1 << 2
+    detmask[:, cols // 2 - 1:] |= 1 << 3
+    detmask[:2, :3] = 0
+    orbit = _view_orbit(ORBIT)
+
+    zenith, azimuth, transform = view_angle_grid(angle_obs, orbit, coeffs, detmask, gsd, subsamp)
+    gvecs = CachedGroundVectors(angle_obs, gsd, subsamp, rows, cols)
+    expected_zenith, expected_azimuth = _view_angles_reference(orbit, coeffs, detmask, gsd, subsamp, gvecs)
+    numpy.testing.assert_array_equal(numpy.isnan(zenith), detmask == 0)
+    numpy.testing.assert_allclose(zenith, expected_zenith, atol=1)
+    numpy.testing.assert_allclose(azimuth, expected_azimuth, atol=1)
+    assert transform * (0.5, 0.5) == (angle_obs['ul_x'] + gsd / 2, angle_obs['ul_y'] - gsd / 2)
+
+    # A subset computes the samples surrounding its bounds only
+    bounds = (400500, 8398500, 401500, 8399500)
+    zenith_subset, _, _ = view_angle_grid(angle_obs, orbit, coeffs, detmask, gsd, subsamp, bounds=bounds)
+    computed = numpy.isfinite(zenith_subset)
+    assert 0 < computed.sum() < (detmask > 0).sum()
+    numpy.testing.assert_array_equal(zenith_subset[computed], zenith[computed])
+
+
+def test_utm_inv():
+    """Arrays of UTM coordinates are inverted like scalars and agree with PROJ."""
+    xs, ys = numpy.meshgrid(numpy.linspace(399960, 509760, 7), numpy.linspace(8290240, 8400040, 5))
+    lat, lon = utm_inv(-23, xs, ys)
+    assert lat.shape == xs.shape
+    for (x, y, expected_lat, expected_lon) in zip(xs.flat, ys.flat, lat.flat, lon.flat):
+        assert utm_inv(-23, x, y) == (expected_lat, expected_lon)
+    lons, lats = transform(TILE_CRS, CRS.from_epsg(4326), xs.ravel(), ys.ravel())
+    numpy.testing.assert_allclose(numpy.degrees(lat).ravel(), lats, atol=1e-7)
+    numpy.testing.assert_allclose(numpy.degrees(lon).ravel(), lons, atol=1e-7)
+
+
+def test_line_of_sight_vectors():
+    """Ground vectors lie on the ellipsoid and lines of sight point at their zenith and azimuth."""
+    lat = numpy.radians(numpy.array([[-14.5, -15.3], [10.0, 60.0]]))
+    lon = numpy.radians(numpy.array([[-45.9, -45.1], [120.0, -170.0]]))
+    zen = numpy.radians(numpy.array([[2.0, 10.5], [0.0, 45.0]]))
+    az = numpy.radians(numpy.array([[100.0, 285.0], [0.0, 190.0]]))
+    sat, gx = LOSVec(lat, lon, zen, az)
+    assert sat.shape == gx.shape == (2, 2, 3)
+    numpy.testing.assert_array_equal(gx, GrndVec(lat, lon))
+    radius = (gx[..., 0] ** 2 + gx[..., 1] ** 2) / 6378137.0 ** 2 + gx[..., 2] ** 2 / 6356752.314 ** 2
+    numpy.testing.assert_allclose(radius, 1.0, rtol=1e-12)
+
+    # Local east, north and up components of the lines of sight
+    east = numpy.stack([-numpy.sin(lon), numpy.cos(lon), numpy.zeros_like(lon)], axis=-1)
+    north = numpy.stack([-numpy.sin(lat) * numpy.cos(lon), -numpy.sin(lat) * numpy.sin(lon), numpy.cos(lat)], axis=-1)
+    up = numpy.cross(east, north)
+    numpy.testing.assert_allclose(numpy.einsum('...i,...i', sat, up), numpy.cos(zen), atol=1e-12)
+    numpy.testing.assert_allclose(numpy.einsum('...i,...i', sat, east), numpy.sin(zen) * numpy.sin(az), atol=1e-12)
+    numpy.testing.assert_allclose(numpy.einsum('...i,...i', sat, north), numpy.sin(zen) * numpy.cos(az), atol=1e-12)
+    for index in numpy.ndindex(lat.shape):
+        numpy.testing.assert_allclose(LOSVec(lat[index], lon[index], zen[index], az[index])[0], sat[index], rtol=1e-15)
+
+
+def test_calcobs_partials():
+    """Analytic partials of CalcObs match central finite differences."""
+    lat = numpy.radians(numpy.array([-14.5, -14.8, -15.2, -15.3]))
+    lon = numpy.radians(numpy.array([-45.9, -45.4, -45.7, -45.1]))
+    obs = numpy.zeros(len(lat), dtype=OBS_DTYPE)
+    obs['gx'] = GrndVec(lat, lon)
+    obs['time'] = [-3.0, -1.0, 2.0, 4.0]
+
+    def residuals(orbit, time=0.0):
+        shifted = obs.copy()
+        shifted['time'] += time
+        return CalcObs(shifted, orbit, *_view_orbit(orbit)[5:])
+
+    _, P0, P1 = CalcObs(obs, ORBIT, *_view_orbit(ORBIT)[5:], partials=True)
+    for parm, step in enumerate((1e-6, 1e-6, 1.0, 1e-6)):
+        upper, lower = list(ORBIT), list(ORBIT)
+        upper[parm] += step
+        lower[parm] -= step
+        numeric = (residuals(upper) - residuals(lower)) / (2 * step)
+        numpy.testing.assert_allclose(P0[:, :, parm], numeric, rtol=1e-5, atol=1e-7 * abs(numeric).max())
+    numeric = (residuals(ORBIT, 1e-3) - residuals(ORBIT, -1e-3)) / 2e-3
+    numpy.testing.assert_allclose(P1, numeric, rtol=1e-5, atol=1e-7 * abs(numeric).max())
+
+
+def _fit_time_reference(ul_x, ul_y, obs, band):
+    """Per detector time fit of a band, as fitted before the normal equations were accumulated at once."""
+    tmodel = []
+    for sca in range(13):
+        A0 = numpy.zeros((4, 4))
+        L0 = numpy.zeros(4)
+        for los in obs:
+            if los['band'] == band and (sca == 0 or los['det'] == sca):
+                dx = los['x'] - ul_x
+                dy = ul_y - los['y']
+                basis = numpy.array([1.0, dx, dy, dx * dy])
+                A0 += numpy.outer(basis, basis)
+                L0 += basis * los['time']
+        if sca == 0:
+            A0all, L0all = A0, L0
+        try:
+            A0inv = numpy.linalg.inv(A0)
+        except numpy.linalg.LinAlgError:
+            A0, L0 = A0.copy(), L0.copy()
+            A0[0, 0] = max(A0[0, 0], 1.0)
+            A0[1:, 1:] = A0all[1:, 1:]
+            L0[1:] = L0all[1:]
+            A0inv = numpy.linalg.inv(A0)
+        tmodel.append(A0inv @ L0)
+    return numpy.array(tmodel)
+
+
+def test_fit_time():
+    """Fit_Time matches the per detector fit, including sparse and missing detectors."""
+    rng = numpy.random.default_rng(0)
+    ul_x, ul_y = 399960.0, 8400040.0
+    records = []
+    for det, count in ((1, 40), (2, 40), (3, 40), (4, 1)):
+        # One observation only (detector 4) gives singular normal equations
+        x = ul_x + (rng.integers(0, 92, count) * 1200.0 if count > 1 else numpy.array([1200.0]))
+        y = ul_y - (rng.integers(0, 92, count) * 1200.0 if count > 1 else numpy.array([2400.0]))
+        obs = numpy.zeros(count, dtype=OBS_DTYPE)
+        obs['band'], obs['det'], obs['x'], obs['y'] = 3, det, x, y
+        obs['time'] = det - 2.0 + 1.5e-4 * (ul_y - y) + 1e-5 * (x - ul_x) + rng.normal(0, 1e-3, count)
+        records.append(obs)
+    obs = numpy.concatenate(records)
+
+    time_parms = Fit_Time(ul_x, ul_y, obs)
+    expected = _fit_time_reference(ul_x, ul_y, obs, 3)
+    tmodel = time_parms[3]['tmodel']
+    assert tmodel.shape == (13, 4)
+    assert time_parms[3]['numobs'] == len(obs)
+
+    # Compare the modelled times over the tile, the coefficients being ill-conditioned
+    dx, dy = numpy.meshgrid(numpy.linspace(0, 109800, 12), numpy.linspace(0, 109800, 12))
+    basis = numpy.stack([numpy.ones_like(dx), dx, dy, dx * dy], axis=-1)
+    numpy.testing.assert_allclose(basis @ tmodel.T, basis @ expected.T, atol=1e-6)
+    assert time_parms[3]['rms'] < 2e-3 and time_parms[2]['rms'] is None
+
+
+def test_detector_footprint_raster(tmp_path):
+    """Raster footprints are read at the angle grid samples, the samples beyond the raster taking its edge."""
+    rows, cols = numpy.mgrid[0:100, 0:90]
+    footprint = ((rows // 7 + cols // 3) % 12 + 1).astype(numpy.uint8)
+    path = str(tmp_path / 'MSK_DETFOO_B05.jp2')
+    profile = dict(driver='GTiff', width=90, height=100, count=1, dtype='uint8', crs=TILE_CRS,
+                   transform=Affine(20, 0, 399960, 0, -20, 8400040))
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(footprint, 1)
+
+    detgrid = get_detgrid(path, 11, 10, 200, 20)
+    assert detgrid.shape == (11, 10)
+    numpy.testing.assert_array_equal(detgrid[:10, :9], footprint[::10, ::10])
+    numpy.testing.assert_array_equal(detgrid[10], detgrid[9])
+    numpy.testing.assert_array_equal(detgrid[:, 9], detgrid[:, 8])
+
+
+def test_rasterize_detector_footprints():
+    """Each detector sets its bit once, where its polygons overlap each other or other detectors."""
+    def square(left, top, size):
+        return [(left, top), (left + size, top), (left + size, top - size), (left, top - size), (left, top)]
+
+    ul_x, ul_y = 399960.0, 8400040.0
+    band_foot = [dict(detId=2, bandId=1, coords=square(ul_x, ul_y, 5000)),
+                 dict(detId=2, bandId=1, coords=square(ul_x + 2000, ul_y - 2000, 5000)),
+                 dict(detId=3, bandId=1, coords=square(ul_x + 4000, ul_y, 6000)),
+                 dict(detId=4, bandId=2, coords=square(ul_x, ul_y, 10000))]
+    detmask = rasterize_detfootprint(band_foot, 1, 10, 10, ul_x, ul_y, 10, 100)
+    assert detmask.dtype == numpy.uint16
+
+    # Samples at ul + 5 + index * 1000m
+    expected = numpy.zeros((10, 10), dtype=numpy.uint16)
+    expected[:5, :5] |= 1 << 2
+    expected[2:7, 2:7] |= 1 << 2
+    expected[:6, 4:10] |= 1 << 3
+    numpy.testing.assert_array_equal(detmask, expected)
+    assert rasterize_detfootprint(band_foot, 0, 10, 10, ul_x, ul_y, 10, 100).sum() == 0
+
+
+# Synthetic product of a 10980m tile at the corner of 23LLF, seen by detectors 2 and 3 of B02, B04 and B8A
+PRODUCT_NAME = 'S2A_MSIL1C_20230527T130251_N0509_R095_T23LLF_20230527T145859'
+PRODUCT_TILE_ID = 'S2A_OPER_MSI_L1C_TL_2APS_20230527T145859_A041234_T23LLF_N05.09'
+PRODUCT_SIZE = 10980
+PRODUCT_BANDS = {1: 'B02', 3: 'B04', 8: 'B8A'}
+# Detector 2 sees the samples west of ULX + 5500m, detector 3 the others
+DETECTOR_SPLIT = 5500
+
+
+@pytest.fixture(autouse=True)
+def no_cache(monkeypatch):
+    """Run without the persistent caches, unless a test sets a cache directory."""
+    monkeypatch.delenv(CACHE_DIR_ENV, raising=False)
+
+
+def _angle_grid_values(grid):
+    """Angle grid elements of MTD_TL.xml, with steps of 5000m."""
+    rows = ''.join(f'<VALUES>{" ".join(repr(float(value)) for value in row)}</VALUES>' for row in grid)
+    return f'<COL_STEP unit="m">5000</COL_STEP><ROW_STEP unit="m">5000</ROW_STEP><Values_List>{rows}</Values_List>'
+
+
+def _angle_grids(zenith, azimuth):
+    return f'<Zenith>{_angle_grid_values(zenith)}</Zenith><Azimuth>{_angle_grid_values(azimuth)}</Azimuth>'
+
+
+def _write_raster(path, array, resolution):
+    """Write a GeoTIFF on the synthetic tile, whatever the extension of path."""
+    profile = dict(driver='GTiff', width=array.shape[1], height=array.shape[0], count=1, dtype=array.dtype.name,
+                   crs=TILE_CRS, transform=Affine(resolution, 0, 399960, 0, -resolution, 8400040), compress='deflate')
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(array, 1)
+
+
+def _write_product(folder, tile_id=PRODUCT_TILE_ID):
+    """Write a synthetic .SAFE whose view angles are seen from ORBIT, returning its path.
+
+    The raster detector footprints and the reference band are GeoTIFFs named as their JPEG2000 counterparts.
+    """
+    safe = os.path.join(str(folder), PRODUCT_NAME + '.SAFE')
+    granule = os.path.join(safe, 'GRANULE', 'L1C_T23LLF_A041234_20230527T130251')
+    os.makedirs(os.path.join(granule, 'QI_DATA'))
+    os.makedirs(os.path.join(granule, 'IMG_DATA'))
+    with open(os.path.join(safe, 'MTD_MSIL1C.xml'), 'w') as f:
+        f.write(f'<Level-1C_User_Product><General_Info><Product_Info><PRODUCT_URI>{PRODUCT_NAME}.SAFE</PRODUCT_URI>'
+                '</Product_Info></General_Info></Level-1C_User_Product>')
+
+    # View angles at the 5000m grid nodes, detectors seeing the nodes up to 5000m beyond their footprint
+    xs, ys = numpy.meshgrid(399960.0 + numpy.arange(4) * 5000, 8400040.0 - numpy.arange(4) * 5000)
+    lat, lon = utm_inv(-23, xs, ys)
+    orbit = _view_orbit(ORBIT)
+    abeam = (orbit[5] - numpy.arcsin(numpy.sin(lat) / sin(ORBIT[3]))) * ORBIT[4] / (2 * pi)
+    view_grids = ''
+    for band in PRODUCT_BANDS:
+        for (det, offset, seen) in ((2, -0.3, xs < 399960 + DETECTOR_SPLIT + 5000),
+                                    (3, 0.3, xs > 399960 + DETECTOR_SPLIT - 5000)):
+            zenith, azimuth = CalcViewAngles(GrndVec(lat, lon), abeam + offset + 0.01 * band, orbit)
+            zenith, azimuth = numpy.where(seen, zenith / 100, numpy.nan), numpy.where(seen, azimuth / 100, numpy.nan)
+            grids = _angle_grids(zenith, azimuth)
+            view_grids += (f'<Viewing_Incidence_Angles_Grids bandId="{band}" detectorId="{det}">{grids}'
+                           '</Viewing_Incidence_Angles_Grids>')
+    sun_zenith = 34.0 + 0.1 * (8400040 - ys) / 5000 + 0.2 * (xs - 399960) / 5000
+    sun_azimuth = 41.0 + 0.3 * (8400040 - ys) / 5000 + 0.1 * (xs - 399960) / 5000
+
+    geocoding = ''.join(f'<Size resolution="{resolution}"><NROWS>{PRODUCT_SIZE // resolution}</NROWS>'
+                        f'<NCOLS>{PRODUCT_SIZE // resolution}</NCOLS></Size>'
+                        f'<Geoposition resolution="{resolution}"><ULX>399960</ULX><ULY>8400040</ULY></Geoposition>'
+                        for resolution in (10, 20, 60))
+    masks = ''.join(f'<MASK_FILENAME bandId="{band}" type="MSK_DETFOO">GRANULE/L1C/QI_DATA/MSK_DETFOO_{name}.jp2'
+                    '</MASK_FILENAME>' for (band, name) in PRODUCT_BANDS.items())
+    with open(os.path.join(granule, 'MTD_TL.xml'), 'w') as f:
+        f.write(f'<Level-1C_Tile_ID><General_Info><TILE_ID>{tile_id}</TILE_ID>'
+                '<SENSING_TIME>2023-05-27T13:10:48.123Z</SENSING_TIME></General_Info>'
+                '<Geometric_Info><Tile_Geocoding><HORIZONTAL_CS_NAME>WGS84 / UTM zone 23S</HORIZONTAL_CS_NAME>'
+                f'<HORIZONTAL_CS_CODE>EPSG:32723</HORIZONTAL_CS_CODE>{geocoding}</Tile_Geocoding>'
+                f'<Tile_Angles><Sun_Angles_Grid>{_angle_grids(sun_zenith, sun_azimuth)}</Sun_Angles_Grid>{view_grids}'
+                '</Tile_Angles></Geometric_Info>'
+                f'<Quality_Indicators_Info><Pixel_Level_QI>{masks}</Pixel_Level_QI></Quality_Indicators_Info>'
+                '</Level-1C_Tile_ID>')
+
+    # Detector footprints, the upper left 1000m being out of all of them
+    for (band, name) in PRODUCT_BANDS.items():
+        resolution = BAND_RESOLUTIONS[band]
+        size = PRODUCT_SIZE // resolution
+        footprint = numpy.where(numpy.arange(size) * resolution < DETECTOR_SPLIT, 2, 3).astype(numpy.uint8)
+        footprint = numpy.repeat(footprint[numpy.newaxis, :], size, axis=0)
+        footprint[:1000 // resolution, :1000 // resolution] = 0
+        _write_raster(os.path.join(granule, 'QI_DATA', f'MSK_DETFOO_{name}.jp2'), footprint, resolution)
+    _write_raster(os.path.join(granule, 'IMG_DATA', 'T23LLF_20230527T130251_B04.jp2'),
+                  numpy.zeros((PRODUCT_SIZE // 10, PRODUCT_SIZE // 10), dtype=numpy.uint16), 10)
+    return safe
+
+
+def _read(path, band=1):
+    with rasterio.open(path) as src:
+        return src.read(band)
+
+
+def test_zip_product(tmp_path):
+    """Zipped products give the outputs of their .SAFE, only their metadata and footprints being extracted."""
+    safe = _write_product(tmp_path)
+    zip_path = str(tmp_path / (PRODUCT_NAME + '.zip'))
+    with ZipFile(zip_path, 'w') as zip_file:
+        for (folder, _, names) in os.walk(safe):
+            for name in names:
+                zip_file.write(os.path.join(folder, name), os.path.relpath(os.path.join(folder, name), str(tmp_path)))
+
+    with zip_product_files(zip_path) as files:
+        assert files.imgref.startswith('/vsizip/') and files.imgref.endswith('_B04.jp2')
+        with rasterio.open(files.imgref) as src:
+            assert src.shape == (1098, 1098)
+        extracted = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(files.mtd))))
+        members = sorted(os.path.relpath(os.path.join(folder, name), extracted)
+                         for (folder, _, names) in os.walk(extracted) for name in names)
+        assert [member.rsplit('/', 1)[-1] for member in members] == [
+            'MTD_TL.xml', 'MSK_DETFOO_B02.jp2', 'MSK_DETFOO_B04.jp2', 'MSK_DETFOO_B8A.jp2', 'MTD_MSIL1C.xml']
+    assert not os.path.exists(extracted)
+
+    zip_outputs = gen_s2_ang(zip_path, str(tmp_path / 'zip'))
+    safe_outputs = gen_s2_ang(safe, str(tmp_path / 'safe'))
+    for (zip_output, safe_output) in zip(zip_outputs, safe_outputs):
+        assert os.path.basename(zip_output) == os.path.basename(safe_output)
+        numpy.testing.assert_array_equal(_read(zip_output), _read(safe_output))
+    assert (_read(safe_outputs[2]) != -9999).mean() > 0.99
+
+
+def test_upsample_window_registration():
+    """Metadata grid nodes are registered at ULX + i * 5000m and affine fields are reproduced."""
+    transform = angle_grid_transform(TILE_GRID)
+    nodes_x = TILE_GRID.transform.c + numpy.arange(23) * 5000.0
+    nodes_y = TILE_GRID.transform.f - numpy.arange(23) * 5000.0
+    field = 2.0 * nodes_x[numpy.newaxis, :] - 3.0 * nodes_y[:, numpy.newaxis]
+
+    grid = scale_grid(TILE_GRID, 60)
+    window = Window(10, 20, 300, 200)
+    values = upsample_window(field, transform, grid.transform, window)
+    cols, rows = numpy.meshgrid(numpy.arange(10, 310) + 0.5, numpy.arange(20, 220) + 0.5)
+    xs, ys = grid.transform * (cols, rows)
+    numpy.testing.assert_allclose(values, 2.0 * xs - 3.0 * ys, rtol=1e-12)
+
+    # A pixel centred on a node takes its value
+    node = Window(5000 // 10 - 1, 5000 // 10 - 1, 2, 2)
+    values = upsample_window(field, transform, TILE_GRID.transform, node)
+    numpy.testing.assert_allclose(values.mean(), field[1, 1], rtol=1e-12)
+
+
+def test_upsample_window_nan():
+    """Missing samples are left out of the interpolation and the remaining weights renormalized."""
+    array = numpy.array([[1.0, numpy.nan], [3.0, 5.0]])
+    transform = Affine(100, 0, 0, 0, -100, 200)
+    values = upsample_window(array, transform, Affine(1, 0, 0, 0, -1, 200), Window(0, 0, 200, 200))
+    # Half way between the four samples, the three valid ones are averaged
+    numpy.testing.assert_allclose(values[99:101, 99:101].mean(), 3.0, rtol=1e-9)
+    # Next to the missing sample only, there are no valid samples left
+    assert numpy.isnan(values[0, -1])
+    assert not numpy.isnan(values[:, :100]).any()
+    assert numpy.isnan(upsample_window(numpy.full((2, 2), numpy.nan), transform, transform, Window(0, 0, 2, 2))).all()
+
+
+def test_resample_anglebands(tmp_path):
+    """The metadata grid is written as is, registered on its nodes, and upsampled to the reference grid."""
+    grid = ReferenceGrid(width=1098, height=1098, transform=TILE_GRID.transform, crs=TILE_GRID.crs)
+    array = 30.0 + numpy.arange(16, dtype=numpy.float64).reshape(4, 4)
+    array[3, 3] = numpy.nan
+    resample_anglebands(array, grid, str(tmp_path / 'SZA.tif'), str(tmp_path / 'SZA_5000m.tif'))
+    with rasterio.open(str(tmp_path / 'SZA_5000m.tif')) as src:
+        assert src.shape == (4, 4) and src.crs == TILE_CRS
+        assert src.xy(1, 2) == (399960 + 2 * 5000, 8400040 - 5000)
+        numpy.testing.assert_array_equal(src.read(1, masked=True).filled(numpy.nan), array)
+    # The pixel of the grid node (1, 1) takes its value
+    assert _read(str(tmp_path / 'SZA.tif'))[500, 500] == 3500
+
+
+def test_encode_angles():
+    """Angles are rounded (or truncated for int32), azimuths wrapped and missing values set to nodata."""
+    values = numpy.array([12345.6, -0.4, 36010.0, 18000.0, -18001.0, numpy.nan])
+    numpy.testing.assert_array_equal(encode_angles(values, OUTPUT_PROFILES['default']),
+                                     [12345, 0, 36010, 18000, -18001, -9999])
+    numpy.testing.assert_array_equal(encode_angles(values, OUTPUT_PROFILES['int16'], azimuth=True),
+                                     [12346, 0, 10, -18000, 17999, -32768])
+    numpy.testing.assert_array_equal(encode_angles(values, OUTPUT_PROFILES['uint16'], azimuth=True),
+                                     [12346, 0, 10, 18000, 17999, 65535])
+    zenith = encode_angles(numpy.array([8999.5, 9000.4, numpy.nan]), OUTPUT_PROFILES['int16'])
+    assert zenith.dtype == numpy.int16
+    numpy.testing.assert_array_equal(zenith, [9000, 9000, -32768])
+
+
+@pytest.mark.parametrize('name', ['int16', 'cog'])
+def test_output_profiles(tmp_path, name):
+    """Outputs are tiled, scaled and compressed with the predictor of their profile, COGs with overviews."""
+    grid = ReferenceGrid(width=1200, height=1100, transform=TILE_GRID.transform, crs=TILE_CRS)
+
+    def compute(window):
+        cols = numpy.arange(window.col_off, window.col_off + window.width)
+        return numpy.broadcast_to(30000.0 + cols, (window.height, window.width))
+
+    path = write_angles(str(tmp_path / 'VAA.tif'), grid, compute, name, azimuth=True)
+    with rasterio.open(path) as src:
+        structure = src.tags(ns='IMAGE_STRUCTURE')
+        assert structure['COMPRESSION'] == 'ZSTD' and structure['PREDICTOR'] == '2'
+        assert (structure.get('LAYOUT') == 'COG') == (name == 'cog')
+        assert bool(src.overviews(1)) == (name == 'cog')
+        assert src.block_shapes == [(512, 512)] and src.dtypes == ('int16',) and src.scales == (0.01,)
+        numpy.testing.assert_array_equal(src.read(1)[0, :3], [-6000, -5999, -5998])
+
+
+def test_angle_stack(tmp_path):
+    """Stacked outputs hold the separate outputs as described bands, 20m bands being upsampled to 10m."""
+    safe = _write_product(tmp_path)
+    sz_path, sa_path, vz_path, va_path = gen_s2_ang(safe, str(tmp_path / 'files'), bands=['B8A', 'B02'])
+    assert sorted(vz_path) == ['B02', 'B8A']
+    descriptions = ('SZA', 'SAA', 'VZA_B02', 'VAA_B02', 'VZA_B8A', 'VAA_B8A')
+    for stack in ('band', 'vrt'):
+        paths = gen_s2_ang(safe, str(tmp_path / stack), bands=['B8A', 'B02'], stack=stack)
+        path = paths[0]
+        assert path.endswith('_ANG.tif' if stack == 'band' else '_ANG.vrt')
+        assert paths == (path, path, {'B02': path, 'B8A': path}, {'B02': path, 'B8A': path})
+        with rasterio.open(path) as src:
+            assert src.descriptions == descriptions and src.shape == (1098, 1098)
+            numpy.testing.assert_array_equal(src.read(1), _read(sz_path))
+            numpy.testing.assert_array_equal(src.read(4), _read(va_path['B02']))
+            assert numpy.abs(src.read(5)[::2, ::2].astype(float) - _read(vz_path['B8A'])).max() <= 1
+
+
+def _gen_s2_ang_or_crash(path, output_dir=None, **kwargs):
+    """gen_s2_ang of the batch tests, whose worker process dies on products named crash."""
+    if os.path.basename(path) == 'crash':
+        os._exit(1)
+    return gen_s2_ang(path, output_dir, **kwargs)
+
+
+def test_batch_failures(tmp_path, monkeypatch):
+    """A failing or crashing scene fails alone, the other scenes of the batch being done."""
+    safe = _write_product(tmp_path)
+    monkeypatch.setattr(batch, 'gen_s2_ang', _gen_s2_ang_or_crash)
+    products = [safe, str(tmp_path / 'crash'), str(tmp_path / 'missing'), safe]
+    results = gen_s2_ang_batch(products, str(tmp_path / 'out'), workers=3, max_memory=2**40)
+    assert [result.path for result in results] == products
+    assert [result.error is None for result in results] == [True, False, False, True]
+    assert 'BrokenProcessPool' in results[1].error and results[1].elapsed is None
+    assert 'IndexError' in results[2].error and results[2].elapsed is not None
+    assert results[3].outputs == results[0].outputs and os.path.exists(results[0].outputs[2])
+
+
+def test_batch_workers():
+    """Processes are bounded by the memory a scene needs, larger for stacked and COG outputs."""
+    assert batch_workers(10, 8, 4 * batch.SCENE_MEMORY) == 4
+    assert batch_workers(2, 8, 4 * batch.SCENE_MEMORY) == 2
+    assert batch_workers(10, 8, 1) == 1
+    assert estimate_scene_memory(bands=['B02', 'B8A']) == batch.SCENE_MEMORY
+    assert estimate_scene_memory(output_profile='cog') == batch.SCENE_MEMORY + batch.LAYER_MEMORY
+    assert estimate_scene_memory(bands=['B02', 'B8A'], stack='band') == batch.SCENE_MEMORY + 6 * batch.LAYER_MEMORY
+
+
+def test_cli(tmp_path):
+    """The command passes its options to the batch and exits with status 1 when a product fails."""
+    safe = _write_product(tmp_path)
+    runner = CliRunner()
+    assert runner.invoke(cli, []).exit_code == 2
+    assert runner.invoke(cli, [safe, '--bands', 'B02,B99']).exit_code == 2
+    assert __version__ in runner.invoke(cli, ['--version']).output
+
+    output_dir = str(tmp_path / 'out')
+    result = runner.invoke(cli, [safe, '-o', output_dir, '-w', '1', '-b', 'b02,B8A', '-b', 'B04', '--stack', 'band',
+                                 '-p', 'int16', '--bounds', '402000', '8391000', '406000', '8397000'])
+    assert result.exit_code == 0, result.output
+    assert '1 of 1 products done, 0 failed.' in result.output
+    with rasterio.open(os.path.join(output_dir, PRODUCT_NAME + '_ANG.tif')) as src:
+        assert src.descriptions == ('SZA', 'SAA', 'VZA_B02', 'VAA_B02', 'VZA_B04', 'VAA_B04', 'VZA_B8A', 'VAA_B8A')
+        assert src.dtypes[0] == 'int16' and src.bounds == (402000, 8390980, 406020, 8397040)
+
+    # Products of a list file, skipping comments and blank lines
+    list_file = tmp_path / 'products.txt'
+    list_file.write_text(f'# products\n{safe}\n\n{tmp_path / "missing"}\n')
+    result = runner.invoke(cli, ['--list', str(list_file), '-o', output_dir, '-w', '1', '--skip-existing'])
+    assert result.exit_code == 1
+    assert f'OK      {safe}' in result.output and f'FAILED  {tmp_path / "missing"}: IndexError' in result.output
+    assert 'Traceback' in result.stderr
+
+
+def test_orbit_cache(tmp_path):
+    """The other tiles of a datatake start from its cached orbit, kept as is when it fits their view angles."""
+    safe = _write_product(tmp_path)
+    mtd = os.path.join(safe, 'GRANULE', os.listdir(os.path.join(safe, 'GRANULE'))[0], 'MTD_TL.xml')
+    tile_id, angle_obs = get_angleobs(mtd)
+    key = cache.orbit_key(tile_id)
+    assert key == 'S2A_A041234' and cache.orbit_key('S2A_MSIL1C_TEST') is None
+    cache_dir = str(tmp_path / 'cache')
+    cold_orbit, _, cold = Fit_Orbit(angle_obs)
+    assert cold['converged'] and not cold['warm_start']
+
+    orbit, time_parms = fit_view_model(tile_id, angle_obs, cache_dir)
+    entries = cache.load_orbits(cache_dir, key)
+    assert [entry['tile'] for entry in entries] == [tile_id] and entries[0]['orbit'] == orbit[:5] == cold_orbit
+
+    # The cached orbit is moved along its track to the tile, and only the observation times are fitted
+    orbit0 = cache.nearest_orbit(cache_dir, key, cold_orbit[0] + 0.01)
+    fixed_orbit, fixed_time_parms, fixed = Fit_Orbit(angle_obs, orbit0=orbit0, los_tol=1e-3)
+    assert fixed['warm_start'] and fixed['orbit_fixed'] and fixed['converged']
+    assert fixed['iterations'] < cold['iterations'] and fixed_orbit[2:] == orbit0[2:]
+    # Synthetic view angles are rounded to hundredths of a degree, above the default tolerance
+    assert cold['los_rms'] > ORBIT_LOS_TOL
+    _, _, refined = Fit_Orbit(angle_obs, orbit0=orbit0, los_tol=ORBIT_LOS_TOL)
+    assert refined['warm_start'] and not refined['orbit_fixed'] and refined['converged']
+
+    # Both orbits give the same view angles
+    detmask = detector_grids(mtd, angle_obs, [3], BAND_RESOLUTIONS)[3]
+    fixed_orbit = _view_orbit(fixed_orbit)
+    zenith, azimuth, _ = view_angle_grid(angle_obs, orbit, time_parms[3]['tmodel'], detmask, 10)
+    fixed_zenith, fixed_azimuth, _ = view_angle_grid(angle_obs, fixed_orbit, fixed_time_parms[3]['tmodel'], detmask, 10)
+    numpy.testing.assert_allclose(fixed_zenith, zenith, atol=1)
+    numpy.testing.assert_allclose(fixed_azimuth, azimuth, atol=1)
+
+    # Only orbits fitted on the view angles of a tile are cached
+    fit_view_model(tile_id.replace('T23LLF', 'T23LLG'), angle_obs, cache_dir, los_tol=1e-3)
+    assert len(cache.load_orbits(cache_dir, key)) == 1
+    fit_view_model(tile_id.replace('T23LLF', 'T23LLG'), angle_obs, cache_dir)
+    assert len(cache.load_orbits(cache_dir, key)) == 2
+
+
+def test_ground_vectors_cache(tmp_path):
+    """Ground vectors are stored once per tile grid and memory-mapped from the cache directory afterwards."""
+    angle_obs = dict(zone=23, hemis='S', nrows=20, ncols=20, ul_x=399960.0, ul_y=8400040.0)
+    (gsd, subsamp) = (20, 10)
+    (rows, cols) = angle_grid_shape(angle_obs, gsd, subsamp)
+    cache_dir = str(tmp_path / 'cache')
+    expected = CalcGroundVectors(angle_obs, gsd, subsamp, 0, rows, 0, cols, rows, cols)
+
+    gvecs = CachedGroundVectors(angle_obs, gsd, subsamp, rows, cols, cache_dir)
+    numpy.testing.assert_array_equal(gvecs, expected)
+    assert not gvecs.flags.writeable
+    assert CachedGroundVectors(angle_obs, gsd, subsamp, rows, cols, cache_dir) is gvecs
+    stored = os.listdir(os.path.join(cache_dir, 'gvecs'))
+    assert len(stored) == 1 and stored[0].endswith('.npy')
+
+    # Once out of memory, the grid is read back from its file
+    _ground_vectors.cache_clear()
+    loaded = CachedGroundVectors(angle_obs, gsd, subsamp, rows, cols, cache_dir)
+    assert isinstance(loaded, numpy.memmap) and not loaded.flags.writeable
+    numpy.testing.assert_array_equal(loaded, expected)
+    assert os.listdir(os.path.join(cache_dir, 'gvecs')) == stored
+
+    # Subsets compute their own samples without caching the grid
+    subset_cache = str(tmp_path / 'subset')
+    detmask = numpy.full((rows, cols), 1 << 2, dtype=numpy.uint16)
+    coeffs = numpy.zeros((13, 4))
+    coeffs[2] = [-0.5, 1e-5, 1.5e-4, 0.0]
+    view_angle_grid(angle_obs, _view_orbit(ORBIT), coeffs, detmask, gsd, subsamp,
+                    bounds=(400500, 8398500, 401500, 8399500), cache_dir=subset_cache)
+    assert not os.path.exists(subset_cache)
+
+
+def test_output_cache(tmp_path, monkeypatch):
+    """Products sharing a geometry copy the cached outputs, the least recently used being removed beyond the limit."""
+    safe = _write_product(tmp_path)
+    cache_dir = str(tmp_path / 'cache')
+    monkeypatch.setenv(CACHE_DIR_ENV, cache_dir)
+    outputs = gen_s2_ang(safe, str(tmp_path / 'first'))
+    (key,) = os.listdir(os.path.join(cache_dir, 'outputs'))
+
+    def no_angles(*args, **kwargs):
+        raise AssertionError('cached outputs are computed again')
+
+    monkeypatch.setattr(s2_angs, 'angle_layers', no_angles)
+    restored = gen_s2_ang(safe, str(tmp_path / 'second'))
+    for (output, restored_output) in zip(outputs, restored):
+        assert os.path.basename(output) == os.path.basename(restored_output)
+        numpy.testing.assert_array_equal(_read(restored_output), _read(output))
+    # Other options are computed
+    with pytest.raises(AssertionError, match='computed again'):
+        gen_s2_ang(safe, str(tmp_path / 'third'), output_profile='int16')
+
+    # Restoring an entry makes it the most recently used
+    source = tmp_path / 'output.tif'
+    source.write_bytes(b'\0' * 1000)
+    entry_size = cache._entry_size(os.path.join(cache_dir, 'outputs', key))
+    cache.store_outputs(cache_dir, 'old', {'output.tif': str(source)})
+    os.utime(os.path.join(cache_dir, 'outputs', 'old'), ns=(0, 0))
+    os.utime(os.path.join(cache_dir, 'outputs', key), ns=(1, 1))
+    assert cache.restore_outputs(cache_dir, key, {'SZA.tif': str(tmp_path / 'SZA.tif')})
+    cache.store_outputs(cache_dir, 'new', {'output.tif': str(source)}, max_bytes=entry_size + 1500)
+    assert sorted(os.listdir(os.path.join(cache_dir, 'outputs'))) == sorted([key, 'new'])
+    # The stored entry is kept even beyond the limit
+    cache.store_outputs(cache_dir, 'newest', {'output.tif': str(source)}, max_bytes=0)
+    assert os.listdir(os.path.join(cache_dir, 'outputs')) == ['newest']
+    assert not cache.restore_outputs(cache_dir, key, {'SZA.tif': str(tmp_path / 'SZA.tif')})
+
+
+def test_outdated_outputs(tmp_path, monkeypatch):
+    """Only missing, stale or corrupt outputs are outdated, unchanged outputs are not hashed again."""
+    outputs = {name: str(tmp_path / f'{name}.tif') for name in ('SZA', 'SAA', 'VZA', 'VAA')}
+    for name, path in outputs.items():
+        with open(path, 'wb') as f:
+            f.write(name.encode() * 100)
+    path = str(tmp_path / 'scene_ANG.json')
+    options = {'bands': None, 'output_profile': 'default'}
+    assert manifest.outdated_outputs(path, 'digest', options, outputs) == set(outputs)
+
+    manifest.write_manifest(path, 'digest', options, outputs)
+    hashed = []
+    checksum = manifest.file_checksum
+    monkeypatch.setattr(manifest, 'file_checksum', lambda output: hashed.append(output) or checksum(output))
+    assert manifest.outdated_outputs(path, 'digest', options, outputs) == set()
+    assert hashed == []
+    assert manifest.outdated_outputs(path, 'other', options, outputs) == set(outputs)
+    assert manifest.outdated_outputs(path, 'digest', dict(options, bands=['B02']), outputs) == set(outputs)
+
+    # Same size, other content, found by its modification time or when verifying
+    stat = os.stat(outputs['SAA'])
+    with open(outputs['SAA'], 'r+b') as f:
+        f.write(b'XX')
+    (tmp_path / 'VAA.tif').unlink()
+    assert manifest.outdated_outputs(path, 'digest', options, outputs) == {'SAA', 'VAA'}
+    assert hashed == [outputs['SAA']]
+    os.utime(outputs['SAA'], ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert manifest.outdated_outputs(path, 'digest', options, outputs) == {'VAA'}
+    assert manifest.outdated_outputs(path, 'digest', options, outputs, verify=True) == {'SAA', 'VAA'}
+
+    # Only the rewritten outputs are hashed
+    with open(outputs['SAA'], 'wb') as f:
+        f.write(b'SAA' * 100)
+    with open(outputs['VAA'], 'wb') as f:
+        f.write(b'VAA' * 100)
+    hashed.clear()
+    manifest.write_manifest(path, 'digest', options, outputs)
+    assert sorted(hashed) == sorted([outputs['SAA'], outputs['VAA']])
+    assert manifest.read_manifest(path)['outputs']['VAA']['sha256'] == checksum(outputs['VAA'])
+    assert manifest.outdated_outputs(path, 'digest', options, outputs, verify=True) == set()
+
+
+def test_interrupted_run(tmp_path, monkeypatch):
+    """The manifest records each output once written, so a resumed run only computes the others."""
+    safe = _write_product(tmp_path)
+    manifest_path = str(tmp_path / 'angles' / (PRODUCT_NAME + '_ANG.json'))
+    (written, failing) = ([], ['_VZAr.tif'])
+
+    def write_or_fail(path, *args, **kwargs):
+        if path.endswith(tuple(failing)):
+            raise OSError('No space left on device')
+        written.append(path.rsplit('_', 1)[-1])
+        return write_angles(path, *args, **kwargs)
+
+    monkeypatch.setattr(s2_angs, 'write_angles', write_or_fail)
+    with pytest.raises(OSError):
+        gen_s2_ang(safe, str(tmp_path / 'angles'))
+    assert written == ['SZAr.tif', 'SAAr.tif']
+    assert sorted(manifest.read_manifest(manifest_path)['outputs']) == ['SAA.tif', 'SZA.tif']
+
+    failing.clear()
+    written.clear()
+    outputs = gen_s2_ang(safe, str(tmp_path / 'angles'), skip_existing=True)
+    assert written == ['VZAr.tif', 'VAAr.tif']
+    assert sorted(manifest.read_manifest(manifest_path)['outputs']) == ['SAA.tif', 'SZA.tif', 'VAA.tif', 'VZA.tif']
+    assert all(os.path.exists(output) for output in outputs)
+
+
+def test_compute_s2_angles(tmp_path):
+    """The angles computed in memory are the written outputs, before their scaling to hundredths of a degree."""
+    safe = _write_product(tmp_path)
+    contents = sorted(os.listdir(str(tmp_path)))
+    angles = compute_s2_angles(safe)
+    assert sorted(os.listdir(str(tmp_path))) == contents
+
+    outputs = gen_s2_ang(safe, str(tmp_path / 'angles'))
+    with rasterio.open(outputs[0]) as src:
+        assert (angles.transform, angles.crs) == (src.transform, src.crs)
+    for (array, output, azimuth) in zip(angles[:4], outputs, (False, True, False, True)):
+        written = _read(output)
+        assert array.dtype == numpy.float32 and array.shape == written.shape
+        numpy.testing.assert_array_equal(numpy.isnan(array), written == -9999)
+        difference = numpy.abs(array * 100 - written)[written != -9999]
+        if azimuth:
+            difference = numpy.minimum(difference, 36000 - difference)
+        assert difference.max() <= 1
+
+    # Bands at a coarser resolution, over an area
+    bounds = (402000, 8390980, 406020, 8397040)
+    angles = compute_s2_angles(safe, bands=['B02', 'B8A'], bbox=bounds, resolution=20)
+    assert sorted(angles.vza) == sorted(angles.vaa) == ['B02', 'B8A']
+    assert angles.sza.shape == angles.vza['B8A'].shape == (303, 201)
+    assert angles.transform == Affine(20, 0, 402000, 0, -20, 8397040)
+    assert numpy.isfinite(angles.vza['B02']).all() and numpy.isfinite(angles.vaa['B8A']).all()
+
+
+def test_iter_s2_angles(tmp_path):
+    """Blocks are aligned to the tile blocks, cover the area once and hold the angles computed in memory."""
+    safe = _write_product(tmp_path)
+    bounds = (402000, 8390980, 406020, 8397040)
+    angles = compute_s2_angles(safe, bands=['B02', 'B8A'], bbox=bounds, resolution=20)
+    (row_off, col_off) = (int((TILE_GRID.transform.f - 8397040) / 20), int((402000 - TILE_GRID.transform.c) / 20))
+    covered = numpy.zeros(angles.sza.shape, dtype=int)
+    blocks = iter_s2_angles(safe, bands=['B02', 'B8A'], bbox=bounds, resolution=20, block_size=(128, 64))
+    for (window, sza, saa, vza, vaa) in blocks:
+        assert window.row_off == row_off or window.row_off % 128 == 0
+        assert window.col_off == col_off or window.col_off % 64 == 0
+        assert 0 < window.height <= 128 and 0 < window.width <= 64
+        area = (slice(window.row_off - row_off, window.row_off - row_off + window.height),
+                slice(window.col_off - col_off, window.col_off - col_off + window.width))
+        covered[area] += 1
+        numpy.testing.assert_allclose(sza, angles.sza[area], atol=1e-4)
+        numpy.testing.assert_allclose(saa, angles.saa[area], atol=1e-4)
+        for band in ('B02', 'B8A'):
+            assert vza[band].dtype == numpy.float32 and vza[band].shape == (window.height, window.width)
+            numpy.testing.assert_allclose(vza[band], angles.vza[band][area], atol=1e-4)
+            numpy.testing.assert_allclose(vaa[band], angles.vaa[band][area], atol=1e-4)
+    assert (covered == 1).all()
+
+    # Without an area, the blocks of the reference band are used
+    windows = [window for (window, *_) in iter_s2_angles(safe)]
+    with rasterio.open(os.path.join(safe, 'GRANULE', os.listdir(os.path.join(safe, 'GRANULE'))[0], 'IMG_DATA',
+                                    'T23LLF_20230527T130251_B04.jp2')) as src:
+        assert windows == [window for (_, window) in src.block_windows(1)]
+
+
+def test_crop_grid():
+    """Crops are widened to the 60m grid, so they are exact at every band resolution."""
+    bounds = (450005, 8340003, 460001, 8350007)
+    grid = crop_grid(TILE_GRID, bounds)
+    left, bottom, right, top = grid_bounds(grid)
+    assert (left, top) == (450000, 8350060)
+    assert left <= bounds[0] and bottom <= bounds[1] and right >= bounds[2] and top >= bounds[3]
+    for resolution in (10, 20, 60):
+        assert (left - TILE_GRID.transform.c) % resolution == 0 and (TILE_GRID.transform.f - top) % resolution == 0
+        assert grid_bounds(scale_grid(grid, resolution)) == (left, bottom, right, top)
+
+    # Clipped to the tile, and bounds outside of it are rejected
+    clipped = crop_grid(TILE_GRID, (500000, 8200000, 600000, 8300000))
+    assert clipped == crop_grid(TILE_GRID, (500000, 8290240, 509760, 8300000))
+    assert grid_bounds(clipped)[1:3] == (8290240, 509760)
+    with pytest.raises(ValueError):
+        crop_grid(TILE_GRID, (0, 0, 1000, 1000))
+
+    # Longitudes and latitudes are cropped to the bounding box of their projection
+    lonlat = transform_bounds(TILE_CRS, 'EPSG:4326', *bounds)
+    geographic = crop_grid(TILE_GRID, lonlat, crs='EPSG:4326')
+    assert geographic == crop_grid(TILE_GRID, transform_bounds('EPSG:4326', TILE_CRS, *lonlat, densify_pts=21))
+    left, bottom, right, top = grid_bounds(geographic)
+    assert left <= bounds[0] and bottom <= bounds[1] and right >= bounds[2] and top >= bounds[3]
+    assert crop_grid(TILE_GRID, bounds, crs=TILE_CRS) == grid
+
+
+def test_bbox_outputs(tmp_path):
+    """Every output of a run restricted to an area, given in the tile crs or as longitudes and latitudes, covers it."""
+    safe = _write_product(tmp_path)
+    bounds = (402000, 8390980, 406020, 8397040)
+    tile_outputs = gen_s2_ang(safe, str(tmp_path / 'tile'))
+    lonlat = transform_bounds(TILE_CRS, 'EPSG:4326', *bounds)
+    for (name, bbox, bbox_crs) in (('utm', bounds, None), ('lonlat', lonlat, 'EPSG:4326')):
+        outputs = gen_s2_ang(safe, str(tmp_path / name), bbox=bbox, bbox_crs=bbox_crs)
+        for (output, tile_output) in zip(outputs, tile_outputs):
+            with rasterio.open(output) as src, rasterio.open(tile_output) as tile_src:
+                left, bottom, right, top = src.bounds
+                assert left <= bounds[0] and bottom <= bounds[1] and right >= bounds[2] and top >= bounds[3]
+                assert (left - 399960) % 60 == 0 and (8400040 - top) % 60 == 0
+                window = tile_src.window(*src.bounds)
+                numpy.testing.assert_array_equal(src.read(1), tile_src.read(1, window=window))
+
+
+def test_angle_model(tmp_path):
+    """A saved angle model evaluates, without the product, the angles computed from it."""
+    safe = _write_product(tmp_path)
+    model = AngleModel.from_product(safe, bands=['B02', 'B04'])
+    assert model.bands == ['B02', 'B04'] and model.header['tile_id'] == PRODUCT_TILE_ID
+    model.save(str(tmp_path / 'model.npz'))
+    assert os.path.getsize(str(tmp_path / 'model.npz')) < 100 * 1024
+    loaded = AngleModel.load(str(tmp_path / 'model.npz'))
+    assert loaded.header == model.header and loaded.bands == model.bands
+
+    expected = compute_s2_angles(safe, bands=['B02', 'B04'], resolution=20)
+    window = Window(100, 150, 200, 120)
+    angles = loaded.evaluate(window, resolution=20, bands=['B02', 'B04'])
+    assert angles.transform == expected.transform * Affine.translation(100, 150) and angles.crs == expected.crs
+    area = window.toslices()
+    numpy.testing.assert_allclose(angles.sza, expected.sza[area], atol=1e-4)
+    numpy.testing.assert_allclose(angles.saa, expected.saa[area], atol=1e-4)
+    for band in ('B02', 'B04'):
+        numpy.testing.assert_allclose(angles.vza[band], expected.vza[band][area], atol=1e-4)
+        numpy.testing.assert_allclose(angles.vaa[band], expected.vaa[band][area], atol=1e-4)
+    numpy.testing.assert_allclose(loaded.evaluate().vza, compute_s2_angles(safe).vza, atol=1e-4)
+
+    model.header['version'] = MODEL_VERSION + 1
+    model.save(str(tmp_path / 'future.npz'))
+    with pytest.raises(ValueError, match='Unsupported angle model version'):
+        AngleModel.load(str(tmp_path / 'future.npz'))
+
+
+def test_angles_at(tmp_path):
+    """Angles at points, given as longitudes and latitudes, are the angles of the pixels centred on them."""
+    safe = _write_product(tmp_path)
+    AngleModel.from_product(safe).save(str(tmp_path / 'model.npz'))
+    expected = compute_s2_angles(safe)
+    rows = numpy.array([500, 500, 500, 10, 500])
+    cols = numpy.array([200, 549, 800, 10, 200])
+    xs, ys = expected.transform * (cols + 0.5, rows + 0.5)
+    xs[4] = 300000.0
+    lons, lats = transform(TILE_CRS, CRS.from_epsg(4326), xs, ys)
+
+    points = angles_at(str(tmp_path / 'model.npz'), lons, lats, crs='EPSG:4326')
+    for name in ('sza', 'saa', 'vza', 'vaa'):
+        numpy.testing.assert_allclose(getattr(points, name)[:4], getattr(expected, name)[rows[:4], cols[:4]],
+                                      atol=1e-4)
+    # The fourth point is out of the detector footprints and the last out of the tile
+    assert numpy.isnan(points.vza[3:]).all() and numpy.isnan(points.sza[4]) and numpy.isfinite(points.sza[:4]).all()
+    numpy.testing.assert_array_equal(points.detectors, [1 << 2, 1 << 2 | 1 << 3, 1 << 3, 0, 0])
+    assert [detector_ids(detectors) for detectors in points.detectors[:3]] == [[2], [2, 3], [3]]
+
+    # Products are fitted, the points being in the tile crs by default
+    product_points = angles_at(safe, xs, ys, bands=['B02', 'B04'])
+    numpy.testing.assert_allclose(product_points.vza['B04'], points.vza, atol=1e-4)
+    numpy.testing.assert_array_equal(product_points.detectors['B04'], points.detectors)
+    assert sorted(product_points.vaa) == ['B02', 'B04']